@@ -0,0 +1,198 @@
+import asyncio
+import time
+import colorlog
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from crawler import FETCH_BYTES, IDLE_POLL, Crawler
+from fetch import CHUNK_SIZE, BodyBuffer, FetchAborted, check_headers
+from validators import conditional_headers
+
+logger = colorlog.getLogger('NLPCrawl')
+
+
+class AsyncCrawler(Crawler):
+    '''asyncio fetch backend for the crawler. fetches are multiplexed on
+    one event loop over a shared aiohttp session (keep-alive connections,
+    cached dns, per host connection cap). parsing and publishing still run
+    on a small thread pool so they never block the event loop'''
+    def __init__(self, *args, concurrency=1000, limit_per_host=8,
+                 dns_cache_ttl=300, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+
+        # per host semaphores, so queued requests don't burn their timeout
+        # waiting on the connection pool
+        self._host_slots = {}
+
+        # set from any thread to wake _crawl_async, see _wake
+        self._loop = None
+        self._wake_event = None
+
+    def crawl(self, max_pages=None):
+        '''start the crawler in motion'''
+        logger.info('│ ├ Starting async crawler ({} in flight, {} per host)...'.format(
+            self.concurrency, self.limit_per_host))
+
+        self._limiter = self._new_limiter(self.concurrency)
+        self._stopping = False
+        loop = asyncio.new_event_loop()
+        self._limiter.start(on_change=self._wake)
+        try:
+            with self._stop_on_sigterm():
+                loop.run_until_complete(self._crawl_async(max_pages))
+        finally:
+            self._limiter.stop()
+            self._loop = None
+            loop.close()
+
+        self._finish_crawl()
+
+        logger.info('│ └ crawled {} links!'.format(self._crawled_count))
+
+    def _wake(self):
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wake_event.set)
+            except RuntimeError:
+                pass  # the loop has closed
+
+    async def _crawl_async(self, max_pages):
+        '''keeps as many fetches in flight as the limiter allows (at most
+        `concurrency`) until the frontier is drained and nothing is left
+        in flight'''
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            ssl=False
+        )
+        timeout = aiohttp.ClientTimeout(total=self.fetch_deadline,
+                                        sock_connect=self.fetch_timeout,
+                                        sock_read=self.fetch_timeout)
+        executor = ThreadPoolExecutor(self.num_threads)
+        self._loop = asyncio.get_event_loop()
+        self._wake_event = asyncio.Event()
+
+        scheduled = 0
+        stop_saved = False
+        pending = set()
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                while True:
+                    # max_pages reached or stop() called, let what's in flight finish
+                    winding_down = self._stopping or (max_pages is not None and scheduled >= max_pages)
+                    while not winding_down and len(pending) < self._limiter.limit:
+                        item = self._next_url()
+                        if item is None:
+                            break
+                        url, depth = item
+                        scheduled += 1
+                        pending.add(asyncio.ensure_future(
+                            self._fetch_async(session, executor, url, depth)))
+                        winding_down = max_pages is not None and scheduled >= max_pages
+
+                    # wake up again when a fetch finishes, the next host's
+                    # politeness window opens or the limiter pauses or resumes
+                    if winding_down or self._limiter.paused:
+                        ready_in = None
+                    elif len(pending) >= self._limiter.limit:
+                        self._limiter.saturated()
+                        ready_in = None
+                    else:
+                        ready_in = self._urls_to_crawl.next_ready_in()
+
+                    if not pending and ready_in is None:
+                        # nothing in flight and nothing left to schedule, we're done
+                        if winding_down:
+                            break
+                        if not self._limiter.paused:
+                            if not self._expecting_work():
+                                break
+                            ready_in = IDLE_POLL
+
+                    self._wake_event.clear()
+                    woken = asyncio.ensure_future(self._wake_event.wait())
+                    done, pending = await asyncio.wait(
+                        pending | {woken}, timeout=ready_in,
+                        return_when=asyncio.FIRST_COMPLETED)
+                    woken.cancel()
+                    pending.discard(woken)
+                    done.discard(woken)
+                    for task in done:
+                        if task.exception() is not None:
+                            logger.warning('│ │ │ └ {!r}'.format(task.exception()))
+
+                    force = self._stopping and not stop_saved
+                    if self._checkpoint_due(force):
+                        # sqlite writes of the whole frontier and the bloom
+                        # filter, the fetches in flight carry on meanwhile
+                        await self._loop.run_in_executor(executor, self._checkpoint, force)
+                    # once, as docker stop won't wait long for the fetches in flight
+                    stop_saved = self._stopping
+        finally:
+            executor.shutdown(wait=True)
+
+    async def _fetch_async(self, session, executor, url, depth):
+        '''fetches one page and hands it off to the shared page processing'''
+        host = urlparse(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(self.limit_per_host)
+
+        loop = asyncio.get_event_loop()
+        try:
+            async with slot:
+                if self.verbose:
+                    logger.info('│ │ ├ Fetching {}...'.format(url))
+                # sqlite, and the seen set below, stay off the event loop
+                cached = await loop.run_in_executor(executor, self._validators.get, url)
+                started = time.perf_counter()
+                try:
+                    async with session.get(url, headers=conditional_headers(cached)) as result:
+                        body = None
+                        if result.status == 200:
+                            # the total timeout is the request deadline
+                            check_headers(result.headers, self.allowed_content_types,
+                                          self.max_body_size)
+                            buffer = BodyBuffer(self.max_body_size)
+                            async for chunk in result.content.iter_chunked(CHUNK_SIZE):
+                                buffer.feed(chunk)
+                            body = buffer.getvalue()
+                        self._observe_fetch(host, result.status, started)
+                        if self.verbose:
+                            logger.info('│ │ │ └ result code {}...'.format(result.status))
+                        # processed below, once the connection and slot are free
+                        unchanged = result.status == 304 and cached is not None
+                        if not unchanged and result.status != 200:
+                            return False
+                        if body is not None:
+                            FETCH_BYTES.inc(len(body), host=host)
+                        headers = result.headers
+                except FetchAborted as e:
+                    # leaving the block unread closes the connection
+                    self._aborted(url, e.reason)
+                    return False
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if (isinstance(e, asyncio.TimeoutError)
+                            and time.perf_counter() - started >= self.fetch_deadline):
+                        # the total timeout, an abort like the thread
+                        # backend's, so the limiter doesn't count it
+                        self._aborted(url, 'deadline')
+                        return False
+                    self._observe_fetch(host, 'error', started)
+                    logger.warning('│ │ │ └ {!r}'.format(e))
+                    return False
+
+            if unchanged:
+                return await loop.run_in_executor(
+                    executor, self._process_unchanged, url, cached, depth)
+            return await loop.run_in_executor(
+                executor, self._fetched, url, body, depth, headers, cached)
+        finally:
+            self._done(url)
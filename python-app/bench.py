@@ -0,0 +1,613 @@
+'''offline benchmarks for the crawler, cleaner and the whole pipeline.
+
+everything runs in process: pages come from a synthetic site served on
+localhost and messages go through the in-memory publisher, so neither the
+real site nor rabbitmq is needed. results are printed (or written) as json,
+and can be checked against an earlier run with --baseline.
+
+    python bench.py                           # every benchmark
+    python bench.py crawl-async clean --pages 2000 --latency 0.01
+    python bench.py --output new.json --baseline old.json
+    python bench.py crawl-cluster --nodes 3 --hosts 12
+'''
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import colorlog
+
+from publisher import MEMORY_HOST, get_publisher
+
+logger = colorlog.getLogger('NLPCrawl')
+
+BENCHMARKS = ['crawl-thread', 'crawl-async', 'crawl-cluster', 'clean', 'pipeline']
+
+# rate metrics, higher is better. everything ending in _s is a latency
+RATES = ('pages_per_s', 'docs_per_s')
+
+HTML_QUEUE = 'HTML_QUEUE'
+DOC_QUEUE = 'DOC_QUEUE'
+FEATURE_QUEUE = 'FEAT_QUEUE'
+CORPUS_QUEUE = 'CORPUS_QUEUE'
+DOC_EXCHANGE = 'DOC_EXCHANGE'
+
+# idle_timeout of the services in the pipeline benchmark
+PIPELINE_IDLE = 0.2
+
+_SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'po', 'ven', 'dor',
+              'ing', 'ed', 'er', 'al', 'ly', 'tion', 'ness', 'ment']
+_FILLER = ['the', 'and', 'of', 'to', 'in', 'is', 'it', 'that', 'was', 'for']
+
+# stands in for the server port in links between hosts until start()
+_PORT = '__PORT__'
+
+
+class _Server(ThreadingHTTPServer):
+    # a crawl opens connections faster than the default backlog of 5 takes
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class SyntheticSite(object):
+    '''a generated site of `pages` html pages of about `page_size` bytes,
+    each linking to `fanout` others (page i always links to page i + 1,
+    so every page is reachable from /). pages are rendered up front and
+    served from a threaded http server that waits `latency` seconds
+    before every response. the arrival time of each request is kept so
+    crawl latencies can be measured.
+
+    with `hosts` above one the pages are spread round robin over that many
+    loopback addresses (127.0.0.1, 127.0.0.2, ...), all on the same port,
+    and links to another host's pages are absolute'''
+    def __init__(self, pages=1000, fanout=10, page_size=8192, latency=0.0,
+                 vocabulary=20000, seed=0, hosts=1):
+        self.pages = pages
+        self.latency = latency
+        self.hosts = hosts
+        rng = random.Random(seed)
+        words = [''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4)))
+                 for _ in range(vocabulary)] + _FILLER
+        # roughly zipfian, like real text
+        cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+
+        self._bodies = []
+        for i in range(pages):
+            targets = [(i + 1) % pages] + [rng.randrange(pages) for _ in range(fanout - 1)]
+            links = ''.join('<li><a href="{}/page/{}.html">page {}</a></li>'.format(
+                '' if t % hosts == i % hosts else 'http://{}:{}'.format(self._address(t), _PORT), t, t)
+                for t in targets)
+            paragraphs = []
+            size = 0
+            while size < page_size:
+                sentence = ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(8, 24)))
+                paragraph = '<p>{}, {}. {}!</p>'.format(
+                    sentence.capitalize(), rng.randint(0, 9999), rng.choice(words))
+                paragraphs.append(paragraph)
+                size += len(paragraph)
+            self._bodies.append((
+                '<html><head><title>page {}</title>'
+                '<style>p {{ margin: 0 }}</style></head><body>'
+                '<nav><ul>{}</ul></nav>{}'
+                '<script>var page = {};</script></body></html>'
+            ).format(i, links, ''.join(paragraphs), i).encode('utf-8'))
+
+        self.arrivals = {}
+        self._servers = []
+
+    def _address(self, i):
+        return '127.0.0.{}'.format(1 + i % self.hosts)
+
+    def html(self, i):
+        return self._bodies[i]
+
+    def start(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                site.arrivals.setdefault(self.path, time.time())
+                if site.latency:
+                    time.sleep(site.latency)
+                try:
+                    i = 0 if self.path == '/' else int(self.path[len('/page/'):-len('.html')])
+                    body = site._bodies[i]
+                except (ValueError, IndexError):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        port = 0
+        for k in range(self.hosts):
+            server = _Server((self._address(k), port), Handler)
+            port = server.server_address[1]
+            self._servers.append(server)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._bodies = [body.replace(_PORT.encode('ascii'), str(port).encode('ascii'))
+                        for body in self._bodies]
+        return self
+
+    @property
+    def host(self):
+        return '127.0.0.1:{}'.format(self._servers[0].server_address[1])
+
+    @property
+    def url(self):
+        return 'http://{}/'.format(self.host)
+
+    def latency_of(self, url, finished_at):
+        '''seconds between the request for `url` reaching the server and
+        `finished_at`'''
+        path = urlsplit(url).path
+        started = self.arrivals.get(path)
+        return None if started is None else finished_at - started
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+
+def percentile(values, q):
+    '''nearest rank percentile, None for no values'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def latencies(values, prefix):
+    return {prefix + '_p50_s': percentile(values, 50),
+            prefix + '_p99_s': percentile(values, 99)}
+
+
+def peak_rss(children=None):
+    '''peak resident set size in kB of this process and of its biggest
+    child, as sampled by a ChildRss if given'''
+    scale = 1024 if sys.platform == 'darwin' else 1  # darwin reports bytes
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    if children is not None and children.supported:
+        children_kb = max(children_kb, children.peak_kb)
+    return {'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            'peak_rss_children_kb': children_kb}
+
+
+def _descendants(pid):
+    '''pids of every live process below `pid`, from /proc'''
+    parents = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            continue  # exited
+        # the command name may hold spaces and parentheses, ppid follows the last ')'
+        parents[int(stat[stat.rindex(')') + 2:].split()[1])].append(int(entry))
+    found = []
+    todo = [pid]
+    while todo:
+        children = parents.get(todo.pop(), ())
+        found.extend(children)
+        todo.extend(children)
+    return found
+
+
+def _vm_hwm_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class ChildRss(object):
+    '''samples the peak rss of every process below this one while the
+    with block runs. getrusage(RUSAGE_CHILDREN) only counts children that
+    were waited for, and workers started from the multiprocessing
+    forkserver are its children, not ours. linux only, see `supported`'''
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.supported = os.path.exists('/proc/self/status')
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        for pid in _descendants(os.getpid()):
+            self.peak_kb = max(self.peak_kb, _vm_hwm_kb(pid))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if self.supported:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+def _header(properties, name):
+    value = (properties.headers or {}).get(name)
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _crawl_config(args, site):
+    return {
+        'start_url': site.url,
+        'include_urls': ['127.0.0.'],
+        'exclude_urls': [],
+        'include_content': [],
+        'exclude_content': [],
+        'num_threads': args.threads,
+        'html_queue': HTML_QUEUE,
+        'rabbitmq_host': MEMORY_HOST,
+        'seen_capacity': args.pages,
+        'duplicate_action': 'tag',
+        # nothing consumes the html queue until the crawl is over
+        'queue_high_water': None
+    }
+
+
+def _page_latencies(site, messages):
+    page_latencies = []
+    for properties, body in messages:
+        latency = site.latency_of(_header(properties, 'url'),
+                                  properties.headers['fetched_at_ms'] / 1000.0)
+        if latency is not None:
+            page_latencies.append(latency)
+    return page_latencies
+
+
+def _crawl(args, site, backend, consume=True):
+    '''crawls the whole site into the in-memory html queue, returns the
+    metrics and the published messages, which are left in the queue
+    unless `consume`'''
+    from crawler import Crawler
+    from async_crawler import AsyncCrawler
+
+    config = _crawl_config(args, site)
+    if backend == 'async':
+        crawler = AsyncCrawler(**config, concurrency=args.concurrency,
+                               limit_per_host=args.concurrency)
+    else:
+        crawler = Crawler(**config)
+
+    started = time.monotonic()
+    try:
+        crawler.crawl()
+    finally:
+        crawler.close()
+    seconds = time.monotonic() - started
+
+    messages = list(get_publisher(MEMORY_HOST).queues[HTML_QUEUE])
+    if consume:
+        get_publisher(MEMORY_HOST).queues.pop(HTML_QUEUE)
+    result = {
+        'pages': crawler._crawled_count,
+        'published': len(messages),
+        'html_bytes': sum(len(body) for properties, body in messages),
+        'seconds': seconds,
+        'pages_per_s': crawler._crawled_count / seconds
+    }
+    result.update(latencies(_page_latencies(site, messages), 'page_latency'))
+    return result, messages
+
+
+def bench_crawl(args, backend):
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency,
+                         seed=args.seed, hosts=args.hosts).start()
+    try:
+        result, messages = _crawl(args, site, backend)
+    finally:
+        site.stop()
+    result.update(peak_rss())
+    return result
+
+
+def bench_cluster(args):
+    '''--nodes crawlers of the chosen backend sharing a site spread over
+    --hosts addresses, each node crawling in its own thread and talking to
+    the others over an in-memory network. counts pages crawled by more
+    than one node as well as the unique ones'''
+    from cluster import AsyncClusterCrawler, ClusterCrawler, MemoryNetwork
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency,
+                         seed=args.seed, hosts=args.hosts).start()
+    network = MemoryNetwork()
+    heartbeat_interval = 0.2
+    crawlers = []
+    for i in range(args.nodes):
+        config = dict(_crawl_config(args, site), node_id='node-{}'.format(i),
+                      transport=network.transport(), heartbeat_interval=heartbeat_interval,
+                      member_timeout=10 * heartbeat_interval)
+        if args.backend == 'async':
+            crawlers.append(AsyncClusterCrawler(**config, concurrency=args.concurrency,
+                                                limit_per_host=args.concurrency))
+        else:
+            crawlers.append(ClusterCrawler(**config))
+
+    threads = [threading.Thread(target=crawler.crawl) for crawler in crawlers]
+    started = time.monotonic()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        site.stop()
+        for crawler in crawlers:
+            crawler.close()
+    seconds = time.monotonic() - started
+
+    messages = list(get_publisher(MEMORY_HOST).queues.pop(HTML_QUEUE, ()))
+    pages = sum(crawler._crawled_count for crawler in crawlers)
+    result = {
+        'nodes': args.nodes,
+        'pages': pages,
+        'unique_pages': len(set(_header(properties, 'url') for properties, body in messages)),
+        'pages_per_node': [crawler._crawled_count for crawler in crawlers],
+        'seconds': seconds,
+        'pages_per_s': pages / seconds
+    }
+    result.update(latencies(_page_latencies(site, messages), 'page_latency'))
+    result.update(peak_rss())
+    return result
+
+
+def bench_clean(args):
+    '''clean_html one doc at a time in this process'''
+    from cleaner import clean_html
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, seed=args.seed)
+    doc_latencies = []
+    started = time.monotonic()
+    for i in range(args.pages):
+        t = time.monotonic()
+        clean_html(site.html(i))
+        doc_latencies.append(time.monotonic() - t)
+    seconds = time.monotonic() - started
+
+    result = {
+        'docs': args.pages,
+        'bytes': sum(len(site.html(i)) for i in range(args.pages)),
+        'seconds': seconds,
+        'docs_per_s': args.pages / seconds
+    }
+    result.update(latencies(doc_latencies, 'doc_latency'))
+    result.update(peak_rss())
+    return result
+
+
+def bench_pipeline(args):
+    '''crawl, then the cleaner, feature and corpus services one after the
+    other, each draining its queue, all over the in-memory queues. stage
+    times include up to PIPELINE_IDLE seconds for a service to notice its
+    queue is empty'''
+    from cleaner import CLEAN_BATCH_SECONDS, fetch_and_clean_html
+    from corpus import CorpusStore, store_docs
+    from envelope import decode
+    from features import extract_features
+
+    publisher = get_publisher(MEMORY_HOST)
+    publisher.bind(DOC_EXCHANGE, DOC_QUEUE)
+    publisher.bind(DOC_EXCHANGE, CORPUS_QUEUE)
+    corpus_path = tempfile.mkdtemp(prefix='nlpcrawl-bench-')
+    consuming = {'batch_size': args.batch_size, 'batch_wait': PIPELINE_IDLE / 2,
+                 'idle_timeout': PIPELINE_IDLE}
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency,
+                         seed=args.seed).start()
+    try:
+        started = time.monotonic()
+        crawl, messages = _crawl(args, site, args.backend, consume=False)
+    finally:
+        # done with the site before the cleaner starts its workers
+        site.stop()
+    try:
+        stages = {'crawl': crawl['seconds']}
+
+        t = time.monotonic()
+        batches = CLEAN_BATCH_SECONDS.count(), CLEAN_BATCH_SECONDS.sum()
+        # the workers are gone by the end, watch them while they run
+        with ChildRss() as workers:
+            fetch_and_clean_html(MEMORY_HOST, HTML_QUEUE, DOC_QUEUE, num_workers=args.workers,
+                                 doc_exchange=DOC_EXCHANGE, pack_docs=args.pack_docs,
+                                 **consuming)
+        stages['clean'] = time.monotonic() - t
+        clean_batches = CLEAN_BATCH_SECONDS.count() - batches[0]
+        clean_batch_seconds = CLEAN_BATCH_SECONDS.sum() - batches[1]
+
+        doc_messages = list(publisher.queues[DOC_QUEUE])
+        docs = sum(len(decode(p, b)) for p, b in doc_messages)
+
+        t = time.monotonic()
+        extract_features(MEMORY_HOST, DOC_QUEUE, FEATURE_QUEUE, args.n_features, **consuming)
+        stages['features'] = time.monotonic() - t
+
+        t = time.monotonic()
+        store_docs(MEMORY_HOST, CORPUS_QUEUE, corpus_path,
+                   docs_per_message=args.batch_size if args.pack_docs else 1, **consuming)
+        stages['corpus'] = time.monotonic() - t
+
+        seconds = time.monotonic() - started
+        store = CorpusStore(corpus_path)
+        stored = len(store)
+        store.close()
+    finally:
+        shutil.rmtree(corpus_path, ignore_errors=True)
+
+    result = {
+        'pages': crawl['pages'],
+        'docs': docs,
+        'features': len(publisher.queues.pop(FEATURE_QUEUE, ())),
+        'stored': stored,
+        'left_over': sum(len(publisher.queues.pop(q, ())) for q in (HTML_QUEUE, DOC_QUEUE, CORPUS_QUEUE)),
+        'html_bytes': crawl['html_bytes'],
+        'doc_bytes': sum(len(b) for p, b in doc_messages),
+        'seconds': seconds,
+        'stage_seconds': stages,
+        'pages_per_s': crawl['pages'] / seconds,
+        'docs_per_s': docs / seconds,
+        'page_latency_p50_s': crawl['page_latency_p50_s'],
+        'page_latency_p99_s': crawl['page_latency_p99_s'],
+        'clean_batch_mean_s': clean_batch_seconds / clean_batches if clean_batches else None
+    }
+    result.update(peak_rss(workers))
+    return result
+
+
+def run(name, args):
+    if name == 'crawl-thread':
+        return bench_crawl(args, 'thread')
+    if name == 'crawl-async':
+        return bench_crawl(args, 'async')
+    if name == 'crawl-cluster':
+        return bench_cluster(args)
+    if name == 'clean':
+        return bench_clean(args)
+    if name == 'pipeline':
+        return bench_pipeline(args)
+    raise ValueError('unknown benchmark {}'.format(name))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    '''lists the metrics that got worse than `baseline` by more than
+    `tolerance` (a fraction)'''
+    regressions = []
+    for name, metrics in results.items():
+        for key, value in metrics.items():
+            old = baseline.get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            if key in RATES:
+                worse = value < old * (1 - tolerance)
+            elif key.endswith('_s') or key.startswith('peak_rss'):
+                worse = value > old * (1 + tolerance)
+            else:
+                continue
+            if worse:
+                regressions.append('{} {}: {:.4g} -> {:.4g}'.format(name, key, old, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='any of {}, default all'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=8192, help='bytes of text per page')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hosts', type=int, default=1, help='loopback addresses to spread the site over')
+    parser.add_argument('--nodes', type=int, default=3, help='crawlers in crawl-cluster')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--backend', choices=['thread', 'async'], default='async',
+                        help='crawl backend of the pipeline and cluster benchmarks')
+    parser.add_argument('--workers', type=int, default=None, help='cleaner processes')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--pack-docs', action='store_true',
+                        help='pack each cleaned batch into one message')
+    parser.add_argument('--n-features', type=int, default=2 ** 20)
+    parser.add_argument('--output', help='write the json here instead of stdout')
+    parser.add_argument('--baseline', help='json from an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--verbose', action='store_true', help='keep the per page logging')
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    names = args.benchmarks or BENCHMARKS
+
+    results = {}
+    if args.in_process:
+        for name in names:
+            results[name] = run(name, args)
+    else:
+        # a fresh interpreter per benchmark keeps peak rss (and any state
+        # left in the shared publisher) from leaking between them
+        options = []
+        for key, value in vars(args).items():
+            if key in ('benchmarks', 'output', 'baseline', 'in_process') or value is None:
+                continue
+            flag = '--' + key.replace('_', '-')
+            if value is True:
+                options.append(flag)
+            elif value is not False:
+                options.extend([flag, str(value)])
+        for name in names:
+            out = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), name, '--in-process'] + options)
+            results[name] = json.loads(out)['results'][name]
+
+    report = {
+        'revision': _git_revision(),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'params': {k: v for k, v in vars(args).items()
+                   if k not in ('benchmarks', 'output', 'baseline', 'in_process', 'verbose')},
+        'results': results
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output and not args.in_process:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline and not args.in_process:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print('regression: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+RUNNING = 'running'
+COMPLETE = 'complete'
+
+
+def config_fingerprint(config):
+    '''stable hash of the crawl settings that decide what gets crawled'''
+    encoded = json.dumps(config, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class CrawlState(object):
+    '''on-disk crawl state kept under `path`. the seen set and the page
+    fingerprints live in their own databases (see seenset.SeenSet and
+    dedupe.Deduper) while this one holds periodic snapshots
+    of the frontier and the crawl counters. a crawl with the same
+    fingerprint that didn't finish is resumed from the last snapshot,
+    anything else starts from scratch'''
+    def __init__(self, path, fingerprint):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fingerprint = fingerprint
+        self.seen_path = os.path.join(path, 'seen.db')
+        # content fingerprints of the stored pages, see dedupe.Deduper
+        self.dedupe_path = os.path.join(path, 'dedupe.db')
+        # survives finished crawls, recrawls revalidate against it
+        self.validators_path = os.path.join(path, 'validators.db')
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'crawl.db'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS frontier ('
+                         'url TEXT, priority REAL, depth INTEGER)')
+        self._db.commit()
+
+    def _get(self, key, default=None):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def load(self):
+        '''returns (frontier items, crawled count) of an unfinished crawl with
+        the same fingerprint, otherwise resets the state and returns None'''
+        with self._lock:
+            if (self._get('fingerprint') == self.fingerprint
+                    and self._get('status') == RUNNING):
+                items = self._db.execute(
+                    'SELECT url, priority, depth FROM frontier').fetchall()
+                return items, self._get('crawled', 0)
+            self._reset()
+            return None
+
+    def _reset(self):
+        self._db.execute('DELETE FROM frontier')
+        self._set('fingerprint', self.fingerprint)
+        self._set('status', RUNNING)
+        self._set('crawled', 0)
+        self._db.commit()
+        for path in (self.seen_path, self.dedupe_path):
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+
+    def save(self, items, crawled):
+        '''replaces the frontier snapshot with `items` (url, priority, depth)'''
+        with self._lock:
+            self._db.execute('DELETE FROM frontier')
+            self._db.executemany(
+                'INSERT INTO frontier (url, priority, depth) VALUES (?, ?, ?)', items)
+            self._set('crawled', crawled)
+            self._db.commit()
+
+    def finish(self, crawled):
+        '''marks the crawl as complete, the next run starts afresh'''
+        with self._lock:
+            self._db.execute('DELETE FROM frontier')
+            self._set('crawled', crawled)
+            self._set('status', COMPLETE)
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -1,88 +1,198 @@
-from bs4 import BeautifulSoup
+import functools
+import multiprocessing
+import os
+import signal
+import time
 import unicodedata
 import re
 import nltk
-import pika
 import colorlog
 
-from stopwords import stop_words
+import metrics
+from consumer import batch_consumer
+from envelope import Message, encode, encode_batch, media_type
+from extract import extract_text
+from publisher import get_publisher
 
 logger = colorlog.getLogger('NLPCrawl')
 
+DOC_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+CLEAN_SECONDS = metrics.histogram(
+    'nlpcrawl_clean_seconds', 'clean time per doc by step', ('step',))
+CLEAN_BATCH_SECONDS = metrics.histogram(
+    'nlpcrawl_clean_batch_seconds', 'wall time to clean a batch on the pool')
+
 # inspired by:
 # https://www.kdnuggets.com/2018/08/practitioners-guide-processing-understanding-text-2.html
 
 
-def fetch_and_clean_html(rabbitmq_host, html_queue, doc_queue, keep_numbers=True):
+def _init_worker():
+    # ctrl-c is handled by the service, which shuts the pool down cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _clean_message(args):
+    '''cleans one consumed message, runs in the worker processes. returns
+    the doc and the seconds spent parsing, normalising and stemming, the
+    metrics live in the parent process'''
+    content_type, body, keep_numbers = args
+    started = time.perf_counter()
+    if media_type(content_type) == 'text/plain':
+        # the crawler already extracted the text, no need to parse again
+        text = body.decode('utf-8', 'replace')
+    else:
+        text = html_to_text(body)
+    parsed = time.perf_counter()
+    text = normalize_text(text, keep_numbers)
+    normalized = time.perf_counter()
+    text = stem_text(text)
+    return text, (parsed - started, normalized - parsed, time.perf_counter() - normalized)
+
+
+def _observe_steps(timings):
+    for parse, normalize, stem in timings:
+        CLEAN_SECONDS.observe(parse, step='parse')
+        CLEAN_SECONDS.observe(normalize, step='normalize')
+        CLEAN_SECONDS.observe(stem, step='stem')
+
+
+def fetch_and_clean_html(rabbitmq_host, html_queue, doc_queue, keep_numbers=True,
+                         num_workers=None, batch_size=64, batch_wait=0.5,
+                         prefetch=None, idle_timeout=None, doc_exchange='',
+                         codec='zlib', pack_docs=False):
+    '''cleaner service. html is consumed in batches of up to `batch_size`
+    (or whatever arrived within `batch_wait` seconds), cleaned on a pool of
+    `num_workers` processes and the batch acked once its docs are
+    confirmed. runs until SIGINT/SIGTERM, or until the queue has been idle
+    for `idle_timeout` seconds if that is set. docs keep the headers (url,
+    fetch metadata) of the html they came from and are published to
+    `doc_exchange` if set, otherwise straight to `doc_queue`, compressed
+    with `codec`. `pack_docs` sends each batch's docs as one message'''
     logger.info("│ │ ├ Fetching HTML from RabbitMQ...")
 
-    while True:
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
-            channel_consume = connection.channel()
-            channel_publish = connection.channel()
-            logger.debug("│ │ │ ├ connected to rabbitmq at {}".format(rabbitmq_host))
-            break
-        except pika.exceptions.AMQPConnectionError as e:
-            logger.warning("│ │ │ ├ {}".format(e))
-            time.sleep(3)
-            pass
-    
-    for method, properties, body in channel_consume.consume(html_queue, ):
-        # logger.debug('│ │ │ ├ cleaning "{}"...'.format(body[0:25]))
-        text = clean_html(body, keep_numbers)
-        logger.debug('│ │ │ ├ cleaned "{}"...'.format(text[0:25]))
-        channel_publish.basic_publish(
-            exchange='',
-            routing_key=doc_queue,
-            body=text
-        )
-        logger.debug("│ │ │ └ Cleaned doc published to rabbitmq!")
-        channel_consume.basic_ack(method.delivery_tag)
-
-        # check if queue is empty, if so exit
-        if channel_consume.get_waiting_message_count() == 0:
-            channel_consume.cancel()
+    # by now main has the metrics server and the crawler's publisher
+    # thread and connection running, which a plain fork would copy half
+    # way. the forkserver forks workers from a clean process instead
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    pool = context.Pool(num_workers, initializer=_init_worker)
+    logger.info("│ │ ├ Cleaning with {} worker processes...".format(
+        num_workers or os.cpu_count()))
+
+    consumer = batch_consumer(rabbitmq_host, html_queue, batch_size, batch_wait,
+                              prefetch, idle_timeout, name='cleaner')
+    publisher = get_publisher(rabbitmq_host)
+
+    for batch in consumer.batches():
+        # a consumed message may hold a packed batch of pages, ones that
+        # don't decode are rejected and dropped from the batch
+        batch, messages = consumer.decode(batch)
+        with CLEAN_BATCH_SECONDS.time():
+            results = pool.map(_clean_message, [(m.content_type, m.body, keep_numbers)
+                                                for m in messages])
+        _observe_steps([timings for text, timings in results])
+        docs = [Message(m.headers, DOC_CONTENT_TYPE, text)
+                for m, (text, timings) in zip(messages, results)]
+        if not docs:
+            consumer.ack(batch)
+            continue
+
+        if pack_docs:
+            encoded = [encode_batch(docs, codec)]
+        else:
+            encoded = [encode(text, headers, content_type, codec)
+                       for headers, content_type, text in docs]
+        on_confirm = consumer.ack_on_confirm(batch, len(encoded))
+        for body, properties in encoded:
+            publisher.publish(
+                doc_queue,
+                body,
+                exchange=doc_exchange,
+                properties=properties,
+                on_confirm=on_confirm
+            )
+        logger.debug("│ │ │ └ {} cleaned docs queued for rabbitmq!".format(len(docs)))
+
+    pool.close()
+    pool.join()
+
+    # let the outstanding confirms (and their acks) land before closing
+    publisher.flush()
+    consumer.close()
 
 
 def html_to_text(html):
     '''extracts the text from HTML formatted data'''
-    soup = BeautifulSoup(html, "html.parser")
-    return soup.get_text()
+    return extract_text(html)
+
+# compiled once, strip_numbers' class is a subset of strip_punctuation's
+# so applying it alone is the same as applying both
+_punctuation_re = re.compile(r'[^a-zA-z0-9\s]')
+_numbers_re = re.compile(r'[^a-zA-z\s]')
+
+_stemmer = nltk.stem.SnowballStemmer("english")
+_tokenizer = nltk.tokenize.toktok.ToktokTokenizer()
+
+# word frequencies are zipfian, a modest cache absorbs most stem calls
+STEM_CACHE_SIZE = 100000
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem_word(word):
+    '''lower cases and stems a single word, memoised'''
+    return _stemmer.stem(word.lower())
 
 def text_to_ascii(text):
     '''normalises text to be ascii only chars as utf8'''
+    if text.isascii():
+        # nfkd and the ascii round trip leave ascii text unchanged
+        return text
     text = unicodedata.normalize('NFKD', text)
     text = text.encode('ascii', 'ignore')
     return text.decode('utf-8', 'ignore')
 
 def strip_punctuation(text):
     '''removes punctuation from the text'''
-    return re.sub(r'[^a-zA-z0-9\s]', '', text)
+    return _punctuation_re.sub('', text)
 
 def strip_numbers(text):
     '''removes numbers rom the text'''
-    return re.sub(r'[^a-zA-z\s]', '', text)
+    return _numbers_re.sub('', text)
 
 def text_to_lowercase(text):
     '''converts text to be all lower case'''
     return text.lower()
 
-def stem_text(text, stemmer=nltk.stem.SnowballStemmer("english")):
+def stem_text(text, stemmer=None):
     '''stems words to create more robust training data'''
+    if stemmer is None:
+        return ' '.join([stem_word(word) for word in text.split()])
     return ' '.join([stemmer.stem(word) for word in text.split()])
 
 def tokenize_text(text):
     '''tokenises the text (creates a list of words)'''
-    tokens = nltk.tokenize.toktok.ToktokTokenizer().tokenize(text)
+    tokens = _tokenizer.tokenize(text)
     return [token.strip() for token in tokens]
 
 def clean_html(html, keep_numbers=True):
-    text = html_to_text(html)
+    return clean_text(html_to_text(html), keep_numbers)
+
+def normalize_text(text, keep_numbers=True):
+    '''ascii folds and strips punctuation (and optionally numbers) in one
+    regex pass. lower casing is left to stem_word'''
     text = text_to_ascii(text)
-    text = strip_punctuation(text)
-    if not keep_numbers:
-        text = strip_numbers(text)
-    text = text_to_lowercase(text)
-    text = stem_text(text)
-    return text
\ No newline at end of file
+    return (_punctuation_re if keep_numbers else _numbers_re).sub('', text)
+
+def clean_text(text, keep_numbers=True):
+    '''ascii folds, strips punctuation (and optionally numbers), lower
+    cases and stems the text. one regex pass, with lower casing folded into
+    the cached per word stem'''
+    return stem_text(normalize_text(text, keep_numbers))
+
+def clean_texts(texts, keep_numbers=True):
+    '''batch form of clean_text'''
+    return [clean_text(text, keep_numbers) for text in texts]
+
+def clean_html_batch(htmls, keep_numbers=True):
+    '''batch form of clean_html'''
+    return [clean_html(html, keep_numbers) for html in htmls]
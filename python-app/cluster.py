@@ -0,0 +1,535 @@
+import bisect
+import collections
+import hashlib
+import json
+import queue
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+import colorlog
+
+import metrics
+from async_crawler import AsyncCrawler
+from consumer import REJECTED, connect
+from crawler import Crawler
+from envelope import decode, encode
+from publisher import get_publisher
+from seenset import url_key
+
+logger = colorlog.getLogger('NLPCrawl')
+
+# prefix of the cluster's exchanges and queues
+CLUSTER = 'nlpcrawl'
+
+# a url bounced between nodes this often is kept, while rings disagree
+MAX_HOPS = 3
+
+# url keys per message when a host's seen urls go to its new owner
+SEEN_BATCH = 10000
+
+ROUTED_URLS = metrics.counter(
+    'nlpcrawl_cluster_urls_total', 'urls routed between cluster nodes', ('direction',))
+CLUSTER_MEMBERS = metrics.gauge('nlpcrawl_cluster_members', 'live cluster nodes, this one included')
+
+
+def _hash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def host_key(url):
+    '''the part of a url that picks its owner, the frontier's host'''
+    return urlsplit(url).netloc.lower()
+
+
+class HashRing(object):
+    '''consistent hash ring with `replicas` virtual points per node, so a
+    node joining or leaving only moves about 1 / n of the keys'''
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def copy(self):
+        ring = HashRing(replicas=self.replicas)
+        ring._points = list(self._points)
+        ring._owners = dict(self._owners)
+        ring._nodes = set(self._nodes)
+        return ring
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            point = _hash('{}#{}'.format(node, i))
+            bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        for i in range(self.replicas):
+            point = _hash('{}#{}'.format(node, i))
+            del self._points[bisect.bisect_left(self._points, point)]
+            del self._owners[point]
+
+    def owner(self, key):
+        '''the node owning `key`, None for an empty ring'''
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+
+class AmqpTransport(object):
+    '''cluster traffic over rabbitmq. urls go through a direct exchange to
+    a durable queue per node (routing key = node id), so they wait for a
+    node that restarts, which routes them on to their owners. heartbeats
+    go through a fanout exchange to an exclusive queue per node. messages
+    that can't be handled are logged and rejected, never requeued'''
+    def __init__(self, rabbitmq_host, cluster=CLUSTER):
+        self.rabbitmq_host = rabbitmq_host
+        self.url_exchange = cluster + '.urls'
+        self.member_exchange = cluster + '.members'
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, node_id, on_urls, on_member):
+        self._on_urls = on_urls
+        self._on_member = on_member
+        self._connection = connect(self.rabbitmq_host)
+        channel = self._channel = self._connection.channel()
+        channel.exchange_declare(self.url_exchange, 'direct', durable=True)
+        channel.exchange_declare(self.member_exchange, 'fanout')
+
+        self._url_queue = '{}.{}'.format(self.url_exchange, node_id)
+        channel.queue_declare(self._url_queue, durable=True)
+        channel.queue_bind(self._url_queue, self.url_exchange, routing_key=node_id)
+        member_queue = channel.queue_declare('', exclusive=True).method.queue
+        channel.queue_bind(member_queue, self.member_exchange)
+
+        channel.basic_qos(prefetch_count=100)
+        self._consumer_tags = [
+            channel.basic_consume(self._url_queue, self._deliver_urls),
+            channel.basic_consume(member_queue, self._deliver_member, auto_ack=True)
+        ]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # the connection belongs to this thread until stop() joins it
+        try:
+            while not self._stopping.is_set():
+                self._connection.process_data_events(time_limit=0.2)
+        except Exception as e:
+            # the deliveries handle their own errors, this is the connection
+            logger.error('│ ├ cluster transport stopped: {!r}'.format(e))
+
+    @staticmethod
+    def _load(properties, body):
+        return json.loads(decode(properties, body)[0].body.decode('utf-8'))
+
+    def _deliver_urls(self, channel, method, properties, body):
+        try:
+            self._on_urls(self._load(properties, body))
+        except Exception as e:
+            self._reject(channel, method, e)
+            return
+        channel.basic_ack(method.delivery_tag)
+
+    def _deliver_member(self, channel, method, properties, body):
+        try:
+            self._on_member(self._load(properties, body))
+        except Exception as e:
+            # auto acked, a bad heartbeat is just skipped
+            logger.warning('│ ├ dropping member message: {!r}'.format(e))
+
+    def _reject(self, channel, method, error):
+        logger.warning('│ ├ rejecting url batch {}: {!r}'.format(method.delivery_tag, error))
+        REJECTED.inc(queue=self._url_queue)
+        channel.basic_reject(method.delivery_tag, requeue=False)
+
+    def _publish(self, exchange, routing_key, message):
+        body, properties = encode(json.dumps(message), content_type='application/json')
+        get_publisher(self.rabbitmq_host).publish(
+            routing_key, body, exchange=exchange, properties=properties)
+
+    def send_urls(self, node_id, message):
+        '''sends a url batch to a node, returns False if it can't'''
+        self._publish(self.url_exchange, node_id, message)
+        return True
+
+    def broadcast(self, message):
+        self._publish(self.member_exchange, '', message)
+
+    def stop(self):
+        '''stops consuming, returns the url batches waiting in this node's
+        queue. the queue is kept, batches peers route to it after this wait
+        there for the node's next start, which hands them on'''
+        self._stopping.set()
+        self._thread.join()
+        # unacked deliveries go back to the queue, and out again below
+        for tag in self._consumer_tags:
+            self._channel.basic_cancel(tag)
+        leftovers = []
+        while True:
+            method, properties, body = self._channel.basic_get(self._url_queue)
+            if method is None:
+                break
+            try:
+                leftovers.append(self._load(properties, body))
+            except Exception as e:
+                self._reject(self._channel, method, e)
+                continue
+            self._channel.basic_ack(method.delivery_tag)
+        self._connection.close()
+        return leftovers
+
+    def flush(self):
+        get_publisher(self.rabbitmq_host).flush()
+
+
+class MemoryNetwork(object):
+    '''in-process stand-in for the broker, lets several nodes in one
+    process (e.g. in benchmarks) talk through their MemoryTransports'''
+    def __init__(self):
+        self.inboxes = {}
+        self.lock = threading.Lock()
+
+    def transport(self):
+        return MemoryTransport(self)
+
+
+class MemoryTransport(object):
+    '''transport for nodes sharing a MemoryNetwork'''
+    def __init__(self, network):
+        self.network = network
+        self._inbox = queue.Queue()
+        self._thread = None
+
+    def start(self, node_id, on_urls, on_member):
+        self._node_id = node_id
+        self._handlers = {'urls': on_urls, 'member': on_member}
+        with self.network.lock:
+            self.network.inboxes[node_id] = self._inbox
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            kind, message = item
+            self._handlers[kind](message)
+
+    def send_urls(self, node_id, message):
+        # under the lock, so nothing lands in an inbox stop() has drained
+        with self.network.lock:
+            inbox = self.network.inboxes.get(node_id)
+            if inbox is None:
+                return False
+            inbox.put(('urls', message))
+        return True
+
+    def broadcast(self, message):
+        with self.network.lock:
+            inboxes = list(self.network.inboxes.values())
+        for inbox in inboxes:
+            inbox.put(('member', message))
+
+    def stop(self):
+        with self.network.lock:
+            self.network.inboxes.pop(self._node_id, None)
+        self._inbox.put(None)
+        self._thread.join()
+        leftovers = []
+        while True:
+            try:
+                kind, message = self._inbox.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'urls':
+                leftovers.append(message)
+        return leftovers
+
+    def flush(self):
+        pass
+
+
+class ClusterMixin(object):
+    '''turns a crawler into one node of a cluster. every host belongs to
+    one node, picked by a consistent hash ring over the live nodes, and
+    discovered urls are routed to their host's node in batches. each node
+    keeps its own seen set, frontier and politeness for the hosts it owns.
+
+    nodes announce themselves with heartbeats. a node joining takes over
+    its share of the others' queued urls, one leaving hands its queued urls
+    to the new owners. either way the old owner of a host also hands over
+    the keys of the host's urls it has seen, read from the seen set on
+    disk where every url is tagged with its host, so the new one doesn't
+    crawl them again. a node going quiet for `member_timeout`
+    seconds is dropped, its hosts' urls may be crawled again. a node only
+    stops once the whole cluster has had nothing to do for `idle_grace`
+    seconds'''
+    def __init__(self, *args, node_id=None, transport=None, heartbeat_interval=1.0,
+                 member_timeout=5.0, route_batch=100, idle_grace=None, **kwargs):
+        self.node_id = node_id or socket.gethostname()
+        self.heartbeat_interval = heartbeat_interval
+        self.member_timeout = member_timeout
+        self.route_batch = route_batch
+        self.idle_grace = idle_grace if idle_grace is not None else 3 * heartbeat_interval
+
+        # replaced, never changed in place, so readers need no lock
+        self._ring = HashRing([self.node_id])
+        # node -> (last heard from, busy)
+        self._members = {}
+        self._members_lock = threading.RLock()
+        # node -> [(url, depth, hops)] waiting to be sent
+        self._outbox = collections.defaultdict(list)
+        self._outbox_lock = threading.Lock()
+        self._idle_since = None
+        self._leaving = threading.Event()
+        self._transport = transport
+
+        # the start url is enqueued in here, while the ring is just us
+        super().__init__(*args, **kwargs)
+        if self._transport is None:
+            self._transport = AmqpTransport(self.rabbitmq_host)
+
+    def crawl(self, max_pages=None):
+        logger.info('│ ├ Joining the cluster as {}...'.format(self.node_id))
+        self._transport.start(self.node_id, self._on_urls, self._on_member)
+        loop = threading.Thread(target=self._cluster_loop, daemon=True)
+        loop.start()
+
+        # hear from the rest of the cluster before deciding what is ours
+        self._heartbeat()
+        time.sleep(2 * self.heartbeat_interval)
+        self._rebalance()
+        try:
+            super().crawl(max_pages)
+        finally:
+            self._leave(loop)
+
+    def _enqueue(self, url, depth=0, hops=0):
+        host = host_key(url)
+        owner = self._ring.owner(host)
+        if owner == self.node_id or hops >= MAX_HOPS:
+            return super()._enqueue(url, depth)
+        if url in self._urls_seen:
+            # queued here while its host was ours, so it has been crawled
+            # or went to the new owner with the rest of the host's urls
+            return False
+        self._send(owner, [(url, depth, hops)])
+        return False
+
+    def _seen_host(self, url):
+        return host_key(url)
+
+    def _adopt_seen(self, message):
+        '''adds the url keys another node has seen of a host we now own'''
+        keys = message.get('seen')
+        if not keys:
+            return
+        host = message['host']
+        with self._snapshot_lock:
+            # ones we had already, e.g. from owning the host before, are
+            # tagged again so they go with the host if it moves on
+            known = [key for key in keys if not self._urls_seen.add_key(key, host)]
+            if known:
+                self._urls_seen.tag(known, host)
+
+    def _hand_over_seen(self, ring, queued):
+        '''sends the seen url keys of hosts this node no longer owns to
+        their new owners, ahead of any of their urls. the keys of `queued`
+        urls stay out, those urls are on their way to be queued there.
+        a host's keys keep their tag until they have all been sent'''
+        for host in self._urls_seen.hosts():
+            owner = ring.owner(host)
+            if owner == self.node_id:
+                continue
+            keys = [key for key in self._urls_seen.host_keys(host) if key not in queued]
+            for i in range(0, len(keys), SEEN_BATCH):
+                message = {'from': self.node_id, 'urls': [], 'host': host,
+                           'seen': keys[i:i + SEEN_BATCH]}
+                if not (owner in self._ring and self._transport.send_urls(owner, message)):
+                    # gone already, the next rebalance finds it a new owner
+                    break
+            else:
+                self._urls_seen.untag(host)
+
+    def _reroute(self, items):
+        '''routes urls this node already took on again with the current
+        ring, whether or not the seen set knows them'''
+        for url, depth, hops in items:
+            owner = self._ring.owner(host_key(url))
+            if owner == self.node_id:
+                with self._snapshot_lock:
+                    host = host_key(url)
+                    if not self._urls_seen.add(url, host):
+                        # untagged when its host was handed over
+                        self._urls_seen.tag([url_key(url)], host)
+                    self._urls_to_crawl.put(url, self._priority(url, depth), depth)
+            else:
+                self._send(owner, [(url, depth, hops)])
+
+    def _send(self, node, items):
+        with self._outbox_lock:
+            batch = self._outbox[node]
+            batch.extend(items)
+            full = len(batch) >= self.route_batch
+        if full:
+            self._flush_outbox()
+
+    def _flush_outbox(self):
+        with self._outbox_lock:
+            outbox, self._outbox = self._outbox, collections.defaultdict(list)
+        for node, items in outbox.items():
+            message = {'from': self.node_id,
+                       'urls': [[url, depth, hops + 1] for url, depth, hops in items]}
+            if node in self._ring and self._transport.send_urls(node, message):
+                ROUTED_URLS.inc(len(items), direction='sent')
+                continue
+            # the node has gone, route again with the current ring
+            self._reroute(items)
+
+    def _on_urls(self, message):
+        self._adopt_seen(message)
+        ROUTED_URLS.inc(len(message['urls']), direction='received')
+        for url, depth, hops in message['urls']:
+            self._enqueue(url, depth, hops)
+        self._wake()
+
+    def _on_member(self, message):
+        node = message['node']
+        if node == self.node_id:
+            return
+        with self._members_lock:
+            if message['state'] == 'leaving':
+                self._members.pop(node, None)
+                if node in self._ring:
+                    logger.info('│ ├ {} left the cluster'.format(node))
+                    self._set_ring(lambda ring: ring.remove(node))
+                return
+            joined = node not in self._members
+            self._members[node] = (time.monotonic(), message['busy'])
+            if joined:
+                logger.info('│ ├ {} joined the cluster'.format(node))
+                self._set_ring(lambda ring: ring.add(node))
+                self._rebalance()
+
+    def _set_ring(self, change):
+        ring = self._ring.copy()
+        change(ring)
+        self._ring = ring
+        CLUSTER_MEMBERS.set(len(ring))
+
+    def _rebalance(self):
+        '''sends queued urls of hosts this node no longer owns to their
+        new owners'''
+        ring = self._ring
+        moved = self._urls_to_crawl.remove_hosts(lambda host: ring.owner(host) != self.node_id)
+        self._hand_over_seen(ring, {url_key(url) for url, priority, depth in moved})
+        # the ring may have changed under us, making some ours again
+        self._reroute([(url, depth, 0) for url, priority, depth in moved])
+        if moved:
+            logger.info('│ ├ handed {} queued urls to other nodes'.format(len(moved)))
+        self._flush_outbox()
+
+    def _busy(self):
+        with self._outbox_lock:
+            unsent = any(self._outbox.values())
+        return unsent or len(self._urls_to_crawl) > 0 or bool(self._in_flight)
+
+    def _heartbeat(self):
+        self._transport.broadcast({'node': self.node_id, 'state': 'alive',
+                                   'busy': self._busy()})
+
+    def _cluster_loop(self):
+        '''flushes routed urls, sends heartbeats and drops nodes that went
+        quiet, until the node leaves'''
+        tick = min(0.1, self.heartbeat_interval / 4)
+        last_heartbeat = time.monotonic()
+        while not self._leaving.wait(tick):
+            self._flush_outbox()
+            now = time.monotonic()
+            if now - last_heartbeat >= self.heartbeat_interval:
+                last_heartbeat = now
+                self._heartbeat()
+            with self._members_lock:
+                for node, (seen, busy) in list(self._members.items()):
+                    if now - seen > self.member_timeout:
+                        logger.warning('│ ├ {} stopped responding, dropping it'.format(node))
+                        del self._members[node]
+                        self._set_ring(lambda ring: ring.remove(node))
+
+    def _expecting_work(self):
+        '''keeps the node crawling while any node still has work, and for
+        idle_grace seconds after, so urls in transit aren't missed'''
+        with self._members_lock:
+            busy = self._busy() or any(busy for seen, busy in self._members.values())
+        now = time.monotonic()
+        if busy:
+            self._idle_since = None
+            return True
+        if self._idle_since is None:
+            self._idle_since = now
+        return now - self._idle_since < self.idle_grace
+
+    def _finish_crawl(self):
+        # deferred to _leave, until the queued urls have been handed off
+        pass
+
+    def _leave(self, loop):
+        '''announces the node is leaving and hands whatever it still has
+        queued to the remaining nodes'''
+        self._transport.broadcast({'node': self.node_id, 'state': 'leaving', 'busy': False})
+        self._leaving.set()
+        loop.join()
+        # let urls sent before the others heard we're going arrive
+        time.sleep(self.heartbeat_interval)
+        leftovers = self._transport.stop()
+
+        with self._members_lock:
+            self._set_ring(lambda ring: ring.remove(self.node_id))
+        if len(self._ring):
+            for message in leftovers:
+                self._on_urls(message)
+            self._rebalance()
+        else:
+            # last one out, keep everything for the next run
+            self._ring = HashRing([self.node_id])
+            for message in leftovers:
+                self._adopt_seen(message)
+                for url, depth, hops in message['urls']:
+                    self._urls_to_crawl.put(url, self._priority(url, depth), depth)
+        self._transport.flush()
+        # checkpoints whatever we kept, or marks our share done if the
+        # others have it all now
+        super()._finish_crawl()
+        logger.info('│ └ {} left the cluster'.format(self.node_id))
+
+
+class ClusterCrawler(ClusterMixin, Crawler):
+    '''thread backend crawler running as a cluster node'''
+
+
+class AsyncClusterCrawler(ClusterMixin, AsyncCrawler):
+    '''async backend crawler running as a cluster node'''
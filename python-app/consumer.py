@@ -0,0 +1,251 @@
+import collections
+import functools
+import signal
+import threading
+import time
+import colorlog
+import pika
+
+import metrics
+from envelope import decode
+from publisher import MEMORY_HOST, get_publisher
+
+logger = colorlog.getLogger('NLPCrawl')
+
+REJECTED = metrics.counter(
+    'nlpcrawl_rejected_messages_total', 'consumed messages that could not be decoded, by queue',
+    ('queue',))
+
+
+def connect(rabbitmq_host):
+    '''blocking connection to rabbitmq, retried until the broker is up'''
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
+            logger.debug("│ │ │ ├ connected to rabbitmq at {}".format(rabbitmq_host))
+            return connection
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.warning("│ │ │ ├ {}".format(e))
+            time.sleep(3)
+
+
+class BatchAcker(object):
+    '''acks consumed messages in delivery order once every message
+    published from them has been confirmed. confirms arrive on the
+    publisher thread, `ack(last_tag)` acks every delivery up to last_tag
+    and must be safe to call from any thread'''
+    def __init__(self, ack):
+        self._ack = ack
+        # [last delivery tag, messages still unconfirmed] per batch, in order
+        self._batches = collections.deque()
+        self._lock = threading.Lock()
+
+    def add(self, last_tag, count):
+        '''registers a batch, returns the confirm callback for the `count`
+        messages published from it'''
+        batch = [last_tag, count]
+        with self._lock:
+            self._batches.append(batch)
+        if count == 0:
+            # nothing to wait for
+            self._settle()
+        return functools.partial(self._confirmed, batch)
+
+    def _confirmed(self, batch):
+        with self._lock:
+            batch[1] -= 1
+        self._settle()
+
+    def _settle(self):
+        with self._lock:
+            last_tag = None
+            while self._batches and self._batches[0][1] == 0:
+                last_tag = self._batches.popleft()[0]
+        if last_tag is not None:
+            self._ack(last_tag)
+
+    def pending(self):
+        with self._lock:
+            return len(self._batches)
+
+
+class BatchConsumer(object):
+    '''consumes a queue in micro batches of up to `batch_size` messages, or
+    whatever arrived within `batch_wait` seconds. stops on SIGINT/SIGTERM,
+    or once the queue has been idle for `idle_timeout` seconds if set'''
+    def __init__(self, rabbitmq_host, queue, batch_size=64, batch_wait=0.5,
+                 prefetch=None, idle_timeout=None, name='consumer'):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.idle_timeout = idle_timeout
+        self.name = name
+
+        # enough prefetch to fill the next batch while this one is worked on
+        self._acker = BatchAcker(self._open(rabbitmq_host, prefetch or batch_size * 2))
+
+        self.stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                signal.signal(signum, self._stop)
+            except ValueError:
+                # not the main thread, rely on idle_timeout instead
+                pass
+
+    def _open(self, rabbitmq_host, prefetch):
+        '''connects, returns the ack function for the BatchAcker'''
+        self.connection = connect(rabbitmq_host)
+        self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=prefetch)
+        # acks have to go out on the consumer connection's thread
+        return lambda last_tag: self.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_ack, last_tag, multiple=True))
+
+    def _reject(self, delivery_tag):
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_reject, delivery_tag, requeue=False))
+
+    def _consume(self):
+        '''yields (method, properties, body), or Nones every `batch_wait`
+        seconds nothing arrives'''
+        return self.channel.consume(self.queue, inactivity_timeout=self.batch_wait)
+
+    def _stop(self, signum, frame):
+        logger.info("│ │ ├ Stopping {}...".format(self.name))
+        self.stopping.set()
+
+    def batches(self, idle_batches=False):
+        '''yields lists of (method, properties, body). with `idle_batches`
+        an empty list is yielded every `batch_wait` seconds nothing
+        arrives, so the caller can act on time passing'''
+        batch = []
+        batch_started = idle_since = time.monotonic()
+        for method, properties, body in self._consume():
+            now = time.monotonic()
+            if method is not None:
+                if not batch:
+                    batch_started = now
+                batch.append((method, properties, body))
+                idle_since = now
+
+            if batch and (len(batch) >= self.batch_size
+                          or now - batch_started >= self.batch_wait
+                          or self.stopping.is_set()):
+                yield batch
+                batch = []
+            elif method is None and idle_batches:
+                yield []
+
+            if self.stopping.is_set():
+                break
+            if self.idle_timeout is not None and now - idle_since >= self.idle_timeout:
+                logger.info("│ │ ├ {} idle for {}s, stopping...".format(
+                    self.name, self.idle_timeout))
+                break
+
+    def decode(self, batch):
+        '''unwraps the messages of a batch (see envelope.decode), returns
+        (batch, messages) for the ones that could be. the others are
+        rejected without requeueing, so they go to the queue's dead letter
+        exchange if it has one instead of coming back forever. they are
+        rejected before the batch is acked, and the batch's ack tag is
+        always a message that is kept'''
+        kept = []
+        messages = []
+        for method, properties, body in batch:
+            try:
+                messages.extend(decode(properties, body))
+            except Exception as e:
+                # zlib, zstandard, struct and json all have their own errors
+                logger.warning("│ │ ├ {} rejecting message {}: {!r}".format(
+                    self.name, method.delivery_tag, e))
+                REJECTED.inc(queue=self.queue)
+                self._reject(method.delivery_tag)
+                continue
+            kept.append((method, properties, body))
+        return kept, messages
+
+    def ack_on_confirm(self, batch, count):
+        '''returns the publisher on_confirm callback that acks `batch` once
+        all `count` messages published from it are confirmed'''
+        return self._acker.add(batch[-1][0].delivery_tag, count)
+
+    def ack(self, batch):
+        '''acks a batch that published nothing'''
+        if batch:
+            self._acker.add(batch[-1][0].delivery_tag, 0)
+
+    def close(self, timeout=30):
+        '''cancels the consumer, lets outstanding acks land and closes. the
+        publisher should be flushed first'''
+        # unacked prefetched messages go back to the queue
+        self.channel.cancel()
+        deadline = time.monotonic() + timeout
+        while self._acker.pending() and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+        self.connection.process_data_events()
+        self.connection.close()
+
+
+class MemoryBatchConsumer(BatchConsumer):
+    '''BatchConsumer over a queue of the in-memory publisher (see
+    publisher.MemoryPublisher), for benchmarks and tests. acks work as
+    they do against rabbitmq, unacked messages go back to the front of the
+    queue on close and rejected ones end up in the publisher's
+    `dead_letters`'''
+    def _open(self, rabbitmq_host, prefetch):
+        self._publisher = get_publisher(rabbitmq_host)
+        self._prefetch = prefetch
+        self._delivery_tag = 0
+        # delivery tag -> (properties, body), in delivery order
+        self._unacked = collections.OrderedDict()
+        return self._ack_up_to
+
+    def _ack_up_to(self, last_tag):
+        with self._publisher.arrived:
+            while self._unacked and next(iter(self._unacked)) <= last_tag:
+                self._unacked.popitem(last=False)
+            # room in the prefetch window
+            self._publisher.arrived.notify_all()
+
+    def _reject(self, delivery_tag):
+        with self._publisher.arrived:
+            self._publisher.dead_letters[self.queue].append(self._unacked.pop(delivery_tag))
+            self._publisher.arrived.notify_all()
+
+    def _consume(self):
+        publisher = self._publisher
+        while True:
+            with publisher.arrived:
+                queue = publisher.queues[self.queue]
+                if not queue or len(self._unacked) >= self._prefetch:
+                    publisher.arrived.wait(self.batch_wait)
+                if not queue or len(self._unacked) >= self._prefetch:
+                    message = None
+                else:
+                    message = queue.popleft()
+                    self._delivery_tag += 1
+                    self._unacked[self._delivery_tag] = message
+            if message is None:
+                yield None, None, None
+            else:
+                properties, body = message
+                yield (pika.spec.Basic.Deliver(delivery_tag=self._delivery_tag,
+                                               routing_key=self.queue),
+                       properties, body)
+
+    def close(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while self._acker.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self._publisher.arrived:
+            self._publisher.queues[self.queue].extendleft(reversed(list(self._unacked.values())))
+            self._unacked.clear()
+
+
+def batch_consumer(rabbitmq_host, queue, *args, **kwargs):
+    '''a BatchConsumer for the queue, over the in-memory publisher's
+    queues if rabbitmq_host is publisher.MEMORY_HOST'''
+    if rabbitmq_host == MEMORY_HOST:
+        return MemoryBatchConsumer(rabbitmq_host, queue, *args, **kwargs)
+    return BatchConsumer(rabbitmq_host, queue, *args, **kwargs)
@@ -0,0 +1,381 @@
+import collections
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+import colorlog
+import numpy as np
+
+from consumer import batch_consumer
+
+logger = colorlog.getLogger('NLPCrawl')
+
+MANIFEST = 'manifest.json'
+
+
+def _write_array(path, values, dtype):
+    np.asarray(values, dtype=dtype).tofile(path)
+
+
+def _map_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class Segment(object):
+    '''an immutable, memory mapped slice of the corpus holding `count` docs
+    with ids base .. base + count - 1.
+
+    docs.bin    zlib compressed json records, docs.off their offsets
+    terms.txt   sorted terms, terms.off their offsets into the postings
+    postings.bin / freqs.bin   local doc ids and term frequencies'''
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        # guarded by the store's lock. a merged away segment is retired and
+        # only deleted once the last reader is done with it
+        self.readers = 0
+        self.retired = False
+        self.doc_offsets = _map_array(os.path.join(path, 'docs.off'), '<u8')
+        self.count = len(self.doc_offsets) - 1
+        self.term_offsets = _map_array(os.path.join(path, 'terms.off'), '<u8')
+        self.postings = _map_array(os.path.join(path, 'postings.bin'), '<u4')
+        self.freqs = _map_array(os.path.join(path, 'freqs.bin'), '<u4')
+        with open(os.path.join(path, 'terms.txt'), encoding='utf-8') as f:
+            self.terms = {term: i for i, term in enumerate(f.read().split('\n')) if term}
+        self._docs = open(os.path.join(path, 'docs.bin'), 'rb')
+        self._docs_lock = threading.Lock()
+
+    @staticmethod
+    def write(path, records, postings):
+        '''writes a segment from compressed doc records and a dict of
+        term -> (local doc ids, frequencies)'''
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        offsets = [0]
+        with open(os.path.join(tmp_path, 'docs.bin'), 'wb') as f:
+            for record in records:
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+        _write_array(os.path.join(tmp_path, 'docs.off'), offsets, '<u8')
+
+        terms = sorted(postings)
+        term_offsets = [0]
+        with open(os.path.join(tmp_path, 'postings.bin'), 'wb') as p, \
+                open(os.path.join(tmp_path, 'freqs.bin'), 'wb') as q:
+            for term in terms:
+                doc_ids, freqs = postings[term]
+                np.asarray(doc_ids, dtype='<u4').tofile(p)
+                np.asarray(freqs, dtype='<u4').tofile(q)
+                term_offsets.append(term_offsets[-1] + len(doc_ids))
+        _write_array(os.path.join(tmp_path, 'terms.off'), term_offsets, '<u8')
+        with open(os.path.join(tmp_path, 'terms.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(terms))
+
+        os.rename(tmp_path, path)
+
+    def raw_doc(self, local_id):
+        start, end = int(self.doc_offsets[local_id]), int(self.doc_offsets[local_id + 1])
+        with self._docs_lock:
+            self._docs.seek(start)
+            return self._docs.read(end - start)
+
+    def doc(self, local_id):
+        return json.loads(zlib.decompress(self.raw_doc(local_id)).decode('utf-8'))
+
+    def term(self, term):
+        '''(local doc ids, frequencies) for the term'''
+        i = self.terms.get(term)
+        if i is None:
+            return np.zeros(0, dtype='<u4'), np.zeros(0, dtype='<u4')
+        start, end = int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+        return self.postings[start:end], self.freqs[start:end]
+
+    def close(self):
+        self._docs.close()
+
+    def delete(self):
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class CorpusStore(object):
+    '''append only store of cleaned docs with an inverted index.
+
+    added docs are buffered and written out as immutable segments every
+    `flush_docs` docs (or on flush()). a background thread merges runs of
+    adjacent segments once there are more than `max_segments`, so doc ids
+    stay stable. only flushed docs are visible to queries'''
+    def __init__(self, path, flush_docs=10000, max_segments=8, merge_factor=4):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.merge_factor = merge_factor
+
+        self._lock = threading.Lock()
+        self._manifest = {'next_segment': 0, 'segments': []}
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._manifest = json.load(f)
+        self._remove_orphans()
+        self._segments = [Segment(os.path.join(path, s['name']), s['base'])
+                          for s in self._manifest['segments']]
+        self._next_id = sum(s.count for s in self._segments)
+
+        self._records = []
+        self._postings = collections.defaultdict(lambda: ([], []))
+
+        self._merge_wanted = threading.Event()
+        self._closing = False
+        self._merger = threading.Thread(target=self._merge_loop, daemon=True)
+        self._merger.start()
+
+    def _remove_orphans(self):
+        '''deletes segments the manifest doesn't list: half written .tmp
+        ones, and ones a crash left between writing a segment (or a merge)
+        and the manifest. their names would be handed out again'''
+        listed = set(s['name'] for s in self._manifest['segments'])
+        for name in os.listdir(self.path):
+            if name.startswith('seg-') and name not in listed:
+                logger.warning("│ │ │ ├ removing {}, not in the manifest".format(name))
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def __len__(self):
+        with self._lock:
+            return sum(s.count for s in self._segments)
+
+    def add(self, text, url=None, meta=None):
+        '''buffers a cleaned doc, returns its doc id'''
+        local_id = len(self._records)
+        record = {'url': url, 'meta': meta or {}, 'text': text}
+        self._records.append(zlib.compress(json.dumps(record).encode('utf-8')))
+        for term, freq in collections.Counter(text.split()).items():
+            doc_ids, freqs = self._postings[term]
+            doc_ids.append(local_id)
+            freqs.append(freq)
+
+        doc_id = self._next_id
+        self._next_id += 1
+        if len(self._records) >= self.flush_docs:
+            self.flush()
+        return doc_id
+
+    def flush(self):
+        '''writes the buffered docs out as a new segment'''
+        if not self._records:
+            return
+        with self._lock:
+            name = 'seg-{:06d}'.format(self._manifest['next_segment'])
+            self._manifest['next_segment'] += 1
+            base = self._next_id - len(self._records)
+            Segment.write(os.path.join(self.path, name), self._records, self._postings)
+            self._segments.append(Segment(os.path.join(self.path, name), base))
+            self._manifest['segments'].append(
+                {'name': name, 'base': base, 'count': len(self._records)})
+            self._write_manifest()
+            self._records = []
+            self._postings = collections.defaultdict(lambda: ([], []))
+            if len(self._segments) > self.max_segments:
+                self._merge_wanted.set()
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    @contextlib.contextmanager
+    def _reading(self):
+        '''the current segments, kept on disk and open until the with block
+        ends even if a merge replaces them meanwhile'''
+        with self._lock:
+            segments = list(self._segments)
+            for segment in segments:
+                segment.readers += 1
+        try:
+            yield segments
+        finally:
+            with self._lock:
+                for segment in segments:
+                    segment.readers -= 1
+                unused = [s for s in segments if s.retired and not s.readers]
+            for segment in unused:
+                segment.delete()
+
+    def doc(self, doc_id):
+        '''the stored {'url', 'meta', 'text'} for a doc id'''
+        with self._reading() as segments:
+            for segment in segments:
+                if segment.base <= doc_id < segment.base + segment.count:
+                    return segment.doc(doc_id - segment.base)
+        raise KeyError(doc_id)
+
+    def term(self, term):
+        '''sorted ids of the docs containing the term'''
+        with self._reading() as segments:
+            parts = [segment.term(term)[0].astype(np.int64) + segment.base
+                     for segment in segments]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def term_frequencies(self, term):
+        '''(doc ids, term frequencies) for the term'''
+        ids, freqs = [], []
+        with self._reading() as segments:
+            for segment in segments:
+                local_ids, local_freqs = segment.term(term)
+                ids.append(local_ids.astype(np.int64) + segment.base)
+                freqs.append(np.array(local_freqs))
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype='<u4')
+        return np.concatenate(ids), np.concatenate(freqs)
+
+    def search(self, *terms):
+        '''ids of the docs containing every one of the terms'''
+        result = None
+        for term in terms:
+            ids = self.term(term)
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        return result if result is not None else np.zeros(0, dtype=np.int64)
+
+    def iter_docs(self):
+        '''yields (doc id, doc) for every flushed doc in id order'''
+        with self._reading() as segments:
+            for segment in segments:
+                for local_id in range(segment.count):
+                    yield segment.base + local_id, segment.doc(local_id)
+
+    def _merge_loop(self):
+        while True:
+            self._merge_wanted.wait()
+            self._merge_wanted.clear()
+            if self._closing:
+                return
+            try:
+                while self._merge_once():
+                    pass
+            except Exception as e:
+                logger.warning("│ │ │ ├ segment merge failed: {!r}".format(e))
+
+    def _merge_once(self):
+        '''merges the run of `merge_factor` adjacent segments with the
+        fewest docs, returns False if there was nothing to do'''
+        with self._lock:
+            if len(self._segments) <= self.max_segments:
+                return False
+            n = min(self.merge_factor, len(self._segments))
+            start = min(range(len(self._segments) - n + 1),
+                        key=lambda i: sum(s.count for s in self._segments[i:i + n]))
+            run = self._segments[start:start + n]
+            name = 'seg-{:06d}'.format(self._manifest['next_segment'])
+            self._manifest['next_segment'] += 1
+
+        # the heavy lifting happens without the lock, segments are immutable
+        records = []
+        postings = collections.defaultdict(lambda: ([], []))
+        offset = 0
+        for segment in run:
+            records.extend(segment.raw_doc(i) for i in range(segment.count))
+            for term in segment.terms:
+                local_ids, freqs = segment.term(term)
+                doc_ids, merged_freqs = postings[term]
+                doc_ids.append(np.asarray(local_ids, dtype=np.int64) + offset)
+                merged_freqs.append(np.asarray(freqs))
+            offset += segment.count
+        postings = {term: (np.concatenate(ids), np.concatenate(freqs))
+                    for term, (ids, freqs) in postings.items()}
+        path = os.path.join(self.path, name)
+        Segment.write(path, records, postings)
+        merged = Segment(path, run[0].base)
+
+        with self._lock:
+            i = self._segments.index(run[0])
+            self._segments[i:i + n] = [merged]
+            self._manifest['segments'][i:i + n] = [
+                {'name': name, 'base': merged.base, 'count': merged.count}]
+            self._write_manifest()
+            for segment in run:
+                segment.retired = True
+            unused = [s for s in run if not s.readers]
+        logger.debug("│ │ │ ├ merged {} segments into {}".format(n, name))
+
+        # the rest go when their last reader is done, see _reading
+        for segment in unused:
+            segment.delete()
+        return True
+
+    def close(self):
+        self.flush()
+        self._closing = True
+        self._merge_wanted.set()
+        self._merger.join()
+        for segment in self._segments:
+            segment.close()
+
+
+def _decode_headers(headers):
+    return {k: v.decode('utf-8', 'replace') if isinstance(v, bytes) else v
+            for k, v in (headers or {}).items()}
+
+
+def store_docs(rabbitmq_host, corpus_queue, corpus_path, batch_size=256,
+               batch_wait=0.5, flush_docs=10000, flush_interval=30, idle_timeout=None,
+               docs_per_message=1):
+    '''corpus sink. appends every cleaned doc, with the url and fetch
+    metadata from its headers, to the corpus store. a segment is written
+    once `flush_docs` docs are buffered, or `flush_interval` seconds after
+    the oldest of them arrived, and messages are acked once the segment
+    holding them is on disk. `docs_per_message` is how many docs the
+    cleaner packs into a message, which sizes the prefetch'''
+    logger.info("│ │ ├ Storing docs from RabbitMQ in {}...".format(corpus_path))
+
+    store = CorpusStore(corpus_path, flush_docs)
+    # unacked messages pile up until a flush, so prefetch has to cover
+    # them. if the packs run smaller than docs_per_message we flush early
+    # rather than wait on a prefetch that is used up
+    flush_messages = max(1, -(-flush_docs // docs_per_message))
+    consumer = batch_consumer(rabbitmq_host, corpus_queue, batch_size, batch_wait,
+                              flush_messages + batch_size, idle_timeout, name='corpus sink')
+
+    unflushed = []
+    unflushed_docs = 0
+    unflushed_messages = 0
+    unflushed_since = None
+    # empty batches while idle, so a trickle of docs still gets flushed
+    for batch in consumer.batches(idle_batches=True):
+        # messages that don't decode are rejected and dropped from the batch
+        batch, docs = consumer.decode(batch)
+        if batch:
+            for doc in docs:
+                meta = _decode_headers(doc.headers)
+                store.add(doc.body.decode('utf-8', 'replace'), meta.pop('url', None), meta)
+            unflushed.append(batch)
+            unflushed_docs += len(docs)
+            unflushed_messages += len(batch)
+            if unflushed_since is None:
+                unflushed_since = time.monotonic()
+            logger.debug("│ │ │ └ {} docs stored!".format(len(docs)))
+
+        if unflushed and (unflushed_docs >= flush_docs
+                          or unflushed_messages >= flush_messages
+                          or time.monotonic() - unflushed_since >= flush_interval):
+            store.flush()
+            for done in unflushed:
+                consumer.ack(done)
+            unflushed = []
+            unflushed_docs = 0
+            unflushed_messages = 0
+            unflushed_since = None
+
+    store.flush()
+    for done in unflushed:
+        consumer.ack(done)
+    store.close()
+    consumer.close()
@@ -1,34 +1,83 @@
 import colorlog
-import pika
+import contextlib
 import requests
-from bs4 import BeautifulSoup
+import signal
 import threading
 import time
+import urllib3
 from multiprocessing.pool import ThreadPool
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse
+
+import metrics
+from publisher import get_publisher
+from checkpoint import CrawlState, config_fingerprint
+from dedupe import Deduper
+from envelope import encode
+from filters import ContentFilter, UrlFilter
+from fetch import (CHUNK_SIZE, HTML_CONTENT_TYPES, BodyBuffer, FetchAborted,
+                   check_headers, decode_body)
+from extract import extract_page
+from frontier import Frontier
+from seenset import SeenSet
+from throttle import AimdLimiter
+from validators import ValidatorCache, conditional_headers, content_hash
 
 logger = colorlog.getLogger('NLPCrawl')
 
-def store_html(url, html, queue, rabbitmq_host):
-    logger.info("│ │ ├ Storing HTML from {}...".format(url))
+FETCH_SECONDS = metrics.histogram(
+    'nlpcrawl_fetch_seconds', 'page fetch latency by status and host', ('status', 'host'))
+FETCH_BYTES = metrics.counter(
+    'nlpcrawl_fetch_bytes_total', 'page body bytes downloaded by host', ('host',))
+FETCH_ABORTED = metrics.counter(
+    'nlpcrawl_fetch_aborted_total', 'responses dropped before the body was read, by reason',
+    ('reason',))
+PAGE_LINKS = metrics.histogram(
+    'nlpcrawl_page_links', 'links extracted per page', buckets=metrics.COUNT_BUCKETS)
+PAGE_SECONDS = metrics.histogram(
+    'nlpcrawl_page_process_seconds', 'parse, dedupe and publish time per page')
+PAGES = metrics.counter(
+    'nlpcrawl_pages_total', 'crawled pages by outcome', ('outcome',))
+FRONTIER_SIZE = metrics.gauge('nlpcrawl_frontier_urls', 'urls waiting in the frontier')
+SEEN_SIZE = metrics.gauge('nlpcrawl_seen_urls', 'urls in the seen set')
 
-    while True:
-        try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
-            channel = connection.channel()
-            logger.debug("│ │ │ ├ connected to rabbitmq at {}".format(rabbitmq_host))
-            break
-        except pika.exceptions.AMQPConnectionError as e:
-            logger.warning("│ │ │ ├ {}".format(e))
-            time.sleep(3)
-            pass
-    
-    channel.basic_publish(
-        exchange='',
-        routing_key=queue,
-        body=html
-    )
-    logger.debug("│ │ │ └ HTML published to rabbitmq!")
+# seconds between frontier checks while idle but expecting work
+IDLE_POLL = 0.2
+
+def store_html(url, html, queue, rabbitmq_host, headers=None,
+               content_type='text/html; charset=utf-8', verbose=False, codec='zlib'):
+    '''publishes a page in the message envelope, `headers` carry its
+    provenance'''
+    if verbose:
+        logger.info("│ │ ├ Storing HTML from {}...".format(url))
+    body, properties = encode(html, headers, content_type, codec)
+    get_publisher(rabbitmq_host).publish(queue, body, properties=properties)
+    if verbose:
+        logger.debug("│ │ │ └ HTML queued for rabbitmq!")
+
+
+def _read_chunks(raw, deadline, timeout):
+    '''yields a streamed body (a urllib3 response) as it arrives, not in
+    whole CHUNK_SIZE reads a server dripping bytes could drag out for
+    hours. no read waits longer than `timeout` or the time left until
+    `deadline`. errors come out as requests exceptions, as from
+    iter_content'''
+    sock = getattr(raw.connection, 'sock', None)
+    try:
+        while True:
+            if sock is not None:
+                sock.settimeout(max(0.01, min(timeout, deadline - time.monotonic())))
+            chunk = raw.read1(CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    except urllib3.exceptions.ReadTimeoutError as e:
+        if time.monotonic() >= deadline:
+            raise FetchAborted('deadline')
+        raise requests.ConnectionError(e)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
 
 
 class Crawler(object):
@@ -36,107 +85,505 @@ class Crawler(object):
                  include_urls, exclude_urls, 
                  include_content, exclude_content, 
                  num_threads, html_queue, rabbitmq_host,
-                 empty_wait=3, empty_retry_count=10):
+                 seen_path=None, seen_capacity=1000000,
+                 seen_error_rate=0.001, seen_memory_budget=64 * 1024 * 1024,
+                 host_delay=0.0, host_delays=None,
+                 state_path=None, checkpoint_interval=60,
+                 duplicate_threshold=0.95, duplicate_action='drop',
+                 publish_text=False, message_codec='zlib',
+                 allowed_content_types=HTML_CONTENT_TYPES,
+                 max_body_size=10 * 1024 * 1024, fetch_timeout=5, fetch_deadline=30,
+                 min_concurrency=1, max_error_rate=0.1, target_latency=None,
+                 queue_high_water=10000, queue_low_water=None, queue_check_interval=1.0,
+                 flush_timeout=60, verbose=False):
         '''Initialise the crawler and setup variables'''
         self.start_url = start_url
         self.include_urls = include_urls
         self.exclude_urls = exclude_urls
         self.include_content = include_content
         self.exclude_content = exclude_content
+        # compiled once, so filtering costs the same for one rule or thousands
+        self._url_filter = UrlFilter(include_urls, exclude_urls)
+        self._content_filter = ContentFilter(include_content, exclude_content)
         self.num_threads = num_threads
         self.html_queue = html_queue
         self.rabbitmq_host = rabbitmq_host
-        self.empty_wait = empty_wait
-        self.empty_retry_count = empty_retry_count
+        self.checkpoint_interval = checkpoint_interval
+        self.duplicate_action = duplicate_action
+        self.publish_text = publish_text
+        # compression of published pages, 'zlib', 'zstd' or None
+        self.message_codec = message_codec
+        # responses of other types, or bigger than max_body_size bytes, are
+        # dropped unread. fetch_timeout is per socket operation and
+        # fetch_deadline bounds the whole request
+        self.allowed_content_types = allowed_content_types
+        self.max_body_size = max_body_size
+        self.fetch_timeout = fetch_timeout
+        self.fetch_deadline = fetch_deadline
+        # fetches in flight are adapted between min_concurrency and
+        # num_threads (concurrency for the async backend) by an AimdLimiter,
+        # which also pauses the crawl while the html queue holds more than
+        # queue_high_water pages (None never pauses)
+        self.min_concurrency = min_concurrency
+        self.max_error_rate = max_error_rate
+        self.target_latency = target_latency
+        self.queue_high_water = queue_high_water
+        self.queue_low_water = queue_low_water
+        self.queue_check_interval = queue_check_interval
+        # seconds a finishing crawl waits for rabbitmq to confirm its pages
+        self.flush_timeout = flush_timeout
+        # per page log lines, off by default as they cost in the hot path
+        self.verbose = verbose
 
-        self._urls_to_crawl = set([start_url,])
-        self._urls_to_crawl_lock = threading.Lock()
-        self._urls_been_crawled = set()
-        self._urls_been_crawled_lock = threading.Lock()
+        # on-disk state so a restarted crawl picks up where it stopped
+        self._state = None
+        resumed = None
+        if state_path is not None:
+            self._state = CrawlState(state_path, config_fingerprint({
+                'start_url': start_url,
+                'include_urls': include_urls,
+                'exclude_urls': exclude_urls,
+                'include_content': include_content,
+                'exclude_content': exclude_content
+            }))
+            resumed = self._state.load()
+            seen_path = self._state.seen_path
+        self._last_checkpoint = time.monotonic()
+
+        # content fingerprints of every stored page, 'drop' skips duplicate
+        # pages and 'tag' publishes them with a duplicate_of header. with
+        # on-disk state they are committed by _checkpoint like the seen set
+        self._deduper = Deduper(
+            duplicate_threshold,
+            path=self._state.dedupe_path if self._state is not None else None,
+            commit_every=None if self._state is not None else 1000)
+
+        # etag / last-modified / content hash of every page we've fetched
+        self._validators = ValidatorCache(
+            self._state.validators_path if self._state is not None else ':memory:')
+
+        # every url ever queued, normalised, so nothing is fetched twice
+        # with on-disk state it is only committed by _checkpoint, together
+        # with the frontier
+        self._urls_seen = SeenSet(seen_path, seen_capacity,
+                                  seen_error_rate, seen_memory_budget,
+                                  commit_every=None if self._state is not None else 1000)
+        # per host politeness queues, ordered by _priority()
+        self._urls_to_crawl = Frontier(host_delay, host_delays)
+        # urls handed out but not finished yet, kept for checkpoints
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # held while a url moves between the seen set, frontier and in
+        # flight, so a checkpoint never catches one half way
+        self._snapshot_lock = threading.Lock()
+        self._crawled_count = 0
+        self._crawled_count_lock = threading.Lock()
+        self._stopping = False
+        self._limiter = None
+        # fetches handed to the pool and not finished yet, guarded by
+        # _wakeup which is notified whenever one finishes
+        self._running = 0
+        self._wakeup = threading.Condition()
+        FRONTIER_SIZE.set_function(self._urls_to_crawl.__len__)
+        SEEN_SIZE.set_function(self._urls_seen.__len__)
+
+        if resumed and (resumed[0] or resumed[1]):
+            items, self._crawled_count = resumed
+            for url, priority, depth in items:
+                self._urls_seen.add(url)
+                self._urls_to_crawl.put(url, priority, depth)
+            logger.info('│ ├ Resuming crawl, {} crawled, {} queued...'.format(
+                self._crawled_count, len(items)))
+        else:
+            # nothing crawled or queued yet, e.g. killed before a checkpoint
+            self._enqueue(start_url)
+            # saved right away, a crash before the first checkpoint must not
+            # leave a running crawl with an empty frontier
+            self._checkpoint(force=True)
+
+        # one requests session per worker thread so connections are reused
+        self._local = threading.local()
 
     def crawl(self, max_pages=None):
-        '''start the crawler in motion'''
+        '''start the crawler in motion. urls are handed to the pool as
+        fetches finish, as many at a time as the limiter allows, and the
+        crawl ends once the frontier is drained and nothing is in flight'''
         crawl_pool = ThreadPool(self.num_threads)
+        self._limiter = self._new_limiter(self.num_threads)
 
         logger.info('│ ├ Starting {} crawler threads...'.format(self.num_threads))
-        
-        crawl_pool.apply(self._crawl_thread, args=(self.start_url,))
+        self._stopping = False
 
-        empty_count = 0
-        while True:
-            crawl_pool.apply_async(self._crawl_thread)
+        scheduled = 0
+        stop_saved = False
+        self._limiter.start(on_change=self._wake)
+        with self._stop_on_sigterm():
+            while True:
+                with self._wakeup:
+                    # max_pages reached or stop() called, let what's in flight finish
+                    winding_down = self._stopping or (max_pages is not None and scheduled >= max_pages)
+                    while not winding_down and self._running < self._limiter.limit:
+                        item = self._next_url()
+                        if item is None:
+                            break
+                        self._running += 1
+                        scheduled += 1
+                        crawl_pool.apply_async(self._run_fetch, item)
+                        winding_down = max_pages is not None and scheduled >= max_pages
 
-            # if queue is empty sleep
-            if len(self._urls_to_crawl) == 0:
-                empty_count += 1
-                time.sleep(self.empty_wait)
+                    # sleep until a fetch finishes, the next host's politeness
+                    # window opens or the limiter pauses or resumes
+                    if winding_down or self._limiter.paused:
+                        ready_in = None
+                    elif self._running >= self._limiter.limit:
+                        self._limiter.saturated()
+                        ready_in = None
+                    else:
+                        ready_in = self._urls_to_crawl.next_ready_in()
 
-            # if queue is still empty after sleeping/retrying x many times then exit
-            if empty_count >= self.empty_retry_count:
-                break
-        
+                    if not self._running and ready_in is None:
+                        # nothing in flight and nothing left to schedule, we're done
+                        if winding_down:
+                            break
+                        if not self._limiter.paused:
+                            if not self._expecting_work():
+                                break
+                            ready_in = IDLE_POLL
+                    self._wakeup.wait(ready_in)
+
+                self._checkpoint(force=self._stopping and not stop_saved)
+                # once, as docker stop won't wait long for the fetches in flight
+                stop_saved = self._stopping
+
+        self._limiter.stop()
         crawl_pool.close()
         crawl_pool.join()
+
+        self._finish_crawl()
         
-        logger.info('│ └ crawled {} links!'.format(len(self._urls_been_crawled)))
+        logger.info('│ └ crawled {} links!'.format(self._crawled_count))
+
+    def stop(self):
+        '''stops handing out urls and checkpoints, crawl() returns once the
+        fetches in flight are done. safe from any thread or a signal
+        handler'''
+        if not self._stopping:
+            logger.info('│ ├ Stopping, waiting for the fetches in flight...')
+        self._stopping = True
+        self._wake()
+
+    def close(self):
+        '''releases the seen set and the page fingerprints, deleting them
+        if they are temporary files. the crawler can't crawl() again after
+        this'''
+        self._urls_seen.close()
+        self._deduper.close()
+
+    @property
+    def stopped(self):
+        '''True if the last crawl() was cut short by stop()'''
+        return self._stopping
+
+    @contextlib.contextmanager
+    def _stop_on_sigterm(self):
+        '''stop() on SIGTERM (docker stop) while the with block runs, so
+        the crawl is checkpointed rather than killed half way'''
+        try:
+            previous = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        except ValueError:
+            # not the main thread, the caller has to stop() us
+            yield
+            return
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def _new_limiter(self, max_concurrency):
+        '''a fresh AimdLimiter for one crawl, watching the html queue'''
+        publisher = get_publisher(self.rabbitmq_host)
+        return AimdLimiter(
+            max_concurrency, self.min_concurrency,
+            queue_depth=lambda: publisher.queue_depth(self.html_queue),
+            high_water=self.queue_high_water, low_water=self.queue_low_water,
+            check_interval=self.queue_check_interval,
+            max_error_rate=self.max_error_rate, target_latency=self.target_latency)
+
+    def _run_fetch(self, url, depth):
+        '''one pool task, crawls a url and wakes crawl() when done'''
+        try:
+            return self._crawl_thread(url, depth)
+        except Exception as e:
+            logger.warning('│ │ │ └ {!r}'.format(e))
+            return False
+        finally:
+            with self._wakeup:
+                self._running -= 1
+                self._wakeup.notify()
+
+    def _wake(self):
+        '''wakes crawl() to look at the frontier, for urls queued from
+        outside the fetch threads or the limiter pausing or resuming'''
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _observe_fetch(self, host, status, started):
+        '''records a fetch's latency, and feeds it to the limiter'''
+        seconds = time.perf_counter() - started
+        FETCH_SECONDS.observe(seconds, status=status, host=host)
+        if self._limiter is not None:
+            self._limiter.record(seconds, failed=status == 'error' or status == 429 or status >= 500)
+
+    def _expecting_work(self):
+        '''True if urls may still arrive although the frontier is empty,
+        which keeps the crawl going. always False for a lone crawler'''
+        return False
+
+    def _checkpoint_due(self, force=False):
+        '''True if _checkpoint(force) would write a checkpoint'''
+        return self._state is not None and (
+            force or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval)
+
+    def _checkpoint(self, force=False):
+        '''snapshots the seen set and frontier every checkpoint_interval'''
+        if not self._checkpoint_due(force):
+            return
+        self._last_checkpoint = time.monotonic()
+
+        with self._snapshot_lock:
+            with self._in_flight_lock:
+                in_flight = list(self._in_flight.values())
+            # the frontier first, and the seen set is committed nowhere
+            # else. after a crash every url seen on disk has been crawled or
+            # is in the saved frontier, at worst a few are crawled twice
+            self._state.save(self._urls_to_crawl.items() + in_flight, self._crawled_count)
+            self._urls_seen.snapshot()
+        # fingerprints of pages published since the last checkpoint, a
+        # resumed crawl must not publish their near duplicates again
+        self._deduper.flush()
+        self._validators.flush()
+        logger.debug('│ ├ checkpointed {} queued urls'.format(len(self._urls_to_crawl)))
+
+    def _finish_crawl(self):
+        '''flushes everything the crawl produced, marking the state complete
+        if the frontier was drained'''
+        # wait for rabbitmq to confirm everything we stored, but not forever
+        # if the broker is down
+        publisher = get_publisher(self.rabbitmq_host)
+        if not publisher.flush(self.flush_timeout):
+            logger.warning('│ ├ {} pages still unconfirmed by rabbitmq after {}s'.format(
+                publisher.outstanding, self.flush_timeout))
+        self._validators.flush()
+        self._deduper.flush()
+
+        if self._state is None:
+            self._urls_seen.flush()
+        elif len(self._urls_to_crawl) == 0 and not self._in_flight:
+            self._urls_seen.flush()
+            self._state.finish(self._crawled_count)
+        else:
+            # stopped early (e.g. max_pages), resume from here next time
+            self._checkpoint(force=True)
     
-    def _crawl_thread(self, url=None):
+    def _crawl_thread(self, url=None, depth=0):
         '''internal method to crawl a page and extract information 
         using excludes/includes. this method is 1 thread of crawler'''
         if not url:
-            with self._urls_to_crawl_lock:
-                if len(self._urls_to_crawl) > 0:
-                    url = self._urls_to_crawl.pop()
-                else:
-                    return
+            if self._stopping:
+                return False
+            url, depth = self._next_url() or (None, 0)
         
         if url:
-            logger.info('│ │ ├ Fetching {}...'.format(url))
-            result = requests.Session()
-            result = result.get(url, timeout=5, verify=False)
-            logger.info('│ │ │ └ result code {}...'.format(result.status_code))
-
-            if result.status_code == 200:
-                with self._urls_been_crawled_lock:
-                    self._urls_been_crawled.add(url)
-                c = result.text
-                soup = BeautifulSoup(c)
-                links = soup.findAll('a')
-                for a in links:
-                    # logger.debug('│ │ ├ checking link: {}'.format(a))
-                    try:
-                        a = a.attrs['href']
-                        parsed_url = urlparse(url)
-                        if parsed_url.scheme == '': 
-                            parsed_url = parsed_url._replace(scheme='http')
-                        base_url = parsed_url[0] + '://' + parsed_url[1]
-                        a = urljoin(base_url, a)
-                        # logger.debug('│ │ ├ expanded link: {}'.format(a))
-                    except:
-                        continue
-                    if self._filter_link(a):
-                        with self._urls_been_crawled_lock:
-                            if a not in self._urls_been_crawled:
-                                # logger.debug('│ │ ├ storing link: {}'.format(a))
-                                with self._urls_to_crawl_lock:
-                                    self._urls_to_crawl.add(a)
-                
-                if self._filter_content(c):
-                    store_html(url, c, self.html_queue, self.rabbitmq_host)
-                    return True
-        logger.info('│ │ │ └ Excluded HTML!...')
+            try:
+                if self.verbose:
+                    logger.info('│ │ ├ Fetching {}...'.format(url))
+                cached = self._validators.get(url)
+                host = urlparse(url).netloc
+                started = time.perf_counter()
+                try:
+                    status, headers, body = self._fetch(url, cached)
+                except FetchAborted as e:
+                    self._aborted(url, e.reason)
+                    return False
+                except requests.RequestException as e:
+                    self._observe_fetch(host, 'error', started)
+                    logger.warning('│ │ │ └ {!r}'.format(e))
+                    return False
+                self._observe_fetch(host, status, started)
+                if self.verbose:
+                    logger.info('│ │ │ └ result code {}...'.format(status))
+
+                if status == 304 and cached is not None:
+                    return self._process_unchanged(url, cached, depth)
+                if status == 200:
+                    FETCH_BYTES.inc(len(body), host=host)
+                    return self._fetched(url, body, depth, headers, cached)
+            finally:
+                self._done(url)
         return False
 
-    def _filter_link(self, a):
-        '''applies url filtering rules to link'''
-        for inc_url in self.include_urls:
-            if inc_url in a:
-                return True
+    def _fetch(self, url, cached):
+        '''streams a page, returns (status, headers, body) where body is
+        None unless the status is 200. raises FetchAborted as soon as the
+        headers or a chunk show the page isn't wanted, which drops the
+        connection rather than reading the rest, or once the deadline has
+        passed. no socket operation waits longer than fetch_timeout or the
+        time left, whichever is less'''
+        deadline = time.monotonic() + self.fetch_deadline
+        timeout = min(self.fetch_timeout, self.fetch_deadline)
+        with self._session().get(url, timeout=timeout, verify=False,
+                                 headers=conditional_headers(cached), stream=True) as result:
+            if result.status_code != 200:
+                return result.status_code, result.headers, None
+            check_headers(result.headers, self.allowed_content_types, self.max_body_size)
+            if time.monotonic() > deadline:
+                # the headers took it
+                raise FetchAborted('deadline')
+            body = BodyBuffer(self.max_body_size, deadline)
+            for chunk in _read_chunks(result.raw, deadline, self.fetch_timeout):
+                body.feed(chunk)
+            return 200, result.headers, body.getvalue()
+
+    def _fetched(self, url, body, depth, headers, cached):
+        '''decodes a downloaded body and processes the page'''
+        text, encoding = decode_body(body, headers.get('Content-Type'))
+        return self._process_page(url, text, depth, headers, cached, encoding)
+
+    def _aborted(self, url, reason):
+        FETCH_ABORTED.inc(reason=reason)
+        if self.verbose:
+            logger.info('│ │ │ └ Dropped {} ({})...'.format(url, reason))
+
+    def _session(self):
+        '''returns the requests session owned by the calling thread'''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _priority(self, url, depth):
+        '''frontier priority of a url, lower is crawled sooner. breadth
+        first by default, override to crawl by score'''
+        return depth
+
+    def _enqueue(self, url, depth=0):
+        '''queues a url to be crawled unless it has been seen before,
+        returns whether it was queued'''
+        with self._snapshot_lock:
+            if not self._urls_seen.add(url, self._seen_host(url)):
+                return False
+            self._urls_to_crawl.put(url, self._priority(url, depth), depth)
+            return True
+
+    def _seen_host(self, url):
+        '''the host a url is tagged with in the seen set, None to not tag
+        it. a lone crawler never reads the tags back'''
+        return None
+
+    def _next_url(self):
+        '''pops the next (url, depth) whose host may be crawled now, or None
+        if there is nothing to do yet'''
+        with self._snapshot_lock:
+            item = self._urls_to_crawl.get()
+            if item is not None:
+                url, depth = item
+                with self._in_flight_lock:
+                    self._in_flight[url] = (url, self._priority(url, depth), depth)
+        return item
+
+    def _done(self, url):
+        '''marks a url handed out by _next_url as finished'''
+        with self._in_flight_lock:
+            self._in_flight.pop(url, None)
+
+    def _process_unchanged(self, url, cached, depth=0):
+        '''a revalidated page that hasn't changed since the last crawl, its
+        cached links still feed the frontier but nothing is published'''
+        with self._crawled_count_lock:
+            self._crawled_count += 1
+        for a in cached.links:
+            self._enqueue(a, depth + 1)
+        PAGES.inc(outcome='unchanged')
+        if self.verbose:
+            logger.info('│ │ │ └ Unchanged since last crawl...')
         return False
+
+    def _process_page(self, url, c, depth=0, headers=None, cached=None, encoding=None):
+        '''extracts links from a fetched page and stores the html. shared
+        by every fetch backend. `headers` are the response headers,
+        `cached` the page's ValidatorCache entry from the last crawl and
+        `encoding` the charset the body was decoded with'''
+        with PAGE_SECONDS.time():
+            return self._store_page(url, c, depth, headers or {}, cached, encoding)
+
+    def _store_page(self, url, c, depth, headers, cached, encoding):
+        with self._crawled_count_lock:
+            self._crawled_count += 1
+        # one parse gives us both the links and the visible text
+        page = extract_page(c, url)
+        kept_links = []
+        for a in page.links:
+            # logger.debug('│ │ ├ checking link: {}'.format(a))
+            if self._filter_link(a):
+                # logger.debug('│ │ ├ storing link: {}'.format(a))
+                kept_links.append(a)
+                self._enqueue(a, depth + 1)
+        PAGE_LINKS.observe(len(page.links))
+
+        chash = content_hash(c)
+        self._validators.put(url, headers.get('ETag'), headers.get('Last-Modified'),
+                             chash, kept_links)
+        if cached is not None and cached.content_hash == chash:
+            PAGES.inc(outcome='unchanged')
+            if self.verbose:
+                logger.info('│ │ │ └ Unchanged since last crawl...')
+            return False
+        
+        if self._filter_content(page.text):
+            # provenance travels with the page through every later stage
+            message_headers = {
+                'url': url,
+                'status': 200,
+                # epoch milliseconds, amqp tables have no floats
+                'fetched_at_ms': int(time.time() * 1000),
+                'depth': depth
+            }
+            if headers.get('Content-Type'):
+                message_headers['content_type'] = headers.get('Content-Type')
+            if encoding:
+                message_headers['encoding'] = encoding
+            kind, original = self._deduper.check(url, page.text)
+            if kind is not None:
+                if self.verbose:
+                    logger.info('│ │ │ └ {} duplicate of {}...'.format(kind, original))
+                if self.duplicate_action == 'drop':
+                    PAGES.inc(outcome='duplicate')
+                    return False
+                message_headers.update({'duplicate': kind, 'duplicate_of': original})
+            if self.publish_text:
+                # hand the cleaner the text so it doesn't parse the html again
+                store_html(url, page.text, self.html_queue, self.rabbitmq_host,
+                           message_headers, 'text/plain; charset=utf-8',
+                           self.verbose, self.message_codec)
+            else:
+                store_html(url, c, self.html_queue, self.rabbitmq_host, message_headers,
+                           verbose=self.verbose, codec=self.message_codec)
+            PAGES.inc(outcome='stored')
+            return True
+        PAGES.inc(outcome='excluded')
+        if self.verbose:
+            logger.info('│ │ │ └ Excluded HTML!...')
+        return False
+
+    def _filter_link(self, a):
+        '''applies url filtering rules to link, it must match one of
+        include_urls and none of exclude_urls (see filters.UrlFilter)'''
+        return self._url_filter(a)
     
     def _filter_content(self, c):
-        '''applies content filtering rules to content'''
-        return True
+        '''applies content filtering rules to the page's visible text'''
+        return self._content_filter(c)
 
 
 
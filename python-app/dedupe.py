@@ -0,0 +1,180 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+FINGERPRINT_BITS = 64
+EXACT = 'exact'
+NEAR = 'near'
+
+_word_re = re.compile(r'\w+')
+
+
+def _hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def _signed(value):
+    '''a 64 bit unsigned value as the signed integer sqlite can hold'''
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _unsigned(value):
+    return value & ((1 << 64) - 1)
+
+
+def exact_hash(text):
+    '''hash of the text with whitespace and case differences removed'''
+    return _hash64(' '.join(text.lower().split()).encode('utf-8'))
+
+
+def simhash(text, shingle_size=3):
+    '''64 bit simhash over word shingles of the text. similar texts get
+    fingerprints that differ in few bits'''
+    words = _word_re.findall(text.lower())
+    shingles = {' '.join(words[i:i + shingle_size])
+                for i in range(max(1, len(words) - shingle_size + 1))}
+    if not shingles:
+        return 0
+
+    # count the set bits in each column of the shingle hashes, zip does
+    # the column walk in C rather than 64 python ops per shingle
+    rows = [format(_hash64(s.encode('utf-8')), '064b') for s in shingles]
+    half = len(rows) / 2
+    fingerprint = 0
+    for column in zip(*rows):
+        fingerprint <<= 1
+        if column.count('1') > half:
+            fingerprint |= 1
+    return fingerprint
+
+
+class SimHashIndex(object):
+    '''finds fingerprints within `max_distance` bits of a query. the
+    fingerprint is cut into max_distance + 1 bands, two fingerprints that
+    close must agree on at least one whole band, so only the fingerprints
+    sharing a band are compared. the bands live in a sqlite table of `db`,
+    an in memory database by default'''
+    def __init__(self, max_distance=3, db=None):
+        self.max_distance = max_distance
+        num_bands = max_distance + 1
+        width = FINGERPRINT_BITS // num_bands
+        self._bands = []
+        for i in range(num_bands):
+            # the last band soaks up the remainder bits
+            bits = width if i < num_bands - 1 else FINGERPRINT_BITS - width * i
+            self._bands.append((width * i, (1 << bits) - 1))
+        self._db = db if db is not None else sqlite3.connect(':memory:')
+        self._db.execute('CREATE TABLE IF NOT EXISTS bands ('
+                         'band INTEGER, key INTEGER, fingerprint INTEGER, value TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS bands_key ON bands (band, key)')
+
+    def _keys(self, fingerprint):
+        return [(band, _signed((fingerprint >> shift) & mask))
+                for band, (shift, mask) in enumerate(self._bands)]
+
+    def find(self, fingerprint):
+        '''returns the value stored with a close fingerprint, or None'''
+        for band, key in self._keys(fingerprint):
+            for other, value in self._db.execute(
+                    'SELECT fingerprint, value FROM bands WHERE band = ? AND key = ?',
+                    (band, key)):
+                if bin(fingerprint ^ _unsigned(other)).count('1') <= self.max_distance:
+                    return value
+        return None
+
+    def add(self, fingerprint, value):
+        self._db.executemany(
+            'INSERT INTO bands (band, key, fingerprint, value) VALUES (?, ?, ?, ?)',
+            [(band, key, _signed(fingerprint), value) for band, key in self._keys(fingerprint)])
+
+
+class Deduper(object):
+    '''remembers the content of every page it has seen and spots exact and
+    near duplicates. `threshold` is the simhash similarity (fraction of
+    matching bits) at which two pages count as near duplicates, None only
+    detects exact duplicates.
+
+    the fingerprints are kept in a sqlite database at `path` (a temporary
+    file if None) rather than in ram. like seenset.SeenSet, inserts are
+    committed every `commit_every` pages, or with a commit_every of None
+    only by flush(), so a crawl can commit them with its checkpoint'''
+    def __init__(self, threshold=0.95, shingle_size=3, path=None, commit_every=1000):
+        self.shingle_size = shingle_size
+        self.commit_every = commit_every
+        self._tempfile = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='nlpcrawl-dedupe-', suffix='.db')
+            os.close(fd)
+            self._tempfile = path
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS exact (digest INTEGER PRIMARY KEY, url TEXT)')
+        self._near = None
+        if threshold is not None:
+            max_distance = int((1 - threshold) * FINGERPRINT_BITS)
+            self._near = SimHashIndex(max_distance, self._db)
+        self._db.commit()
+        self._uncommitted = 0
+
+    def check(self, url, text):
+        '''returns (kind, original url) if the text duplicates an earlier
+        page, otherwise records it and returns (None, None). a page
+        without a word of text (a frameset, a script-only shell) has
+        nothing to compare, it is never a duplicate nor recorded. neither
+        is a page matching an earlier fetch of the same url, e.g. one in
+        flight when a resumed crawl was stopped'''
+        if _word_re.search(text) is None:
+            return None, None
+        digest = _signed(exact_hash(text))
+        fingerprint = None
+        if self._near is not None:
+            fingerprint = simhash(text, self.shingle_size)
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url FROM exact WHERE digest = ?', (digest,)).fetchone()
+            if row is not None:
+                return (EXACT, row[0]) if row[0] != url else (None, None)
+            self._db.execute('INSERT INTO exact (digest, url) VALUES (?, ?)', (digest, url))
+
+            if fingerprint is not None:
+                original = self._near.find(fingerprint)
+                if original is not None and original != url:
+                    self._inserted()
+                    return NEAR, original
+                if original is None:
+                    self._near.add(fingerprint, url)
+            self._inserted()
+        return None, None
+
+    def _inserted(self):
+        self._uncommitted += 1
+        if self.commit_every is not None and self._uncommitted >= self.commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def flush(self):
+        '''commits pending inserts to disk'''
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        if self._db is None:
+            return
+        self.flush()
+        self._db.close()
+        self._db = None
+        if self._tempfile is not None:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self._tempfile + suffix)
+                except OSError:
+                    pass
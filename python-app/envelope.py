@@ -0,0 +1,138 @@
+import collections
+import json
+import struct
+import zlib
+import pika
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always there
+    zstandard = None
+
+# bumped whenever the layout below changes, consumers refuse newer ones
+ENVELOPE_VERSION = 1
+
+# bodies smaller than this aren't worth compressing
+COMPRESS_THRESHOLD = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# content type of a message packing several docs, see encode_batch
+BATCH_CONTENT_TYPE = 'application/vnd.nlpcrawl.batch'
+# (metadata length, body length) before each packed doc
+BATCH_RECORD = struct.Struct('<II')
+
+# headers describing the envelope itself, not the doc
+_ENVELOPE_HEADERS = ('envelope', 'batch_size')
+
+Message = collections.namedtuple('Message', ['headers', 'content_type', 'body'])
+
+
+def _compress(data, codec, threshold):
+    '''returns (data, content encoding), leaving data alone if it is small
+    or compression doesn't pay'''
+    if codec is None or threshold is None or len(data) < threshold:
+        return data, None
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    elif codec == 'zlib':
+        compressed = zlib.compress(data, ZLIB_LEVEL)
+    else:
+        raise ValueError('unknown codec {}'.format(codec))
+    if len(compressed) >= len(data):
+        return data, None
+    return compressed, codec
+
+
+def _decompress(data, content_encoding):
+    if not content_encoding:
+        return data
+    if content_encoding == 'zlib':
+        return zlib.decompress(data)
+    if content_encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed message but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('unknown content encoding {}'.format(content_encoding))
+
+
+def _to_bytes(body):
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+
+def _plain(value):
+    # amqp hands back undecodable strings as bytes
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+def encode(body, headers=None, content_type=None, codec='zlib',
+           threshold=COMPRESS_THRESHOLD):
+    '''wraps one doc, returns (body, properties) ready for basic_publish.
+    the metadata travels as amqp headers, str bodies are sent as utf-8 and
+    compressed with `codec` ('zlib', 'zstd' or None) once they reach
+    `threshold` bytes'''
+    data, content_encoding = _compress(_to_bytes(body), codec, threshold)
+    headers = dict(headers or {})
+    headers['envelope'] = ENVELOPE_VERSION
+    return data, pika.BasicProperties(content_type=content_type,
+                                      content_encoding=content_encoding,
+                                      headers=headers)
+
+
+def encode_batch(messages, codec='zlib', threshold=COMPRESS_THRESHOLD):
+    '''packs many small docs, given as Messages, into one message and
+    compresses the lot. returns (body, properties)'''
+    parts = []
+    for headers, content_type, body in messages:
+        meta = json.dumps({'headers': {k: _plain(v) for k, v in (headers or {}).items()},
+                           'content_type': content_type}).encode('utf-8')
+        body = _to_bytes(body)
+        parts.append(BATCH_RECORD.pack(len(meta), len(body)))
+        parts.append(meta)
+        parts.append(body)
+    data, content_encoding = _compress(b''.join(parts), codec, threshold)
+    return data, pika.BasicProperties(
+        content_type=BATCH_CONTENT_TYPE,
+        content_encoding=content_encoding,
+        headers={'envelope': ENVELOPE_VERSION, 'batch_size': len(messages)})
+
+
+def decode(properties, body):
+    '''unwraps a consumed message into a list of Messages with bytes
+    bodies. messages published before the envelope existed come back
+    as they are'''
+    headers = dict(properties.headers or {}) if properties is not None else {}
+    version = headers.get('envelope')
+    if version is None:
+        content_type = properties.content_type if properties is not None else None
+        return [Message(headers, content_type, body)]
+    if version > ENVELOPE_VERSION:
+        raise ValueError('unknown envelope version {}'.format(version))
+
+    data = _decompress(body, properties.content_encoding)
+    if properties.content_type != BATCH_CONTENT_TYPE:
+        for key in _ENVELOPE_HEADERS:
+            headers.pop(key, None)
+        return [Message(headers, properties.content_type, data)]
+
+    messages = []
+    offset = 0
+    view = memoryview(data)
+    while offset < len(data):
+        meta_length, body_length = BATCH_RECORD.unpack_from(data, offset)
+        offset += BATCH_RECORD.size
+        meta = json.loads(bytes(view[offset:offset + meta_length]).decode('utf-8'))
+        offset += meta_length
+        if offset + body_length > len(data):
+            raise ValueError('batch truncated in record {}'.format(len(messages)))
+        messages.append(Message(meta['headers'], meta['content_type'],
+                                bytes(view[offset:offset + body_length])))
+        offset += body_length
+    return messages
+
+
+def media_type(content_type):
+    '''the media type of a content type, without parameters'''
+    return (content_type or '').split(';')[0].strip().lower()
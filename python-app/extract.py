@@ -0,0 +1,107 @@
+import collections
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+try:
+    from lxml import etree
+except ImportError:  # fall back to the (slower) standard library parser
+    etree = None
+
+Page = collections.namedtuple('Page', ['links', 'text'])
+
+# elements whose text is never shown to a reader
+INVISIBLE = frozenset(['script', 'style', 'noscript', 'template'])
+
+
+class _Collector(object):
+    '''parser target gathering links, the <base> href and visible text in
+    one pass over the document'''
+    def __init__(self):
+        self.base = None
+        self.hrefs = []
+        self.text = []
+        self._hidden = 0
+
+    def start(self, tag, attrib):
+        tag = tag.lower()
+        if tag == 'a':
+            href = attrib.get('href')
+            if href:
+                self.hrefs.append(href)
+        elif tag == 'base' and self.base is None:
+            self.base = attrib.get('href')
+        elif tag in INVISIBLE:
+            self._hidden += 1
+
+    def end(self, tag):
+        if tag.lower() in INVISIBLE and self._hidden:
+            self._hidden -= 1
+
+    def data(self, data):
+        if not self._hidden:
+            self.text.append(data)
+
+    def close(self):
+        return self
+
+
+class _StdlibParser(HTMLParser):
+    '''adapts html.parser callbacks onto a _Collector'''
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def _collect(html):
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', 'replace')
+    collector = _Collector()
+    if not html.strip():
+        return collector
+    if etree is not None:
+        parser = etree.HTMLParser(target=collector)
+        parser.feed(html)
+        parser.close()
+    else:
+        parser = _StdlibParser(collector)
+        parser.feed(html)
+        parser.close()
+    return collector
+
+
+def extract_page(html, url=None):
+    '''parses the document once, returning its absolute links (resolved
+    against <base> or the page url) and its visible text'''
+    collector = _collect(html)
+
+    base = url or ''
+    if urlsplit(base).scheme == '' and base:
+        base = 'http://' + base.lstrip('/')
+    if collector.base:
+        base = urljoin(base, collector.base)
+
+    links = []
+    for href in collector.hrefs:
+        try:
+            links.append(urljoin(base, href.strip()))
+        except ValueError:
+            continue
+    return Page(links, ''.join(collector.text))
+
+
+def extract_text(html):
+    '''visible text of the document'''
+    return ''.join(_collect(html).text)
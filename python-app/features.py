@@ -0,0 +1,138 @@
+import os
+import struct
+import zlib
+import colorlog
+import numpy as np
+import scipy.sparse as sp
+
+from consumer import batch_consumer
+from envelope import encode
+from publisher import get_publisher
+
+logger = colorlog.getLogger('NLPCrawl')
+
+# version, n_features, nnz
+VECTOR_HEADER = struct.Struct('<BII')
+VECTOR_VERSION = 1
+VECTOR_CONTENT_TYPE = 'application/vnd.nlpcrawl.vector'
+
+
+def encode_vector(n_features, indices, data):
+    '''packs one sparse vector as a header, uint32 indices and float32
+    values'''
+    indices = np.asarray(indices, dtype='<u4')
+    data = np.asarray(data, dtype='<f4')
+    return (VECTOR_HEADER.pack(VECTOR_VERSION, n_features, len(indices))
+            + indices.tobytes() + data.tobytes())
+
+
+def decode_vector(body):
+    '''unpacks a vector made by encode_vector into (n_features, indices,
+    data)'''
+    version, n_features, nnz = VECTOR_HEADER.unpack_from(body)
+    if version != VECTOR_VERSION:
+        raise ValueError('unknown feature vector version {}'.format(version))
+    offset = VECTOR_HEADER.size
+    indices = np.frombuffer(body, dtype='<u4', count=nnz, offset=offset)
+    data = np.frombuffer(body, dtype='<f4', count=nnz, offset=offset + 4 * nnz)
+    return n_features, indices, data
+
+
+class HashingTfidf(object):
+    '''hashed bag of words with tf-idf weighting. tokens are hashed
+    straight to columns (crc32, stable across processes) so there is no
+    vocabulary, and document frequencies are updated with every batch so
+    idf never needs a pass over the whole corpus'''
+    def __init__(self, n_features=2 ** 20, sublinear_tf=True, state_path=None):
+        self.n_features = n_features
+        self.sublinear_tf = sublinear_tf
+        self.state_path = state_path
+        self.df = np.zeros(n_features, dtype=np.int64)
+        self.n_docs = 0
+        if state_path is not None and os.path.exists(state_path):
+            state = np.load(state_path)
+            if state['df'].shape == self.df.shape:
+                self.df = state['df']
+                self.n_docs = int(state['n_docs'])
+
+    def save(self):
+        '''writes the document frequencies to state_path'''
+        if self.state_path is None:
+            return
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = self.state_path + '.tmp.npz'
+        np.savez(tmp_path, df=self.df, n_docs=self.n_docs)
+        os.replace(tmp_path, self.state_path)
+
+    def counts(self, docs):
+        '''term counts of whitespace tokenised docs as a csr matrix'''
+        tokens = [doc.split() for doc in docs]
+        lengths = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(docs))
+        cols = np.fromiter(
+            (zlib.crc32(token.encode('utf-8')) for doc in tokens for token in doc),
+            dtype=np.uint32, count=int(lengths.sum()))
+        cols %= self.n_features
+        rows = np.repeat(np.arange(len(docs)), lengths)
+        counts = sp.csr_matrix(
+            (np.ones(len(cols), dtype=np.float32), (rows, cols)),
+            shape=(len(docs), self.n_features))
+        counts.sum_duplicates()
+        return counts
+
+    def transform(self, docs):
+        '''tf-idf vectors (l2 normalised csr rows) for a batch of docs,
+        folding the batch into the document frequencies first'''
+        x = self.counts(docs)
+        self.df += np.bincount(x.indices, minlength=self.n_features)
+        self.n_docs += len(docs)
+
+        if self.sublinear_tf:
+            np.log1p(x.data, out=x.data)
+        idf = np.log((1.0 + self.n_docs) / (1.0 + self.df[x.indices])) + 1.0
+        x.data *= idf.astype(np.float32)
+
+        # l2 normalise each row in place
+        norms = np.sqrt(np.asarray(x.multiply(x).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        x.data /= np.repeat(norms, np.diff(x.indptr)).astype(np.float32)
+        return x
+
+
+def extract_features(rabbitmq_host, doc_queue, feature_queue, n_features=2 ** 20,
+                     batch_size=256, batch_wait=0.5, prefetch=None,
+                     idle_timeout=None, state_path=None):
+    '''feature stage. cleaned docs are consumed in micro batches,
+    vectorised together and published to `feature_queue` as packed sparse
+    vectors (see encode_vector), one message per doc carrying the doc's
+    headers'''
+    logger.info("│ │ ├ Fetching docs from RabbitMQ...")
+
+    vectoriser = HashingTfidf(n_features, state_path=state_path)
+    consumer = batch_consumer(rabbitmq_host, doc_queue, batch_size, batch_wait,
+                              prefetch, idle_timeout, name='feature extractor')
+    publisher = get_publisher(rabbitmq_host)
+
+    for batch in consumer.batches():
+        batch, docs = consumer.decode(batch)
+        if not docs:
+            consumer.ack(batch)
+            continue
+        x = vectoriser.transform([doc.body.decode('utf-8', 'replace') for doc in docs])
+        on_confirm = consumer.ack_on_confirm(batch, x.shape[0])
+        for i, doc in enumerate(docs):
+            start, end = x.indptr[i], x.indptr[i + 1]
+            # the vectors don't compress, send them as they are
+            body, properties = encode(
+                encode_vector(n_features, x.indices[start:end], x.data[start:end]),
+                doc.headers, VECTOR_CONTENT_TYPE, codec=None)
+            publisher.publish(
+                feature_queue,
+                body,
+                properties=properties,
+                on_confirm=on_confirm
+            )
+        logger.debug("│ │ │ └ {} feature vectors queued for rabbitmq!".format(x.shape[0]))
+
+    vectoriser.save()
+    publisher.flush()
+    consumer.close()
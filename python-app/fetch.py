@@ -0,0 +1,117 @@
+import codecs
+import re
+import time
+
+try:
+    import chardet
+except ImportError:  # without it undeclared charsets fall back to utf-8
+    chardet = None
+
+from envelope import media_type
+
+# read size for streamed bodies
+CHUNK_SIZE = 64 * 1024
+
+# html we can parse, anything else is dropped after the headers
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+# how far into the body <meta charset> and chardet look
+SNIFF_BYTES = 4096
+CHARDET_BYTES = 64 * 1024
+
+_charset_param_re = re.compile(r'charset\s*=\s*["\']?\s*([\w:.-]+)', re.I)
+_meta_charset_re = re.compile(
+    br'<meta[^>]+?charset\s*=\s*["\']?\s*([\w:.-]+)', re.I)
+
+_UTF16_BOMS = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+_BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'),) + tuple((bom, 'utf-16') for bom in _UTF16_BOMS)
+
+
+class FetchAborted(Exception):
+    '''a response we don't want, `reason` says why'''
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def check_headers(headers, allowed_types=HTML_CONTENT_TYPES, max_size=None):
+    '''raises FetchAborted if the response isn't worth reading. a missing
+    Content-Type is let through and judged on the first chunk'''
+    content_type = media_type(headers.get('Content-Type'))
+    if content_type and allowed_types is not None and content_type not in allowed_types:
+        raise FetchAborted('content_type')
+    length = headers.get('Content-Length')
+    if max_size is not None and length and length.isdigit() and int(length) > max_size:
+        raise FetchAborted('too_large')
+
+
+class BodyBuffer(object):
+    '''collects a streamed body, enforcing the size cap and the request
+    deadline (a clock time) as chunks arrive. the first chunk is sniffed
+    so binaries served as (or without) text/html are dropped early'''
+    def __init__(self, max_size=None, deadline=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.deadline = deadline
+        self.clock = clock
+        self.size = 0
+        self._chunks = []
+
+    def feed(self, chunk):
+        '''adds a chunk, raises FetchAborted if reading should stop'''
+        if (not self._chunks and b'\x00' in chunk[:SNIFF_BYTES]
+                and not chunk.startswith(_UTF16_BOMS)):
+            # text has no nul bytes, utf-16 aside
+            raise FetchAborted('binary')
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise FetchAborted('too_large')
+        if self.deadline is not None and self.clock() > self.deadline:
+            raise FetchAborted('deadline')
+        self._chunks.append(chunk)
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+def _codec(name):
+    '''python's name for a charset label, None if it is unknown'''
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'ignore')
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+def detect_charset(content_type, body):
+    '''charset of a body: byte order mark, then the Content-Type charset,
+    then <meta charset> / http-equiv near the top, then chardet, then
+    utf-8'''
+    for bom, name in _BOMS:
+        if body.startswith(bom):
+            return name
+
+    match = _charset_param_re.search(content_type or '')
+    charset = _codec(match.group(1)) if match else None
+    if charset:
+        return charset
+
+    match = _meta_charset_re.search(body[:SNIFF_BYTES])
+    charset = _codec(match.group(1)) if match else None
+    if charset:
+        return charset
+
+    if chardet is not None and body:
+        guess = chardet.detect(body[:CHARDET_BYTES])
+        charset = _codec(guess.get('encoding'))
+        if charset and guess.get('confidence', 0) >= 0.5:
+            return charset
+    return 'utf-8'
+
+
+def decode_body(body, content_type=None):
+    '''returns (text, charset) for a downloaded body'''
+    charset = detect_charset(content_type, body)
+    return body.decode(charset, 'replace'), charset
@@ -0,0 +1,76 @@
+import re
+
+import ahocorasick
+
+# url rules starting with this are regular expressions, the rest substrings
+REGEX_PREFIX = 're:'
+
+
+class KeywordSet(object):
+    '''any-of substring matcher compiled up front into an aho-corasick
+    automaton, so a search is one pass over the text whatever the number
+    of keywords. `patterns` are regular expressions, compiled into one
+    regex searched after the automaton, their cost does grow with their
+    number'''
+    def __init__(self, keywords, ignore_case=False, patterns=()):
+        self.ignore_case = ignore_case
+        keywords = set(k.lower() if ignore_case else k for k in keywords if k)
+        patterns = list(patterns)
+        self._empty = not keywords and not patterns
+
+        self._automaton = None
+        if keywords:
+            self._automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                self._automaton.add_word(keyword, keyword)
+            self._automaton.make_automaton()
+        self._regex = None
+        if patterns:
+            self._regex = re.compile('|'.join('(?:{})'.format(p) for p in patterns),
+                                     re.IGNORECASE if ignore_case else 0)
+
+    def __bool__(self):
+        return not self._empty
+
+    def search(self, text):
+        '''True if any keyword (or pattern) occurs in the text'''
+        if self._automaton is not None:
+            haystack = text.lower() if self.ignore_case else text
+            for match in self._automaton.iter(haystack):
+                return True
+        if self._regex is not None:
+            return self._regex.search(text) is not None
+        return False
+
+
+class UrlFilter(object):
+    '''include / exclude rules for links. a rule is a substring of the
+    url, or a regular expression if it starts with "re:". a link is kept
+    if it matches an include rule and no exclude rule'''
+    def __init__(self, include, exclude=()):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+
+    @staticmethod
+    def _compile(rules):
+        rules = list(rules or ())
+        return KeywordSet([r for r in rules if not r.startswith(REGEX_PREFIX)],
+                          patterns=[r[len(REGEX_PREFIX):] for r in rules
+                                    if r.startswith(REGEX_PREFIX)])
+
+    def __call__(self, url):
+        return self.include.search(url) and not self.exclude.search(url)
+
+
+class ContentFilter(object):
+    '''include / exclude keywords for page text, case insensitive. with no
+    include keywords every page is included, pages with any exclude
+    keyword are dropped'''
+    def __init__(self, include=(), exclude=()):
+        self.include = KeywordSet(include or (), ignore_case=True)
+        self.exclude = KeywordSet(exclude or (), ignore_case=True)
+
+    def __call__(self, text):
+        if self.exclude.search(text):
+            return False
+        return not self.include or self.include.search(text)
@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import threading
+import time
+from urllib.parse import urlsplit
+
+# host states
+IDLE = 0
+READY = 1
+WAITING = 2
+
+
+class Frontier(object):
+    '''crawl frontier with a queue per host and a global priority order.
+
+    urls are only handed out for hosts whose politeness window is open,
+    i.e. at least `host_delay` seconds (or the host's entry in
+    `host_delays`) have passed since that host was last handed out. among
+    the open hosts the url with the lowest priority value wins'''
+    def __init__(self, host_delay=0.0, host_delays=None, clock=time.monotonic):
+        self.host_delay = host_delay
+        self.host_delays = host_delays or {}
+        self._clock = clock
+
+        # host -> heap of (priority, seq, url, depth)
+        self._queues = {}
+        # host -> IDLE / READY / WAITING
+        self._state = {}
+        # host -> time its politeness window opens
+        self._opens_at = {}
+        # heap of (priority, seq, host) for open hosts, may hold stale
+        # entries, get() checks them against _ready_key
+        self._ready = []
+        self._ready_key = {}
+        # heap of (opens_at, host) for hosts with urls but a closed window
+        self._waiting = []
+
+        self._seq = itertools.count()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def delay_for(self, host):
+        return self.host_delays.get(host, self.host_delay)
+
+    def put(self, url, priority=0, depth=0):
+        '''queues a url, lower priority values are crawled first'''
+        host = urlsplit(url).netloc
+        with self._lock:
+            queue = self._queues.setdefault(host, [])
+            heapq.heappush(queue, (priority, next(self._seq), url, depth))
+            self._size += 1
+
+            state = self._state.get(host, IDLE)
+            if state == IDLE:
+                opens_at = self._opens_at.get(host, 0)
+                if opens_at > self._clock():
+                    self._wait(host, opens_at)
+                else:
+                    self._make_ready(host)
+            elif state == READY and queue[0][1] != self._ready_key[host][1]:
+                # the new url beats the host's current best
+                self._make_ready(host)
+
+    def get(self):
+        '''returns the next (url, depth) that may be crawled now, or None'''
+        with self._lock:
+            now = self._clock()
+            while self._waiting and self._waiting[0][0] <= now:
+                opens_at, host = heapq.heappop(self._waiting)
+                if self._state.get(host) == WAITING:
+                    self._make_ready(host)
+
+            while self._ready:
+                priority, seq, host = heapq.heappop(self._ready)
+                if self._state.get(host) == READY and self._ready_key[host] == (priority, seq):
+                    break
+            else:
+                return None
+
+            queue = self._queues[host]
+            priority, seq, url, depth = heapq.heappop(queue)
+            self._size -= 1
+            del self._ready_key[host]
+
+            opens_at = now + self.delay_for(host)
+            self._opens_at[host] = opens_at
+            if queue:
+                if opens_at > now:
+                    self._wait(host, opens_at)
+                else:
+                    self._make_ready(host)
+            else:
+                del self._queues[host]
+                self._state[host] = IDLE
+            return url, depth
+
+    def next_ready_in(self):
+        '''seconds until a url can be handed out, None if the frontier is
+        empty'''
+        with self._lock:
+            if self._ready:
+                return 0
+            if not self._waiting:
+                return None
+            return max(0, self._waiting[0][0] - self._clock())
+
+    def items(self):
+        '''snapshot of every queued (url, priority, depth)'''
+        with self._lock:
+            return [(url, priority, depth)
+                    for queue in self._queues.values()
+                    for priority, seq, url, depth in queue]
+
+    def remove_hosts(self, predicate):
+        '''takes the queues of every host `predicate(host)` is true for out
+        of the frontier, returns their (url, priority, depth)'''
+        removed = []
+        with self._lock:
+            hosts = {h for h in self._queues if predicate(h)}
+            if not hosts:
+                return removed
+            for host in hosts:
+                queue = self._queues.pop(host)
+                removed.extend((url, priority, depth) for priority, seq, url, depth in queue)
+                self._size -= len(queue)
+                self._state[host] = IDLE
+                self._ready_key.pop(host, None)
+            # a waiting entry left behind would open the host early if it
+            # came back and had to wait again
+            self._ready = [entry for entry in self._ready if entry[2] not in hosts]
+            self._waiting = [entry for entry in self._waiting if entry[1] not in hosts]
+            heapq.heapify(self._ready)
+            heapq.heapify(self._waiting)
+        return removed
+
+    def _make_ready(self, host):
+        priority, seq = self._queues[host][0][:2]
+        self._state[host] = READY
+        self._ready_key[host] = (priority, seq)
+        heapq.heappush(self._ready, (priority, seq, host))
+
+    def _wait(self, host, opens_at):
+        self._state[host] = WAITING
+        heapq.heappush(self._waiting, (opens_at, host))
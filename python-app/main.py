@@ -1,11 +1,17 @@
 import pika
 import logging
 import colorlog
+import os
 import time
 import warnings
 
+import metrics
 from crawler import Crawler
+from async_crawler import AsyncCrawler
+from cluster import AsyncClusterCrawler, ClusterCrawler
 from cleaner import fetch_and_clean_html
+from features import extract_features
+from corpus import store_docs
 
 # filter warnings
 warnings.filterwarnings("ignore")
@@ -22,17 +28,25 @@ logger.addHandler(ch)
 # RabbitMQ settigns
 RABBITMQ_HOST = 'rabbitmq'
 
+# prometheus style metrics are served at http://<host>:METRICS_PORT/metrics
+METRICS_PORT = 9100
+
 # Queue Settings
 HTML_QUEUE = 'HTML_QUEUE'
 DOC_QUEUE = 'DOC_QUEUE'
 FEATURE_QUEUE = 'FEAT_QUEUE'
+CORPUS_QUEUE = 'CORPUS_QUEUE'
+
+# cleaned docs fan out to both the feature stage and the corpus store
+DOC_EXCHANGE = 'DOC_EXCHANGE'
 
 # Thread Settings
 NUM_CRAWL_THREAD = 8
-NUM_PARSE_THREAD = 1
+NUM_PARSE_THREAD = os.cpu_count()
 NUM_FEAT_THREAD = 1
 
-# crawler settings
+# crawler settings, backend is 'thread' or 'async'
+CRAWL_BACKEND = 'async'
 CRAWL_CONFIG = {
     'start_url': 'http://blog.schlerp.net',
     'include_urls': ['blog.schlerp.net'],
@@ -41,7 +55,49 @@ CRAWL_CONFIG = {
     'exclude_content': [],
     'num_threads': NUM_CRAWL_THREAD,
     'html_queue': HTML_QUEUE, 
-    'rabbitmq_host': RABBITMQ_HOST
+    'rabbitmq_host': RABBITMQ_HOST,
+    'seen_error_rate': 0.001,
+    'seen_memory_budget': 64 * 1024 * 1024,
+    'host_delay': 0.25,
+    'host_delays': {},
+    'state_path': '/usr/src/app/state',
+    'checkpoint_interval': 60,
+    'duplicate_threshold': 0.95,
+    'duplicate_action': 'drop',
+    'publish_text': False,
+    'message_codec': 'zlib',
+    'allowed_content_types': ('text/html', 'application/xhtml+xml'),
+    'max_body_size': 10 * 1024 * 1024,
+    'fetch_timeout': 5,
+    'fetch_deadline': 30,
+    'min_concurrency': 1,
+    'max_error_rate': 0.1,
+    'target_latency': None,
+    # main() runs the cleaner only once the crawl is over, so nothing would
+    # drain the html queue of a paused crawl. set a high water mark (e.g.
+    # 10000) when the cleaner runs alongside the crawler
+    'queue_high_water': None,
+    'queue_check_interval': 1.0,
+    'verbose': False
+}
+
+# extra settings for the async backend
+ASYNC_CRAWL_CONFIG = {
+    'concurrency': 1000,
+    'limit_per_host': 8,
+    'dns_cache_ttl': 300
+}
+
+# cluster mode, every python-app container crawls the hosts it owns and
+# routes the urls it finds for other hosts to their owners over rabbitmq
+CLUSTER_CONFIG = {
+    'enabled': False,
+    # names the node's durable url queue and its checkpoint, so it has to
+    # survive the container being recreated and differ between nodes
+    'node_id': os.environ.get('NLPCRAWL_NODE_ID'),
+    'heartbeat_interval': 1.0,
+    'member_timeout': 5.0,
+    'route_batch': 100
 }
 
 # cleaner settings
@@ -49,12 +105,36 @@ CLEAN_CONFIG = {
     'rabbitmq_host': RABBITMQ_HOST,
     'html_queue': HTML_QUEUE,
     'doc_queue': DOC_QUEUE,
-    'keep_numbers': True
+    'doc_exchange': DOC_EXCHANGE,
+    'keep_numbers': True,
+    'num_workers': NUM_PARSE_THREAD,
+    'batch_size': 64,
+    'idle_timeout': 30,
+    'codec': 'zlib',
+    'pack_docs': True
 }
 
 # feature settings
 FEATURE_CONFIG = {
-    
+    'rabbitmq_host': RABBITMQ_HOST,
+    'doc_queue': DOC_QUEUE,
+    'feature_queue': FEATURE_QUEUE,
+    'n_features': 2 ** 20,
+    'batch_size': 256,
+    'idle_timeout': 30,
+    'state_path': '/usr/src/app/state/features.npz'
+}
+
+# corpus store settings
+CORPUS_CONFIG = {
+    'rabbitmq_host': RABBITMQ_HOST,
+    'corpus_queue': CORPUS_QUEUE,
+    'corpus_path': '/usr/src/app/corpus',
+    'flush_docs': 10000,
+    'flush_interval': 30,
+    'idle_timeout': 30,
+    # the cleaner packs each of its batches into one message
+    'docs_per_message': CLEAN_CONFIG['batch_size'] if CLEAN_CONFIG['pack_docs'] else 1
 }
 
 
@@ -85,9 +165,19 @@ def setup():
     channel.queue_declare(queue=DOC_QUEUE)
 
     # declare the channel for cleaned docs
-    logger.debug(f'│ └ Creating features queue {FEATURE_QUEUE}')
+    logger.debug(f'│ ├ Creating features queue {FEATURE_QUEUE}')
     channel.queue_declare(queue=FEATURE_QUEUE)
 
+    # declare the channel feeding the corpus store
+    logger.debug(f'│ ├ Creating corpus queue {CORPUS_QUEUE}')
+    channel.queue_declare(queue=CORPUS_QUEUE)
+
+    # cleaned docs go to both the docs and corpus queues
+    logger.debug(f'│ └ Creating docs exchange {DOC_EXCHANGE}')
+    channel.exchange_declare(exchange=DOC_EXCHANGE, exchange_type='fanout')
+    channel.queue_bind(queue=DOC_QUEUE, exchange=DOC_EXCHANGE)
+    channel.queue_bind(queue=CORPUS_QUEUE, exchange=DOC_EXCHANGE)
+
     # close of the connection
     connection.close()
 
@@ -96,17 +186,48 @@ def main():
     '''calls the crawler, parser and cleaner scripts'''
     
     logger.info('├ Starting crawler!')
-    wiki_crawler = Crawler(**CRAWL_CONFIG)
-    wiki_crawler.crawl(max_pages=100)
+    if CLUSTER_CONFIG['enabled']:
+        node_id = CLUSTER_CONFIG['node_id']
+        if not node_id:
+            logger.error('├ Cluster mode needs a node id, set NLPCRAWL_NODE_ID')
+            return
+        cluster_config = {k: v for k, v in CLUSTER_CONFIG.items() if k != 'enabled'}
+        # each node checkpoints its own share of the crawl
+        crawl_config = dict(CRAWL_CONFIG, **cluster_config,
+                            state_path=os.path.join(CRAWL_CONFIG['state_path'], node_id))
+        if CRAWL_BACKEND == 'async':
+            wiki_crawler = AsyncClusterCrawler(**crawl_config, **ASYNC_CRAWL_CONFIG)
+        else:
+            wiki_crawler = ClusterCrawler(**crawl_config)
+    elif CRAWL_BACKEND == 'async':
+        wiki_crawler = AsyncCrawler(**CRAWL_CONFIG, **ASYNC_CRAWL_CONFIG)
+    else:
+        wiki_crawler = Crawler(**CRAWL_CONFIG)
+    try:
+        wiki_crawler.crawl(max_pages=100)
+    finally:
+        wiki_crawler.close()
+    if wiki_crawler.stopped:
+        # SIGTERM, the crawl is checkpointed and resumes on the next start
+        logger.info('├ Crawler stopped, skipping the other stages')
+        return
 
     logger.info('├ Starting cleaner!')
     fetch_and_clean_html(**CLEAN_CONFIG)
 
+    logger.info('├ Starting feature extractor!')
+    extract_features(**FEATURE_CONFIG)
+
+    logger.info('├ Storing corpus!')
+    store_docs(**CORPUS_CONFIG)
+
 
 if __name__ == '__main__':
     
     logger.info('Starting NLPCrawl!')
 
+    metrics.serve(METRICS_PORT)
+
     setup()
     
     main()
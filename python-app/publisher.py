@@ -0,0 +1,345 @@
+import atexit
+import collections
+import itertools
+import os
+import queue
+import threading
+import time
+import colorlog
+import pika
+
+import metrics
+
+logger = colorlog.getLogger('NLPCrawl')
+
+PUBLISH_SECONDS = metrics.histogram(
+    'nlpcrawl_publish_seconds', 'time from publish() to broker confirm by queue', ('queue',))
+
+
+class Publisher(object):
+    '''long lived rabbitmq publisher shared by the pipeline stages.
+
+    messages are handed to a background thread that owns one
+    SelectConnection, publishes them in batches and tracks publisher
+    confirms asynchronously. unconfirmed messages are republished after a
+    nack or a dropped connection. `publish` blocks once `max_pending`
+    messages are waiting, which pushes backpressure onto the caller when
+    the broker is slow or has blocked the connection'''
+    def __init__(self, rabbitmq_host, batch_size=100, max_pending=10000,
+                 max_unconfirmed=1000, flush_interval=0.05, reconnect_wait=3):
+        self.rabbitmq_host = rabbitmq_host
+        self.batch_size = batch_size
+        self.max_unconfirmed = max_unconfirmed
+        self.flush_interval = flush_interval
+        self.reconnect_wait = reconnect_wait
+
+        # messages waiting to be published, bounded for backpressure
+        self._pending = queue.Queue(max_pending)
+        # nacked or lost messages, republished before anything new
+        self._retry = collections.deque()
+        # delivery tag -> message, in publish order
+        self._unconfirmed = collections.OrderedDict()
+        self._delivery_tag = 0
+
+        # number of messages accepted by publish() but not yet confirmed
+        self._outstanding = 0
+        self._outstanding_cond = threading.Condition()
+
+        self._connection = None
+        self._channel = None
+        self._blocked = False
+        self._closing = False
+        # True while _drain has found nothing to do and isn't scheduled,
+        # publish() and nacks wake it up again
+        self._idle = False
+        self._idle_lock = threading.Lock()
+
+        # blocking connection of our own for queue_depth, opened on demand
+        self._probe = None
+        self._probe_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def publish(self, routing_key, body, exchange='', properties=None,
+                on_confirm=None, timeout=None):
+        '''queues a message for publishing. `on_confirm` is called from the
+        publisher thread once the broker has confirmed the message'''
+        with self._outstanding_cond:
+            self._outstanding += 1
+        try:
+            self._pending.put((exchange, routing_key, body, properties, on_confirm,
+                               time.perf_counter()), timeout=timeout)
+        except queue.Full:
+            self._confirmed(1)
+            raise
+        self._wake()
+
+    @property
+    def outstanding(self):
+        '''messages accepted by publish() and not confirmed yet'''
+        return self._outstanding
+
+    def flush(self, timeout=None):
+        '''waits until every queued message has been confirmed, returns
+        False if some still weren't after `timeout` seconds'''
+        with self._outstanding_cond:
+            return self._outstanding_cond.wait_for(
+                lambda: self._outstanding == 0, timeout)
+
+    def queue_depth(self, queue):
+        '''messages ready in `queue` on the broker, 0 if it doesn't exist
+        yet. asks with a passive queue_declare'''
+        with self._probe_lock:
+            try:
+                if self._probe is None or not self._probe.is_open:
+                    self._close_probe()
+                    self._probe = pika.BlockingConnection(pika.ConnectionParameters(self.rabbitmq_host))
+                # a fresh channel each time, the broker closes it if the queue is missing
+                channel = self._probe.channel()
+                try:
+                    return channel.queue_declare(queue, passive=True).method.message_count
+                finally:
+                    if channel.is_open:
+                        channel.close()
+            except pika.exceptions.ChannelClosedByBroker:
+                return 0
+            except pika.exceptions.AMQPError:
+                self._close_probe()
+                raise
+
+    def _close_probe(self):
+        probe, self._probe = self._probe, None
+        if probe is not None and probe.is_open:
+            try:
+                probe.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def close(self, timeout=None):
+        '''flushes outstanding messages and closes the connection'''
+        if self._closing:
+            return
+        self.flush(timeout)
+        self._closing = True
+        with self._probe_lock:
+            self._close_probe()
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception:
+                pass
+        self._thread.join(timeout)
+
+    def _confirmed(self, count):
+        with self._outstanding_cond:
+            self._outstanding -= count
+            self._outstanding_cond.notify_all()
+
+    def _run(self):
+        '''publisher thread, (re)connects until the publisher is closed'''
+        while not self._closing:
+            self._connection = pika.SelectConnection(
+                pika.ConnectionParameters(self.rabbitmq_host),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed
+            )
+            self._connection.ioloop.start()
+            if not self._closing:
+                time.sleep(self.reconnect_wait)
+
+    def _close_connection(self):
+        if self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        logger.debug("│ │ │ ├ publisher connected to rabbitmq at {}".format(self.rabbitmq_host))
+        connection.add_on_connection_blocked_callback(self._on_connection_blocked)
+        connection.add_on_connection_unblocked_callback(self._on_connection_unblocked)
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        logger.warning("│ │ │ ├ {}".format(error))
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if not self._closing:
+            logger.warning("│ │ │ ├ publisher connection closed: {}".format(reason))
+        self._channel = None
+        self._blocked = False
+        # anything still unconfirmed may never have reached the broker
+        self._retry.extendleft(reversed(list(self._unconfirmed.values())))
+        self._unconfirmed.clear()
+        connection.ioloop.stop()
+
+    def _on_connection_blocked(self, connection, method):
+        logger.warning("│ │ │ ├ rabbitmq blocked the publisher, pausing...")
+        self._blocked = True
+
+    def _on_connection_unblocked(self, connection, method):
+        logger.info("│ │ │ ├ rabbitmq unblocked the publisher, resuming...")
+        self._blocked = False
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        with self._idle_lock:
+            self._idle = False
+        self._connection.ioloop.call_later(0, self._drain)
+
+    def _on_channel_closed(self, channel, reason):
+        # reconnect from scratch, the connection close callback requeues
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = list(itertools.takewhile(
+                lambda tag: tag <= method.delivery_tag, self._unconfirmed))
+        elif method.delivery_tag in self._unconfirmed:
+            tags = [method.delivery_tag]
+        else:
+            tags = []
+
+        messages = [self._unconfirmed.pop(tag) for tag in tags]
+        if isinstance(method, pika.spec.Basic.Ack):
+            now = time.perf_counter()
+            for message in messages:
+                PUBLISH_SECONDS.observe(now - message[5], queue=message[1])
+                if message[4] is not None:
+                    message[4]()
+            self._confirmed(len(messages))
+        else:
+            logger.warning("│ │ │ ├ rabbitmq nacked {} messages, republishing...".format(len(messages)))
+            self._retry.extend(messages)
+            self._wake()
+
+    def _next_message(self):
+        if self._retry:
+            return self._retry.popleft()
+        return self._pending.get_nowait()
+
+    def _wake(self):
+        '''schedules _drain if it went idle, safe from any thread'''
+        with self._idle_lock:
+            if not self._idle:
+                return
+            connection = self._connection
+            try:
+                connection.ioloop.add_callback_threadsafe(self._drain)
+            except Exception:
+                # closed, the next channel open drains
+                return
+            self._idle = False
+
+    def _drain(self):
+        '''publishes up to one batch of messages then reschedules itself,
+        unless there was nothing to publish'''
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            return
+
+        published = 0
+        while (not self._blocked
+               and published < self.batch_size
+               and len(self._unconfirmed) < self.max_unconfirmed):
+            try:
+                message = self._next_message()
+            except queue.Empty:
+                break
+            exchange, routing_key, body, properties = message[:4]
+            channel.basic_publish(exchange, routing_key, body, properties)
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = message
+            published += 1
+
+        if not published and not self._blocked and len(self._unconfirmed) < self.max_unconfirmed:
+            with self._idle_lock:
+                # checked under the lock publish() wakes us with, so a
+                # message queued meanwhile isn't left waiting
+                if self._pending.empty() and not self._retry:
+                    self._idle = True
+                    return
+        # go again straight away if we filled a batch, otherwise idle a bit
+        delay = 0 if published == self.batch_size else self.flush_interval
+        self._connection.ioloop.call_later(delay, self._drain)
+
+
+class MemoryPublisher(object):
+    '''in-process stand-in for Publisher, used by benchmarks and offline
+    runs. messages land as (properties, body) in `queues`, keyed by routing
+    key, or by every queue bound to the exchange they were published to.
+    messages a consumer rejects go to `dead_letters`, keyed the same way'''
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.dead_letters = collections.defaultdict(collections.deque)
+        self.bindings = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        # notified on every publish, see consumer.MemoryBatchConsumer
+        self.arrived = threading.Condition(self._lock)
+
+    def bind(self, exchange, queue):
+        self.bindings[exchange].append(queue)
+
+    def publish(self, routing_key, body, exchange='', properties=None,
+                on_confirm=None, timeout=None):
+        if isinstance(body, str):
+            # pika sends str bodies as utf-8
+            body = body.encode('utf-8')
+        started = time.perf_counter()
+        queues = self.bindings.get(exchange, ()) if exchange else (routing_key,)
+        with self.arrived:
+            for queue_name in queues:
+                self.queues[queue_name].append((properties, body))
+            self.arrived.notify_all()
+        PUBLISH_SECONDS.observe(time.perf_counter() - started, queue=routing_key)
+        if on_confirm is not None:
+            on_confirm()
+
+    def queue_depth(self, queue):
+        return len(self.queues.get(queue, ()))
+
+    outstanding = 0
+
+    def flush(self, timeout=None):
+        return True
+
+    def close(self, timeout=None):
+        pass
+
+
+# rabbitmq_host that selects the in-memory publisher
+MEMORY_HOST = 'memory'
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(rabbitmq_host, **kwargs):
+    '''returns the publisher shared by this process for `rabbitmq_host`'''
+    key = (os.getpid(), rabbitmq_host)
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+        if publisher is None:
+            if rabbitmq_host == MEMORY_HOST:
+                publisher = MemoryPublisher()
+            else:
+                publisher = Publisher(rabbitmq_host, **kwargs)
+            _publishers[key] = publisher
+        return publisher
+
+
+@atexit.register
+def close_publishers(timeout=30):
+    '''flushes and closes every publisher owned by this process'''
+    with _publishers_lock:
+        publishers = [p for (pid, host), p in _publishers.items() if pid == os.getpid()]
+    for publisher in publishers:
+        publisher.close(timeout)
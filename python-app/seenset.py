@@ -0,0 +1,271 @@
+import array
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+
+from urls import normalize_url
+
+
+MASK64 = (1 << 64) - 1
+
+
+def url_key(url):
+    '''signed 64 bit hash of the normalised url, fits a sqlite integer'''
+    digest = hashlib.blake2b(normalize_url(url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def _host_hash(host):
+    digest = hashlib.blake2b(host.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class BloomFilter(object):
+    '''fixed size bloom filter over 64 bit integer keys'''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def _positions(self, key):
+        # double hashing, the second hash is the key with its halves swapped
+        h1 = key & MASK64
+        h2 = ((h1 >> 32) | (h1 << 32)) & MASK64 | 1
+        m = self.num_bits
+        return [(h1 + i * h2) % m for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    @classmethod
+    def restore(cls, capacity, error_rate, count, bits):
+        '''rebuilds a filter from a snapshot'''
+        f = cls(capacity, error_rate)
+        if len(bits) != len(f.bits):
+            raise ValueError('bloom filter snapshot does not match its parameters')
+        f.bits = bytearray(bits)
+        f.count = count
+        return f
+
+
+class ScalableBloomFilter(object):
+    '''chain of bloom filters that grows as it fills. each new filter is
+    `growth` times larger with a tighter error rate, so the compound false
+    positive rate stays near `error_rate`. once `memory_budget` bytes are
+    in use the last filter keeps absorbing keys and the false positive
+    rate degrades instead of memory growing'''
+    def __init__(self, capacity=1000000, error_rate=0.001,
+                 memory_budget=64 * 1024 * 1024, growth=2, tightening=0.5):
+        self.error_rate = error_rate
+        self.memory_budget = memory_budget
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = [BloomFilter(capacity, error_rate * (1 - tightening))]
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for f in self.filters)
+
+    def __contains__(self, key):
+        for f in reversed(self.filters):
+            if key in f:
+                return True
+        return False
+
+    def add(self, key):
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            grown = BloomFilter(last.capacity * self.growth,
+                                last.error_rate * self.tightening)
+            if self.nbytes + grown.nbytes <= self.memory_budget:
+                self.filters.append(grown)
+                last = grown
+        last.add(key)
+
+
+class SeenSet(object):
+    '''memory bounded set of urls. a scalable bloom filter answers most
+    lookups in ram and an exact sqlite table of url hashes on disk settles
+    the bloom filter's maybes, so there are no false positives.
+
+    inserts are committed every `commit_every` urls, or with a
+    commit_every of None only by snapshot() and flush(), for callers that
+    have to keep the set in step with other on-disk state.
+
+    urls can be tagged with their host, so the keys of one host can be
+    read back from disk, see host_keys()'''
+    def __init__(self, path=None, capacity=1000000, error_rate=0.001,
+                 memory_budget=64 * 1024 * 1024, commit_every=1000):
+        self._tempfile = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='nlpcrawl-seen-', suffix='.db')
+            os.close(fd)
+            self._tempfile = path
+        self.path = path
+        self.commit_every = commit_every
+
+        self._bloom = ScalableBloomFilter(capacity, error_rate, memory_budget)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen (key INTEGER PRIMARY KEY, host INTEGER)')
+        if 'host' not in [row[1] for row in self._db.execute('PRAGMA table_info(seen)')]:
+            # made before urls were tagged
+            self._db.execute('ALTER TABLE seen ADD COLUMN host INTEGER')
+        self._db.execute('CREATE INDEX IF NOT EXISTS seen_host ON seen (host)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hosts (hash INTEGER PRIMARY KEY, host TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS bloom ('
+                         'idx INTEGER PRIMARY KEY, capacity INTEGER, '
+                         'error_rate REAL, count INTEGER, bits BLOB)')
+        self._uncommitted = 0
+        # hashes of the hosts with tagged urls, far fewer than the urls
+        self._hosts = {h for (h,) in self._db.execute('SELECT hash FROM hosts')}
+
+        self._count = self._db.execute('SELECT count(*) FROM seen').fetchone()[0]
+        # keys committed after the last snapshot are missing from a restored
+        # bloom filter, until the next snapshot lookups always go to disk
+        self._bloom_complete = True
+        if self._count:
+            self._bloom_complete = self._restore_bloom()
+
+    def _on_disk(self, key):
+        return self._db.execute(
+            'SELECT 1 FROM seen WHERE key = ?', (key,)).fetchone() is not None
+
+    def _restore_bloom(self):
+        '''loads the bloom filter snapshot, returns True if it covers every
+        key on disk'''
+        rows = self._db.execute(
+            'SELECT capacity, error_rate, count, bits FROM bloom ORDER BY idx').fetchall()
+        if not rows:
+            # no snapshot, rebuild from the keys themselves
+            for (key,) in self._db.execute('SELECT key FROM seen'):
+                self._bloom.add(key)
+            return True
+        self._bloom.filters = [BloomFilter.restore(*row) for row in rows]
+        return sum(row[2] for row in rows) == self._count
+
+    def snapshot(self):
+        '''commits pending inserts and writes the bloom filter to disk, so a
+        restart doesn't have to rebuild it from every key'''
+        with self._lock:
+            self._db.execute('DELETE FROM bloom')
+            self._db.executemany(
+                'INSERT INTO bloom (idx, capacity, error_rate, count, bits) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(i, f.capacity, f.error_rate, f.count, bytes(f.bits))
+                 for i, f in enumerate(self._bloom.filters)])
+            self._db.commit()
+            self._uncommitted = 0
+            self._bloom_complete = True
+
+    def __contains__(self, url):
+        key = url_key(url)
+        with self._lock:
+            if self._bloom_complete and key not in self._bloom:
+                return False
+            return self._on_disk(key)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, url, host=None):
+        '''adds the url, tagged with `host` if given, returns False if it
+        had already been seen'''
+        return self.add_key(url_key(url), host)
+
+    def add_key(self, key, host=None):
+        '''add() for a url_key, e.g. one another crawler has seen'''
+        with self._lock:
+            if key in self._bloom and self._on_disk(key):
+                return False
+            # the insert settles it if a stale bloom filter missed the key
+            inserted = self._db.execute(
+                'INSERT OR IGNORE INTO seen (key, host) VALUES (?, ?)',
+                (key, self._host_id(host))).rowcount
+            if not inserted:
+                return False
+            self._bloom.add(key)
+            self._count += 1
+            self._uncommitted += 1
+            if self.commit_every is not None and self._uncommitted >= self.commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+        return True
+
+    def _host_id(self, host):
+        '''the hash urls of `host` are tagged with, None for no host'''
+        if host is None:
+            return None
+        h = _host_hash(host)
+        if h not in self._hosts:
+            self._db.execute('INSERT OR REPLACE INTO hosts (hash, host) VALUES (?, ?)', (h, host))
+            self._hosts.add(h)
+        return h
+
+    def tag(self, keys, host):
+        '''tags url keys already in the set with `host`'''
+        with self._lock:
+            h = self._host_id(host)
+            self._db.executemany('UPDATE seen SET host = ? WHERE key = ?',
+                                 ((h, key) for key in keys))
+
+    def hosts(self):
+        '''the hosts with tagged urls'''
+        with self._lock:
+            return [host for (host,) in self._db.execute('SELECT host FROM hosts')]
+
+    def host_keys(self, host):
+        '''the keys of the urls tagged with `host`, read from disk'''
+        with self._lock:
+            return array.array('q', (key for (key,) in self._db.execute(
+                'SELECT key FROM seen WHERE host = ?', (_host_hash(host),))))
+
+    def untag(self, host):
+        '''drops the `host` tag from its urls, which stay seen'''
+        h = _host_hash(host)
+        with self._lock:
+            self._db.execute('UPDATE seen SET host = NULL WHERE host = ?', (h,))
+            self._db.execute('DELETE FROM hosts WHERE hash = ?', (h,))
+            self._hosts.discard(h)
+
+    def flush(self):
+        '''commits pending inserts to disk'''
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        if self._db is None:
+            return
+        self.flush()
+        self._db.close()
+        self._db = None
+        if self._tempfile is not None:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self._tempfile + suffix)
+                except OSError:
+                    pass
@@ -0,0 +1,50 @@
+import os
+import sys
+from urllib.parse import urlsplit
+
+import pytest
+
+# the app is a flat set of modules next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_crawler import AsyncCrawler  # noqa: E402
+from crawler import Crawler  # noqa: E402
+from publisher import MEMORY_HOST, get_publisher  # noqa: E402
+
+
+@pytest.fixture
+def memory_publisher():
+    '''the in-memory publisher, emptied after the test'''
+    publisher = get_publisher(MEMORY_HOST)
+    yield publisher
+    publisher.queues.clear()
+    publisher.bindings.clear()
+    publisher.dead_letters.clear()
+
+# AsyncCrawler options the thread backend doesn't take
+ASYNC_ONLY = ('concurrency', 'limit_per_host', 'dns_cache_ttl')
+
+
+@pytest.fixture
+def make_crawler():
+    '''make_crawler(backend, start_url, **overrides) builds a 'thread' or
+    'async' crawler of start_url's host publishing to the in-memory
+    HTML_QUEUE, closed after the test. options only the async backend has
+    are dropped for the thread one'''
+    crawlers = []
+
+    def make(backend, start_url, **overrides):
+        config = dict(start_url=start_url, include_urls=[urlsplit(start_url).netloc],
+                      exclude_urls=[], include_content=[], exclude_content=[],
+                      num_threads=4, html_queue='HTML_QUEUE', rabbitmq_host=MEMORY_HOST)
+        config.update(overrides)
+        if backend == 'async':
+            crawler = AsyncCrawler(**config)
+        else:
+            crawler = Crawler(**{k: v for k, v in config.items() if k not in ASYNC_ONLY})
+        crawlers.append(crawler)
+        return crawler
+
+    yield make
+    for crawler in crawlers:
+        crawler.close()
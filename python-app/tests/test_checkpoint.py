@@ -0,0 +1,130 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+from crawler import Crawler
+from publisher import MEMORY_HOST
+
+APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_crawler(state_path, start_url='http://h.test/'):
+    return Crawler(start_url, ['h.test'], [], [], [], 1, 'HTML_QUEUE', MEMORY_HOST,
+                   state_path=state_path, checkpoint_interval=3600)
+
+
+def run(code, state_path):
+    return subprocess.Popen([sys.executable, '-c', textwrap.dedent(code), str(state_path)],
+                            cwd=APP, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def test_crash_after_checkpoint_loses_no_urls(tmp_path):
+    # urls found after the last checkpoint must not be marked seen on disk
+    # while missing from the saved frontier
+    process = run('''
+        import os, sys
+        from tests.test_checkpoint import make_crawler
+        c = make_crawler(sys.argv[1])
+        c._checkpoint(force=True)
+        for i in range(1500):
+            c._enqueue('http://h.test/p{}'.format(i), 1)
+        os._exit(0)
+    ''', tmp_path)
+    process.wait(60)
+
+    c = make_crawler(str(tmp_path))
+    assert 'http://h.test/p5' not in c._urls_seen
+    c._enqueue('http://h.test/p5', 1)
+    assert len(c._urls_to_crawl) == 2
+
+
+def test_crash_before_the_first_checkpoint_restarts_the_crawl(tmp_path):
+    process = run('''
+        import os, sys
+        from tests.test_checkpoint import make_crawler
+        make_crawler(sys.argv[1])
+        os._exit(0)
+    ''', tmp_path)
+    process.wait(60)
+
+    c = make_crawler(str(tmp_path))
+    assert c._urls_to_crawl.items() == [('http://h.test/', 0, 0)]
+    c.close()
+
+
+def test_resume_keeps_queued_urls(tmp_path):
+    c = make_crawler(str(tmp_path))
+    for i in range(10):
+        c._enqueue('http://h.test/p{}'.format(i), 1)
+    c._checkpoint(force=True)
+
+    resumed = make_crawler(str(tmp_path))
+    assert len(resumed._urls_to_crawl) == 11
+    assert 'http://h.test/p3' in resumed._urls_seen
+    resumed._enqueue('http://h.test/p3', 1)
+    assert len(resumed._urls_to_crawl) == 11
+
+
+def test_resume_remembers_published_pages(tmp_path):
+    page = ' '.join('word{}'.format(i) for i in range(400))
+    c = make_crawler(str(tmp_path))
+    assert c._deduper.check('http://h.test/a', page) == (None, None)
+    c._checkpoint(force=True)
+
+    resumed = make_crawler(str(tmp_path))
+    near = page.replace('word200', 'edited')
+    assert resumed._deduper.check('http://h.test/b', near) == ('near', 'http://h.test/a')
+    # the page itself, refetched after the resume, is not its own duplicate
+    assert resumed._deduper.check('http://h.test/a', page) == (None, None)
+    resumed.close()
+
+
+def test_sigterm_checkpoints(tmp_path):
+    from bench import SyntheticSite
+    site = SyntheticSite(50, fanout=3, page_size=256, latency=0.2).start()
+    try:
+        process = run('''
+            import sys
+            from crawler import Crawler
+            from publisher import MEMORY_HOST
+            c = Crawler({url!r}, ['127.0.0.'], [], [], [], 2, 'HTML_QUEUE', MEMORY_HOST,
+                        state_path=sys.argv[1], checkpoint_interval=3600)
+            print('crawling', flush=True)
+            c.crawl()
+            print('stopped' if c.stopped else 'finished', flush=True)
+        '''.format(url=site.url), tmp_path)
+        assert process.stdout.readline().strip() == b'crawling'
+        time.sleep(1.0)
+        process.send_signal(signal.SIGTERM)
+        output, _ = process.communicate(timeout=60)
+    finally:
+        site.stop()
+
+    assert output.strip().endswith(b'stopped')
+    resumed = Crawler(site.url, ['127.0.0.'], [], [], [], 2, 'HTML_QUEUE', MEMORY_HOST,
+                      state_path=str(tmp_path))
+    assert 0 < resumed._crawled_count < 50
+    assert len(resumed._urls_to_crawl) > 0
+
+
+def test_async_checkpoints_run_off_the_event_loop(tmp_path, memory_publisher, make_crawler):
+    from bench import SyntheticSite
+    site = SyntheticSite(20, fanout=3, page_size=256).start()
+    crawler = make_crawler('async', site.url, include_urls=['127.0.0.'],
+                           state_path=str(tmp_path), checkpoint_interval=0)
+    checkpoint = crawler._checkpoint
+    threads = []
+
+    def spy(force=False):
+        threads.append(threading.current_thread())
+        checkpoint(force)
+    crawler._checkpoint = spy
+    try:
+        crawler.crawl()
+    finally:
+        site.stop()
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,35 @@
+import unicodedata
+
+import nltk
+
+from cleaner import clean_text, strip_numbers, strip_punctuation, text_to_lowercase
+
+CORPUS = [
+    'The Quick Brown Fox jumps over the lazy dog.',
+    'Running, runners and RAN: stemming (mostly) works!',
+    'Prices rose 12.5% in 2019; 3rd-quarter results were [revised] on_line.',
+    'Café déjà vu, naïve façade, Ångström and the ﬁnancial œuvre.',
+    'Straße, Ελληνικά, 日本語 and emoji 🙂 fold away or vanish.',
+    "Don't split contractions' apostrophes \"oddly\" -- em—dashes…",
+    'tabs\tand\nnewlines   and    runs of spaces',
+    'UPPER lower MiXeD 42 x86_64 C++ #hashtag @mention http://example.com/a?b=c',
+    '',
+]
+
+
+def multi_pass_clean(text, keep_numbers=True):
+    '''the cleaner as it was before the steps were fused, one pass each'''
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ascii', 'ignore').decode('utf-8', 'ignore')
+    text = strip_punctuation(text)
+    if not keep_numbers:
+        text = strip_numbers(text)
+    text = text_to_lowercase(text)
+    stemmer = nltk.stem.SnowballStemmer('english')
+    return ' '.join([stemmer.stem(word) for word in text.split()])
+
+
+def test_clean_text_matches_the_multi_pass_cleaner():
+    for keep_numbers in (True, False):
+        for text in CORPUS:
+            assert clean_text(text, keep_numbers) == multi_pass_clean(text, keep_numbers), text
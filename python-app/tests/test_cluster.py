@@ -0,0 +1,192 @@
+import collections
+import json
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import pika
+
+import cluster
+from bench import SyntheticSite, _header
+from cluster import AmqpTransport, ClusterCrawler, MemoryNetwork, host_key
+from envelope import encode
+from publisher import MEMORY_HOST
+from seenset import url_key
+
+PAGES = 400
+HOSTS = 12
+HEARTBEAT = 0.1
+
+
+def node(site, network, i):
+    return ClusterCrawler(
+        start_url=site.url, include_urls=['127.0.0.'], exclude_urls=[],
+        include_content=[], exclude_content=[], num_threads=4,
+        html_queue='HTML_QUEUE', rabbitmq_host=MEMORY_HOST, seen_capacity=PAGES,
+        duplicate_action='tag', queue_high_water=None,
+        node_id='node-{}'.format(i), transport=network.transport(),
+        heartbeat_interval=HEARTBEAT, member_timeout=10 * HEARTBEAT)
+
+
+def test_every_page_published_as_nodes_join_and_leave(memory_publisher):
+    site = SyntheticSite(PAGES, fanout=5, page_size=512, latency=0.05, hosts=HOSTS).start()
+    network = MemoryNetwork()
+    nodes = [node(site, network, i) for i in range(3)]
+    threads = [threading.Thread(target=n.crawl) for n in nodes]
+    try:
+        threads[0].start()
+        threads[1].start()
+        # node-2 joins once the others are crawling, node-1 leaves with
+        # urls still queued, which the others take over
+        time.sleep(0.6)
+        threads[2].start()
+        time.sleep(0.6)
+        assert len(nodes[1]._urls_to_crawl) > 0
+        nodes[1].stop()
+        for thread in threads:
+            thread.join(60)
+            assert not thread.is_alive()
+    finally:
+        site.stop()
+
+    urls = [_header(properties, 'url') for properties, body in memory_publisher.queues['HTML_QUEUE']]
+    paths = {urlsplit(url).path for url in urls}
+    assert paths == {'/'} | {'/page/{}.html'.format(i) for i in range(PAGES)}
+    # node-2 took hosts over when it joined
+    assert nodes[2]._crawled_count > 0
+    # old owners hand over what they've seen with their hosts, only pages
+    # in flight while a host moves may be fetched twice
+    assert len(urls) < 1.05 * (PAGES + 1)
+
+
+def test_seen_urls_handed_over_after_a_restart(tmp_path):
+    network = MemoryNetwork()
+    other = network.inboxes['node-other'] = queue.Queue()
+    urls = ['http://h{}.test/p{}'.format(h, p) for h in range(20) for p in range(5)]
+
+    def restarted():
+        return ClusterCrawler(
+            start_url=urls[0], include_urls=['.test'], exclude_urls=[],
+            include_content=[], exclude_content=[], num_threads=1,
+            html_queue='HTML_QUEUE', rabbitmq_host=MEMORY_HOST, state_path=str(tmp_path),
+            node_id='node-0', transport=network.transport())
+
+    crawler = restarted()
+    for url in urls:
+        crawler._enqueue(url)
+    # crawled, so only the seen set on disk remembers them
+    crawler._urls_to_crawl.remove_hosts(lambda host: True)
+    crawler._checkpoint(force=True)
+    crawler.close()
+
+    crawler = restarted()
+    crawler._set_ring(lambda ring: ring.add('node-other'))
+    crawler._rebalance()
+    handed = set()
+    while not other.empty():
+        kind, message = other.get()
+        handed.update(message['seen'])
+    moved = {url_key(url) for url in urls if crawler._ring.owner(host_key(url)) == 'node-other'}
+    assert moved and handed == moved
+
+    # sent once, a later rebalance has nothing more to hand over
+    crawler._rebalance()
+    assert other.empty()
+    crawler.close()
+
+
+class FakeChannel(object):
+    '''the parts of a pika channel AmqpTransport uses'''
+    def __init__(self):
+        self.consumers = {}
+        self.acked = []
+        self.rejected = []
+        self.deleted = []
+        # (method, properties, body) left in the node's url queue
+        self.waiting = collections.deque()
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(queue=queue or 'amq.gen-members'))
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def basic_consume(self, queue, callback, auto_ack=False):
+        self.consumers[queue] = callback
+        return queue
+
+    def basic_cancel(self, tag):
+        pass
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected.append((delivery_tag, requeue))
+
+    def basic_get(self, queue):
+        return self.waiting.popleft() if self.waiting else (None, None, None)
+
+    def queue_delete(self, queue):
+        self.deleted.append(queue)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.fake_channel = FakeChannel()
+        # (queue, method, properties, body) to hand to the consumers
+        self.deliveries = queue.Queue()
+
+    def channel(self):
+        return self.fake_channel
+
+    def process_data_events(self, time_limit=0):
+        try:
+            name, method, properties, body = self.deliveries.get(timeout=time_limit)
+        except queue.Empty:
+            return
+        self.fake_channel.consumers[name](self.fake_channel, method, properties, body)
+
+    def close(self):
+        pass
+
+
+def url_batch(tag, message):
+    body, properties = encode(json.dumps(message), content_type='application/json')
+    return pika.spec.Basic.Deliver(delivery_tag=tag), properties, body
+
+
+def test_amqp_transport_rejects_bad_batches_and_keeps_its_queue(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(cluster, 'connect', lambda host: connection)
+    received = []
+    transport = AmqpTransport(MEMORY_HOST)
+    transport.start('node-0', received.append, lambda message: None)
+    url_queue = 'nlpcrawl.urls.node-0'
+
+    method, properties, body = url_batch(1, {'urls': []})
+    connection.deliveries.put((url_queue, method, properties, b'not an envelope'))
+    good = {'from': 'node-1', 'urls': [['http://h.test/', 0, 1]]}
+    connection.deliveries.put((url_queue,) + url_batch(2, good))
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # the bad batch didn't stop the consumer, nor will it come back
+    assert received == [good]
+    assert connection.fake_channel.rejected == [(1, False)]
+    assert connection.fake_channel.acked == [2]
+
+    leftover = {'from': 'node-1', 'urls': [['http://h.test/a', 1, 1]]}
+    connection.fake_channel.waiting.append(url_batch(3, leftover))
+    assert transport.stop() == [leftover]
+    # urls routed here after the node left wait for its next start
+    assert connection.fake_channel.deleted == []
@@ -0,0 +1,75 @@
+import os
+import shutil
+import threading
+
+from corpus import CorpusStore
+
+
+def test_add_flush_and_search(tmp_path):
+    store = CorpusStore(str(tmp_path), flush_docs=2)
+    ids = [store.add('the cat sat', url='http://a/1'),
+           store.add('the dog sat', url='http://a/2'),
+           store.add('a cat ran')]
+    store.flush()
+    assert ids == [0, 1, 2]
+    assert store.doc(1)['url'] == 'http://a/2'
+    assert list(store.search('cat', 'sat')) == [0]
+    assert list(store.term('sat')) == [0, 1]
+    store.close()
+
+    reopened = CorpusStore(str(tmp_path))
+    assert len(reopened) == 3
+    assert reopened.doc(2)['text'] == 'a cat ran'
+    reopened.close()
+
+
+def test_reads_during_merges(tmp_path):
+    # merges close and delete segments that readers may still be using
+    store = CorpusStore(str(tmp_path), flush_docs=5, max_segments=2, merge_factor=2)
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            try:
+                for doc_id, doc in store.iter_docs():
+                    assert doc['text'] == 'doc {}'.format(doc_id)
+                for doc_id in range(len(store)):
+                    store.doc(doc_id)
+                store.term('doc')
+            except Exception as e:
+                errors.append(e)
+                return
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for i in range(2000):
+        store.add('doc {}'.format(i))
+    store.flush()
+    stop.set()
+    for reader in readers:
+        reader.join()
+
+    assert not errors
+    assert len(store) == 2000
+    assert [store.doc(i)['text'] for i in (0, 999, 1999)] == ['doc 0', 'doc 999', 'doc 1999']
+    store.close()
+
+
+def test_reopen_after_a_crash_between_segment_and_manifest(tmp_path):
+    store = CorpusStore(str(tmp_path))
+    store.add('the cat sat')
+    store.flush()
+    store.close()
+    # a segment written, then a crash before the manifest listed it
+    shutil.copytree(str(tmp_path / 'seg-000000'), str(tmp_path / 'seg-000001'))
+    os.makedirs(str(tmp_path / 'seg-000002.tmp'))
+
+    store = CorpusStore(str(tmp_path))
+    store.add('the dog sat')
+    store.flush()
+    assert len(store) == 2
+    assert list(store.term('sat')) == [0, 1]
+    store.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['manifest.json', 'seg-000000', 'seg-000001']
@@ -0,0 +1,65 @@
+import os
+import time
+
+import pytest
+
+from bench import SyntheticSite, _header
+
+HTML_QUEUE = 'HTML_QUEUE'
+PAGES = 200
+# server latency per request, what the async backend overlaps
+LATENCY = 0.02
+
+
+@pytest.fixture(scope='module')
+def site():
+    site = SyntheticSite(PAGES, fanout=5, page_size=1024, latency=LATENCY).start()
+    yield site
+    site.stop()
+
+
+def crawl(crawler, memory_publisher, max_pages=None):
+    started = time.monotonic()
+    crawler.crawl(max_pages)
+    seconds = time.monotonic() - started
+    messages = memory_publisher.queues.pop(HTML_QUEUE, ())
+    return [_header(properties, 'url') for properties, body in messages], seconds
+
+
+def new_crawler(make_crawler, site, backend):
+    return make_crawler(backend, site.url, seen_capacity=PAGES, duplicate_action='tag',
+                        concurrency=50, limit_per_host=50)
+
+
+def test_backends_crawl_the_same_pages_async_faster(site, memory_publisher, make_crawler):
+    thread_urls, thread_seconds = crawl(new_crawler(make_crawler, site, 'thread'),
+                                        memory_publisher)
+    async_urls, async_seconds = crawl(new_crawler(make_crawler, site, 'async'),
+                                      memory_publisher)
+
+    # every page once, plus / which serves page 0 again
+    assert len(thread_urls) == len(set(thread_urls)) == PAGES + 1
+    assert set(async_urls) == set(thread_urls)
+    # four threads wait out LATENCY one page at a time each
+    assert async_seconds < thread_seconds
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+def test_max_pages(site, memory_publisher, make_crawler, backend):
+    urls, seconds = crawl(new_crawler(make_crawler, site, backend), memory_publisher,
+                          max_pages=20)
+    assert len(urls) == 20
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+def test_crawl_again_after_max_pages(site, memory_publisher, make_crawler, backend):
+    crawler = new_crawler(make_crawler, site, backend)
+    first, seconds = crawl(crawler, memory_publisher, max_pages=20)
+    rest, seconds = crawl(crawler, memory_publisher)
+    # the second crawl picks up the frontier the first one left
+    assert len(first) + len(rest) == PAGES + 1
+    assert not set(first) & set(rest)
+
+    seen_path = crawler._urls_seen.path
+    crawler.close()
+    assert not os.path.exists(seen_path)
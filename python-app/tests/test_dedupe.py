@@ -0,0 +1,74 @@
+import os
+import random
+
+from dedupe import EXACT, NEAR, Deduper, SimHashIndex, simhash
+
+
+def text(seed, words=400):
+    rng = random.Random(seed)
+    vocabulary = ['word{}'.format(i) for i in range(2000)]
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    deduper = Deduper()
+    page = text(0)
+    assert deduper.check('http://a/1', page) == (None, None)
+    assert deduper.check('http://a/2', '  ' + page.upper().replace(' ', '\n')) == (EXACT, 'http://a/1')
+
+
+def test_near_duplicates():
+    deduper = Deduper(threshold=0.85)
+    page = text(0)
+    words = page.split()
+    words[200] = 'edited'
+    edited = ' '.join(words)
+    assert bin(simhash(page) ^ simhash(edited)).count('1') <= 9
+    assert deduper.check('http://a/1', page) == (None, None)
+    assert deduper.check('http://a/2', edited) == (NEAR, 'http://a/1')
+    # unrelated text is far off
+    assert bin(simhash(page) ^ simhash(text(1))).count('1') > 20
+    assert deduper.check('http://a/3', text(1)) == (None, None)
+    # only exact duplicates without a threshold
+    assert Deduper(threshold=None).check('http://a/2', edited) == (None, None)
+
+
+def test_simhash_index_threshold():
+    # 0.95 of 64 bits similar is up to 3 bits apart
+    index = SimHashIndex(int((1 - 0.95) * 64))
+    index.add(0, 'zero')
+    assert index.find(0b111) == 'zero'
+    assert index.find(1 << 63 | 1 << 40 | 1 << 20) == 'zero'
+    assert index.find(0b1111) is None
+    assert index.find(1 << 63 | 1 << 40 | 1 << 20 | 1) is None
+
+
+def test_pages_without_text_are_not_duplicates():
+    deduper = Deduper()
+    assert deduper.check('http://a/1', '') == (None, None)
+    assert deduper.check('http://a/2', '   \n') == (None, None)
+    assert deduper.check('http://a/3', '') == (None, None)
+
+
+def test_fingerprints_persist_on_flush(tmp_path):
+    path = str(tmp_path / 'dedupe.db')
+    deduper = Deduper(path=path, commit_every=None)
+    deduper.check('http://a/1', text(0))
+    deduper.check('http://a/2', text(1))
+    deduper.flush()
+    deduper.check('http://a/3', text(2))
+    # a crash loses what wasn't flushed
+    deduper._db.close()
+
+    reopened = Deduper(path=path)
+    assert reopened.check('http://a/4', text(1)) == (EXACT, 'http://a/2')
+    assert reopened.check('http://a/5', text(2)) == (None, None)
+    reopened.close()
+
+
+def test_temporary_database_is_removed():
+    deduper = Deduper()
+    deduper.check('http://a/1', text(0))
+    deduper.close()
+    deduper.close()
+    assert not os.path.exists(deduper.path)
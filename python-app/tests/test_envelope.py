@@ -0,0 +1,101 @@
+import zlib
+
+import pika
+import pytest
+
+import envelope
+from envelope import (BATCH_CONTENT_TYPE, COMPRESS_THRESHOLD, ENVELOPE_VERSION, Message,
+                      decode, encode, encode_batch, media_type)
+
+SMALL = 'a short doc'
+LARGE = 'a long doc that compresses well ' * 100
+
+
+@pytest.mark.parametrize('body', [SMALL, LARGE, LARGE.encode('utf-8'), b''])
+def test_round_trip(body):
+    data, properties = encode(body, {'url': 'http://a/'}, 'text/plain')
+    # only bodies past the threshold are compressed
+    compressed = len(body) >= COMPRESS_THRESHOLD
+    assert properties.content_encoding == ('zlib' if compressed else None)
+    assert properties.headers == {'url': 'http://a/', 'envelope': ENVELOPE_VERSION}
+    expected = body.encode('utf-8') if isinstance(body, str) else body
+    assert decode(properties, data) == [Message({'url': 'http://a/'}, 'text/plain', expected)]
+
+
+def test_incompressible_bodies_are_sent_as_they_are():
+    body = bytes(range(256)) * 8
+    data, properties = encode(zlib.compress(body), codec='zlib')
+    assert properties.content_encoding is None
+    assert decode(properties, data)[0].body == zlib.compress(body)
+
+
+def test_newer_versions_are_rejected():
+    data, properties = encode(SMALL)
+    properties.headers['envelope'] = ENVELOPE_VERSION + 1
+    with pytest.raises(ValueError, match='version'):
+        decode(properties, data)
+
+
+def test_unknown_codecs_are_rejected():
+    with pytest.raises(ValueError, match='codec'):
+        encode(LARGE, codec='lz4')
+    data, properties = encode(LARGE)
+    properties.content_encoding = 'lz4'
+    with pytest.raises(ValueError, match='content encoding'):
+        decode(properties, data)
+    # and a body that doesn't decompress
+    properties.content_encoding = 'zlib'
+    with pytest.raises(zlib.error):
+        decode(properties, data[:len(data) // 2])
+
+
+def test_zstd_needs_zstandard(monkeypatch):
+    monkeypatch.setattr(envelope, 'zstandard', None)
+    with pytest.raises(ValueError, match='zstandard'):
+        encode(LARGE, codec='zstd')
+    properties = pika.BasicProperties(content_encoding='zstd',
+                                      headers={'envelope': ENVELOPE_VERSION})
+    with pytest.raises(ValueError, match='zstandard'):
+        decode(properties, b'\x28\xb5\x2f\xfd')
+
+
+def test_legacy_bare_bodies():
+    # published before the envelope existed, taken as they are
+    assert decode(None, b'<html>') == [Message({}, None, b'<html>')]
+    assert decode(pika.BasicProperties(), b'<html>') == [Message({}, None, b'<html>')]
+    properties = pika.BasicProperties(content_type='text/html', content_encoding='zlib',
+                                      headers={'url': 'http://a/'})
+    assert decode(properties, b'<html>') == [Message({'url': 'http://a/'}, 'text/html',
+                                                      b'<html>')]
+
+
+@pytest.mark.parametrize('codec', ['zlib', None])
+def test_batch_round_trip(codec):
+    messages = [Message({'url': 'http://a/1', 'depth': 2}, 'text/plain', LARGE),
+                Message({'url': b'http://a/\xff'}, 'text/html; charset=utf-8', b'<p>'),
+                Message(None, None, ''),
+                Message({}, 'text/plain', SMALL)]
+    data, properties = encode_batch(messages, codec)
+    assert properties.content_type == BATCH_CONTENT_TYPE
+    assert properties.content_encoding == codec
+    assert properties.headers == {'envelope': ENVELOPE_VERSION, 'batch_size': 4}
+    assert decode(properties, data) == [
+        Message({'url': 'http://a/1', 'depth': 2}, 'text/plain', LARGE.encode('utf-8')),
+        # amqp's bytes header values come back as text
+        Message({'url': 'http://a/�'}, 'text/html; charset=utf-8', b'<p>'),
+        Message({}, None, b''),
+        Message({}, 'text/plain', SMALL.encode('utf-8'))]
+
+    assert decode(*reversed(encode_batch([]))) == []
+
+
+def test_truncated_batches_are_rejected():
+    data, properties = encode_batch([Message({}, 'text/plain', SMALL)] * 3, codec=None)
+    with pytest.raises(ValueError, match='truncated'):
+        decode(properties, data[:-1])
+
+
+def test_media_type():
+    assert media_type('Text/HTML; charset=utf-8') == 'text/html'
+    assert media_type(' application/xhtml+xml ') == 'application/xhtml+xml'
+    assert media_type(None) == ''
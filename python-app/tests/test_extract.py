@@ -0,0 +1,107 @@
+from urllib.parse import urljoin, urlparse
+
+import pytest
+
+import extract
+from extract import extract_page, extract_text
+from urls import normalize_url
+
+PAGE = '''<!doctype html>
+<html><head><title>Title</title>
+<style>p { color: red }</style>
+<script>var hidden = "<a href='/script'>no</a>";</script>
+</head><body>
+<h1>Heading</h1>
+<p>Some <b>bold</b> text &amp; an entity.</p>
+<a href="/root">root</a>
+<a href="relative.html">relative</a>
+<a href="?q=1">query</a>
+<a href="#frag">fragment</a>
+<a href="http://other.test/abs">absolute</a>
+<a href="//proto.test/x">protocol relative</a>
+<A HREF="/upper">upper case</A>
+<a name="anchor">no href</a>
+<noscript>Enable javascript</noscript>
+<template><p>template</p></template>
+<div><a href="/nested"><span>nested</span></a></div>
+</body></html>'''
+
+
+@pytest.fixture(params=['lxml', 'stdlib'])
+def parser(request, monkeypatch):
+    '''runs a test with lxml and with the html.parser fallback'''
+    if request.param == 'stdlib':
+        monkeypatch.setattr(extract, 'etree', None)
+    elif extract.etree is None:
+        pytest.skip('lxml is not installed')
+    return request.param
+
+
+def old_links(html, url):
+    '''the crawler's link extraction before extract_page, which resolved
+    every href against the scheme and host of the page'''
+    from bs4 import BeautifulSoup
+    links = []
+    for a in BeautifulSoup(html, 'html.parser').find_all('a'):
+        try:
+            a = a.attrs['href']
+            parsed_url = urlparse(url)
+            if parsed_url.scheme == '':
+                parsed_url = parsed_url._replace(scheme='http')
+            base_url = parsed_url[0] + '://' + parsed_url[1]
+            a = urljoin(base_url, a)
+        except Exception:
+            continue
+        links.append(a)
+    return links
+
+
+def test_links_match_the_old_parser(parser):
+    pytest.importorskip('bs4')
+    # at the site root the page and its host resolve links the same
+    url = 'http://h.test/'
+    # the old one left out the path of ?query and #fragment links,
+    # 'http://h.test?q=1', which the frontier normalises away
+    assert ([normalize_url(a) for a in extract_page(PAGE, url).links]
+            == [normalize_url(a) for a in old_links(PAGE, url)])
+    assert extract_page(PAGE, url).links == [
+        'http://h.test/root', 'http://h.test/relative.html', 'http://h.test/?q=1',
+        'http://h.test/#frag', 'http://other.test/abs', 'http://proto.test/x',
+        'http://h.test/upper', 'http://h.test/nested']
+
+
+def test_links_resolve_against_the_page_and_base(parser):
+    links = extract_page(PAGE, 'http://h.test/dir/page.html').links
+    # unlike the old parser, relative links are relative to the page
+    assert links[:4] == ['http://h.test/root', 'http://h.test/dir/relative.html',
+                         'http://h.test/dir/page.html?q=1', 'http://h.test/dir/page.html#frag']
+
+    based = PAGE.replace('<head>', '<head><base href="http://cdn.test/static/">'
+                                   '<base href="http://ignored.test/">')
+    links = extract_page(based, 'http://h.test/dir/page.html').links
+    assert links[:2] == ['http://cdn.test/root', 'http://cdn.test/static/relative.html']
+    # a relative base is itself resolved against the page
+    based = PAGE.replace('<head>', '<head><base href="/other/">')
+    assert extract_page(based, 'http://h.test/dir/page.html').links[1] == \
+        'http://h.test/other/relative.html'
+    # a url without a scheme is taken as http
+    assert extract_page(PAGE, 'h.test/dir/').links[1] == 'http://h.test/dir/relative.html'
+
+
+def test_text_skips_scripts_and_styles(parser):
+    text = extract_page(PAGE, 'http://h.test/').text
+    words = text.split()
+    assert words[:8] == ['Title', 'Heading', 'Some', 'bold', 'text', '&', 'an', 'entity.']
+    for hidden in ('color', 'hidden', 'script', 'Enable', 'template'):
+        assert hidden not in text
+    assert 'nested' in words
+    assert extract_text(PAGE.encode('utf-8')) == text
+
+
+def test_empty_and_broken_documents(parser):
+    assert extract_page('', 'http://h.test/') == ([], '')
+    assert extract_page(b'  \n', 'http://h.test/') == ([], '')
+    # unclosed tags still give their links and text
+    page = extract_page('<p>one <a href="/a">two <script>x', 'http://h.test/')
+    assert page.links == ['http://h.test/a']
+    assert page.text.split() == ['one', 'two']
@@ -0,0 +1,103 @@
+import collections
+import math
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from features import VECTOR_HEADER, HashingTfidf, decode_vector, encode_vector
+
+
+def test_vector_round_trip():
+    indices = [0, 7, 2 ** 20 - 1]
+    data = [0.25, -1.5, 3.0]
+    body = encode_vector(2 ** 20, indices, data)
+    assert len(body) == VECTOR_HEADER.size + 8 * len(indices)
+    n_features, got_indices, got_data = decode_vector(body)
+    assert n_features == 2 ** 20
+    assert got_indices.tolist() == indices
+    assert got_data.tolist() == data
+
+    n_features, got_indices, got_data = decode_vector(encode_vector(16, [], []))
+    assert (n_features, len(got_indices), len(got_data)) == (16, 0, 0)
+
+
+def test_vector_rejects_unknown_versions():
+    body = encode_vector(16, [1], [1.0])
+    with pytest.raises(ValueError):
+        decode_vector(b'\x02' + body[1:])
+    with pytest.raises(struct.error):
+        decode_vector(body[:VECTOR_HEADER.size - 1])
+
+
+def column(token, n_features):
+    return zlib.crc32(token.encode('utf-8')) % n_features
+
+
+def reference_tfidf(docs, n_features, n_docs, df, sublinear_tf=True):
+    '''tf-idf of each doc by the book, one dict of column: value per doc'''
+    vectors = []
+    for doc in docs:
+        tf = collections.Counter(column(token, n_features) for token in doc.split())
+        weights = {}
+        for col, count in tf.items():
+            if sublinear_tf:
+                count = math.log1p(count)
+            weights[col] = count * (math.log((1 + n_docs) / (1 + df[col])) + 1)
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        vectors.append({col: w / norm for col, w in weights.items()})
+    return vectors
+
+
+def as_dicts(x):
+    return [dict(zip(x.indices[x.indptr[i]:x.indptr[i + 1]].tolist(),
+                     x.data[x.indptr[i]:x.indptr[i + 1]].tolist()))
+            for i in range(x.shape[0])]
+
+
+def assert_close(got, expected):
+    assert [sorted(v) for v in got] == [sorted(v) for v in expected]
+    for g, e in zip(got, expected):
+        for col in e:
+            assert g[col] == pytest.approx(e[col], rel=1e-5)
+
+
+@pytest.mark.parametrize('sublinear_tf', [True, False])
+def test_tfidf_values(sublinear_tf):
+    n_features = 2 ** 10
+    batches = [['the cat sat on the mat', 'the dog sat', ''],
+               ['a cat and a dog and a bird', 'the the the']]
+    vectoriser = HashingTfidf(n_features, sublinear_tf=sublinear_tf)
+    df = collections.Counter()
+    n_docs = 0
+    for docs in batches:
+        # the batch's own docs count towards the idf
+        for doc in docs:
+            df.update({column(token, n_features) for token in doc.split()})
+        n_docs += len(docs)
+        got = as_dicts(vectoriser.transform(docs))
+        assert_close(got, reference_tfidf(docs, n_features, n_docs, df, sublinear_tf))
+    assert vectoriser.n_docs == n_docs == 5
+    assert vectoriser.df.tolist() == [df[col] for col in range(n_features)]
+
+
+def test_colliding_tokens_share_a_column():
+    vectoriser = HashingTfidf(n_features=2)
+    counts = vectoriser.counts(['a b c d e f'])
+    assert counts.shape == (1, 2)
+    assert counts.sum() == 6
+    assert len(counts.indices) <= 2
+
+
+def test_document_frequencies_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'features' / 'df.npz')
+    vectoriser = HashingTfidf(2 ** 8, state_path=path)
+    vectoriser.transform(['one two', 'two three'])
+    vectoriser.save()
+
+    restarted = HashingTfidf(2 ** 8, state_path=path)
+    assert restarted.n_docs == 2
+    assert np.array_equal(restarted.df, vectoriser.df)
+    # a different width starts afresh
+    assert HashingTfidf(2 ** 9, state_path=path).n_docs == 0
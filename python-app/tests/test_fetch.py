@@ -0,0 +1,139 @@
+import codecs
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch
+from crawler import FETCH_ABORTED
+from fetch import BodyBuffer, FetchAborted, check_headers, decode_body, detect_charset
+
+MAX_BODY_SIZE = 1024
+PAGE = b'<html><body><p>' + b'words ' * 50 + b'</p></body></html>'
+
+
+class AbortHandler(BaseHTTPRequestHandler):
+    '''every path is a response the crawler should drop, see RESPONSES'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        content_type, body, length = RESPONSES[self.path]
+        self.send_response(200)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if length:
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            # no length to judge by, the body has to be read to find out
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # the crawler hung up
+
+    def log_message(self, *args):
+        pass
+
+
+# path: (content type, body, send a Content-Length)
+RESPONSES = {
+    '/content_type': ('image/png', b'\x89PNG\r\n\x1a\n' + b'\x00' * 64, True),
+    '/too_large': ('text/html', PAGE * 100, True),
+    '/too_large_unsized': ('text/html', PAGE * 100, False),
+    '/binary': (None, b'GIF89a\x01\x00\x01\x00\x00\x00\x00' + b'\x00' * 64, False),
+}
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AbortHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield '127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+@pytest.mark.parametrize('path', sorted(RESPONSES))
+def test_unwanted_responses_are_aborted(server, memory_publisher, make_crawler, backend, path):
+    reason = path[1:].replace('_unsized', '')
+    crawler = make_crawler(backend, 'http://{}{}'.format(server, path),
+                           max_body_size=MAX_BODY_SIZE)
+    aborted = FETCH_ABORTED.value(reason=reason)
+    crawler.crawl()
+    assert FETCH_ABORTED.value(reason=reason) == aborted + 1
+    assert not memory_publisher.queues['HTML_QUEUE']
+
+
+def test_check_headers():
+    check_headers({'Content-Type': 'text/html; charset=utf-8', 'Content-Length': '10'},
+                  max_size=10)
+    # judged on the body later
+    check_headers({})
+    # anything goes without a type list
+    check_headers({'Content-Type': 'application/pdf'}, allowed_types=None)
+    with pytest.raises(FetchAborted, match='content_type'):
+        check_headers({'Content-Type': 'application/pdf'})
+    with pytest.raises(FetchAborted, match='too_large'):
+        check_headers({'Content-Length': '11'}, max_size=10)
+
+
+def test_body_buffer_sniffs_only_the_first_chunk():
+    buffer = BodyBuffer()
+    buffer.feed(b'<html>')
+    buffer.feed(b'\x00')
+    assert buffer.getvalue() == b'<html>\x00'
+    # utf-16 text is full of nul bytes
+    BodyBuffer().feed(codecs.BOM_UTF16_LE + '<html>'.encode('utf-16-le'))
+    with pytest.raises(FetchAborted, match='binary'):
+        BodyBuffer().feed(b'PK\x03\x04\x00\x00')
+
+
+def test_body_buffer_caps_size_and_time():
+    buffer = BodyBuffer(max_size=10)
+    buffer.feed(b'x' * 10)
+    with pytest.raises(FetchAborted, match='too_large'):
+        buffer.feed(b'x')
+
+    now = [0]
+    buffer = BodyBuffer(deadline=5, clock=lambda: now[0])
+    buffer.feed(b'x')
+    now[0] = 6
+    with pytest.raises(FetchAborted, match='deadline'):
+        buffer.feed(b'x')
+
+
+def test_charset_detection_order():
+    latin = '<p>café crème</p>'.encode('latin-1')
+    meta = b'<meta charset="latin-1">' + latin
+    # a byte order mark beats everything
+    assert detect_charset('text/html; charset=latin-1', codecs.BOM_UTF8 + b'x') == 'utf-8-sig'
+    assert detect_charset(None, codecs.BOM_UTF16_BE + 'x'.encode('utf-16-be')) == 'utf-16'
+    # then the header, then <meta>
+    assert detect_charset('text/html; charset="ISO-8859-1"', meta) == 'iso8859-1'
+    assert detect_charset('text/html; charset=koi8-r', meta) == 'koi8-r'
+    assert detect_charset('text/html', meta) == 'iso8859-1'
+    assert detect_charset('text/html', b'<meta http-equiv="Content-Type" '
+                          b'content="text/html; charset=windows-1252">') == 'cp1252'
+
+
+def test_unknown_charsets_fall_back(monkeypatch):
+    body = 'naïve'.encode('utf-8')
+    # unknown labels are skipped, not fatal
+    assert detect_charset('text/html; charset=x-made-up',
+                          b'<meta charset="nope">' + body) == 'utf-8'
+    assert decode_body(b'', 'text/html; charset=bogus') == ('', 'utf-8')
+
+    # chardet's guess is used when it is confident
+    monkeypatch.setattr(fetch, 'chardet', type('chardet', (), {'detect': staticmethod(
+        lambda body: {'encoding': 'windows-1251', 'confidence': 0.9})}))
+    assert detect_charset('text/html', body) == 'cp1251'
+    monkeypatch.setattr(fetch, 'chardet', type('chardet', (), {'detect': staticmethod(
+        lambda body: {'encoding': 'windows-1251', 'confidence': 0.2})}))
+    assert detect_charset('text/html', body) == 'utf-8'
+
+    # and utf-8 without chardet, undecodable bytes are replaced
+    monkeypatch.setattr(fetch, 'chardet', None)
+    assert decode_body(b'caf\xe9', 'text/html') == ('caf�', 'utf-8')
@@ -0,0 +1,66 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawler import FETCH_ABORTED
+from throttle import AimdLimiter
+
+DEADLINE = 1
+# the server gives up dripping after this long, should a fetch not
+DRIP_SECONDS = 20
+
+
+class DripHandler(BaseHTTPRequestHandler):
+    '''sends the headers, then a byte every 0.1s: every read gets data
+    well inside the socket timeout, so only the deadline ends the fetch'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'<html><body>')
+        self.wfile.flush()
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < DRIP_SECONDS:
+                self.wfile.write(b'.')
+                self.wfile.flush()
+                time.sleep(0.1)
+        except OSError:
+            pass  # the crawler hung up
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DripHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield '127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+def test_slow_drip_hits_the_deadline(server, memory_publisher, make_crawler, monkeypatch,
+                                     backend):
+    crawler = make_crawler(backend, 'http://{}/'.format(server), num_threads=2,
+                           fetch_timeout=5, fetch_deadline=DEADLINE)
+    aborted = FETCH_ABORTED.value(reason='deadline')
+    recorded = []
+    monkeypatch.setattr(AimdLimiter, 'record',
+                        lambda self, latency, failed=False: recorded.append(failed))
+    started = time.monotonic()
+    crawler.crawl()
+
+    assert time.monotonic() - started < DEADLINE + 1
+    assert not memory_publisher.queues['HTML_QUEUE']
+    assert FETCH_ABORTED.value(reason='deadline') == aborted + 1
+    # an abort, not a failure the limiter backs off from
+    assert not recorded
@@ -0,0 +1,61 @@
+import random
+import timeit
+
+from filters import ContentFilter, KeywordSet, UrlFilter
+
+
+def test_keyword_set():
+    keywords = KeywordSet(['cat', 'category', 'dog', 'a.b'])
+    assert keywords.search('the category page')
+    assert keywords.search('hotdogs')
+    # keywords are literal, not regular expressions
+    assert keywords.search('x a.b y') and not keywords.search('aXb')
+    assert not keywords.search('a bird')
+    assert not KeywordSet([]) and not KeywordSet([]).search('anything')
+
+
+def test_url_filter_substrings_and_regexes():
+    f = UrlFilter(['en.wikipedia.org', r're:^https://docs\.[a-z]+\.org/'])
+    assert f('https://en.wikipedia.org/wiki/Cat')
+    assert f('https://docs.python.org/3/')
+    assert not f('http://docs.python.org/3/')
+    assert not f('https://de.wikipedia.org/wiki/Katze')
+
+
+def test_url_filter_exclude_overrides_include():
+    f = UrlFilter(['wikipedia.org'], ['action=edit', r're:/wiki/(?:File|Special):'])
+    assert f('https://en.wikipedia.org/wiki/Cat')
+    assert not f('https://en.wikipedia.org/w/index.php?title=Cat&action=edit')
+    assert not f('https://en.wikipedia.org/wiki/Special:Random')
+    # no include rules, nothing is kept
+    assert not UrlFilter([])('https://en.wikipedia.org/wiki/Cat')
+
+
+def test_content_filter_ignores_case():
+    f = ContentFilter(['Machine Learning'], ['LOREM'])
+    assert f('an intro to machine learning')
+    assert f('MACHINE LEARNING at scale')
+    assert not f('machine learning, lorem ipsum')
+    assert not f('deep nets')
+    # no include keywords, everything not excluded is kept
+    assert ContentFilter([], ['spam'])('Hello')
+    assert not ContentFilter([], ['spam'])('SPAM offer')
+
+
+def test_search_cost_does_not_grow_with_keywords():
+    rng = random.Random(0)
+    text = ' '.join(''.join(rng.choice('abcdefghij') for _ in range(6))
+                    for _ in range(20000))
+
+    def seconds(keywords, ignore_case):
+        keyword_set = KeywordSet(keywords, ignore_case=ignore_case)
+        # nothing matches, so every search scans the whole text
+        assert not keyword_set.search(text)
+        return min(timeit.repeat(lambda: keyword_set.search(text), number=3, repeat=5))
+
+    many = ['{}z{}'.format(i, ''.join(rng.choice('abcdefghij') for _ in range(6)))
+            for i in range(5000)]
+    # a trie regex took 250 times as long for the 5000, the automaton only
+    # gets less cache friendly
+    for ignore_case in (False, True):
+        assert seconds(many, ignore_case) < 5 * seconds(many[:1], ignore_case)
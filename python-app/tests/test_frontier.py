@@ -0,0 +1,74 @@
+from frontier import Frontier
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_priority_order_across_hosts():
+    frontier = Frontier()
+    frontier.put('http://a.test/deep', priority=2, depth=2)
+    frontier.put('http://b.test/top', priority=0, depth=0)
+    frontier.put('http://a.test/mid', priority=1, depth=1)
+    assert [frontier.get() for _ in range(3)] == [
+        ('http://b.test/top', 0), ('http://a.test/mid', 1), ('http://a.test/deep', 2)]
+    assert frontier.get() is None and len(frontier) == 0
+
+
+def test_per_host_delay():
+    clock = Clock()
+    frontier = Frontier(host_delay=1.0, host_delays={'slow.test': 5.0}, clock=clock)
+    for url in ['http://a.test/1', 'http://a.test/2', 'http://slow.test/1', 'http://slow.test/2']:
+        frontier.put(url)
+
+    first = {frontier.get()[0], frontier.get()[0]}
+    assert first == {'http://a.test/1', 'http://slow.test/1'}
+    # both hosts were just crawled
+    assert frontier.get() is None
+    assert frontier.next_ready_in() == 1.0
+
+    clock.now += 1.0
+    assert frontier.get() == ('http://a.test/2', 0)
+    assert frontier.get() is None
+    assert frontier.next_ready_in() == 4.0
+
+    clock.now += 4.0
+    assert frontier.get() == ('http://slow.test/2', 0)
+    assert frontier.next_ready_in() is None
+
+
+def test_delay_holds_after_the_host_queue_empties():
+    clock = Clock()
+    frontier = Frontier(host_delay=2.0, clock=clock)
+    frontier.put('http://a.test/1')
+    assert frontier.get() == ('http://a.test/1', 0)
+    frontier.put('http://a.test/2')
+    assert frontier.get() is None
+    clock.now += 2.0
+    assert frontier.get() == ('http://a.test/2', 0)
+
+
+def test_removed_host_keeps_its_delay_when_added_back():
+    clock = Clock()
+    frontier = Frontier(host_delay=2.0, clock=clock)
+    frontier.put('http://a.test/1')
+    frontier.put('http://a.test/2')
+    assert frontier.get() == ('http://a.test/1', 0)
+    # a.test is waiting until 102 when it is handed to another node
+    assert frontier.remove_hosts(lambda host: host == 'a.test') == [('http://a.test/2', 0, 0)]
+    assert frontier.next_ready_in() is None
+
+    clock.now += 2.0
+    frontier.put('http://a.test/3')
+    frontier.put('http://a.test/4')
+    assert frontier.get() == ('http://a.test/3', 0)
+    # the wait from before the removal must not cut this one short
+    clock.now += 1.0
+    assert frontier.get() is None
+    assert frontier.next_ready_in() == 1.0
+    clock.now += 1.0
+    assert frontier.get() == ('http://a.test/4', 0)
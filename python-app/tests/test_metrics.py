@@ -0,0 +1,77 @@
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Registry
+
+
+def test_render_text_format():
+    registry = Registry()
+    pages = registry.counter('test_pages_total', 'pages by outcome', ('outcome',))
+    pages.inc(outcome='stored')
+    pages.inc(2, outcome='dropped')
+    registry.gauge('test_queue_size', 'queued urls').set_function(lambda: 7)
+    seconds = registry.histogram('test_seconds', 'time per fetch', ('host',),
+                                 buckets=(0.5, 0.1, 1))
+    seconds.observe(0.1, host='a')  # upper bounds are inclusive
+    seconds.observe(0.75, host='a')
+    seconds.observe(3, host='a')
+    seconds.observe(0.2, host='b')
+
+    assert registry.render() == '\n'.join([
+        '# HELP test_pages_total pages by outcome',
+        '# TYPE test_pages_total counter',
+        'test_pages_total{outcome="dropped"} 2',
+        'test_pages_total{outcome="stored"} 1',
+        '# HELP test_queue_size queued urls',
+        '# TYPE test_queue_size gauge',
+        'test_queue_size 7',
+        '# HELP test_seconds time per fetch',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{host="a",le="0.1"} 1',
+        'test_seconds_bucket{host="a",le="0.5"} 1',
+        'test_seconds_bucket{host="a",le="1"} 2',
+        'test_seconds_bucket{host="a",le="+Inf"} 3',
+        'test_seconds_count{host="a"} 3',
+        'test_seconds_sum{host="a"} 3.85',
+        'test_seconds_bucket{host="b",le="0.1"} 0',
+        'test_seconds_bucket{host="b",le="0.5"} 1',
+        'test_seconds_bucket{host="b",le="1"} 1',
+        'test_seconds_bucket{host="b",le="+Inf"} 1',
+        'test_seconds_count{host="b"} 1',
+        'test_seconds_sum{host="b"} 0.2',
+    ]) + '\n'
+
+
+def test_render_escapes_labels_and_help():
+    registry = Registry()
+    registry.counter('test_escaped_total', 'a \\ and\na "quote"', ('path',)).inc(
+        path='C:\\dir\n"x"')
+    assert registry.render().splitlines() == [
+        '# HELP test_escaped_total a \\\\ and\\na "quote"',
+        '# TYPE test_escaped_total counter',
+        'test_escaped_total{path="C:\\\\dir\\n\\"x\\""} 1',
+    ]
+
+
+def test_registry_returns_the_same_metric():
+    registry = Registry()
+    counter = registry.counter('test_total', 'help')
+    assert registry.counter('test_total', 'help') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('test_total', 'help')
+
+
+def test_serve():
+    registry = Registry()
+    registry.counter('test_served_total', 'help').inc()
+    server = metrics.serve(0, '127.0.0.1', registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert b'test_served_total 1\n' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
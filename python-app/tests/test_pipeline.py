@@ -0,0 +1,113 @@
+import pytest
+
+import corpus
+
+from bench import SyntheticSite, _header
+from cleaner import fetch_and_clean_html
+from corpus import CorpusStore, store_docs
+from envelope import ENVELOPE_VERSION, Message, decode, encode, encode_batch
+from features import extract_features
+from publisher import MEMORY_HOST
+
+PAGES = 30
+# every service drains its queue, then stops
+CONSUMING = {'batch_size': 8, 'batch_wait': 0.05, 'idle_timeout': 0.2}
+
+
+def test_services_over_memory_queues(memory_publisher, make_crawler, tmp_path):
+    memory_publisher.bind('DOC_EXCHANGE', 'DOC_QUEUE')
+    memory_publisher.bind('DOC_EXCHANGE', 'CORPUS_QUEUE')
+    site = SyntheticSite(PAGES, fanout=3, page_size=512).start()
+    try:
+        make_crawler('thread', site.url, seen_capacity=PAGES).crawl()
+    finally:
+        site.stop()
+    urls = {_header(properties, 'url')
+            for properties, body in memory_publisher.queues['HTML_QUEUE']}
+
+    fetch_and_clean_html(MEMORY_HOST, 'HTML_QUEUE', 'DOC_QUEUE', num_workers=2,
+                         doc_exchange='DOC_EXCHANGE', **CONSUMING)
+    docs = [doc for properties, body in memory_publisher.queues['DOC_QUEUE']
+            for doc in decode(properties, body)]
+    extract_features(MEMORY_HOST, 'DOC_QUEUE', 'FEAT_QUEUE', 2 ** 10, **CONSUMING)
+    store_docs(MEMORY_HOST, 'CORPUS_QUEUE', str(tmp_path), **CONSUMING)
+
+    # / serves page 0 again and is dropped as a duplicate
+    assert len(docs) == len(urls) == PAGES
+    assert len(memory_publisher.queues['FEAT_QUEUE']) == PAGES
+    # everything consumed was acked, nothing went back
+    for queue in ('HTML_QUEUE', 'DOC_QUEUE', 'CORPUS_QUEUE'):
+        assert not memory_publisher.queues[queue]
+    store = CorpusStore(str(tmp_path))
+    assert len(store) == PAGES
+    store.close()
+
+
+@pytest.mark.parametrize('service', ['cleaner', 'features', 'corpus'])
+def test_undecodable_messages_are_dead_lettered(memory_publisher, tmp_path, service):
+    html = '<html><body><p>{}</p></body></html>'.format('some words here ' * 100)
+    good = [encode(html, {'url': 'http://site/{}'.format(i)}, 'text/html') for i in range(3)]
+    body, properties = encode(html, {'url': 'http://site/corrupt'}, 'text/html')
+    assert properties.content_encoding == 'zlib'
+    corrupt = (body[:len(body) // 2], properties)
+    body, properties = encode(html, {'url': 'http://site/future'}, 'text/html')
+    properties.headers['envelope'] = ENVELOPE_VERSION + 1
+    future = (body, properties)
+    for body, properties in [good[0], corrupt, good[1], future, good[2]]:
+        memory_publisher.publish('IN_QUEUE', body, properties=properties)
+
+    if service == 'cleaner':
+        fetch_and_clean_html(MEMORY_HOST, 'IN_QUEUE', 'OUT_QUEUE', num_workers=1, **CONSUMING)
+    elif service == 'features':
+        extract_features(MEMORY_HOST, 'IN_QUEUE', 'OUT_QUEUE', 2 ** 10, **CONSUMING)
+    else:
+        store_docs(MEMORY_HOST, 'IN_QUEUE', str(tmp_path), **CONSUMING)
+
+    # the good messages went through and were acked, the bad ones are
+    # out of the queue for good instead of being redelivered
+    assert not memory_publisher.queues['IN_QUEUE']
+    assert [body for properties, body in memory_publisher.dead_letters['IN_QUEUE']] == [
+        corrupt[0], future[0]]
+    if service == 'corpus':
+        store = CorpusStore(str(tmp_path))
+        assert len(store) == 3
+        store.close()
+    else:
+        assert len(memory_publisher.queues['OUT_QUEUE']) == 3
+
+
+def test_corpus_flushes_by_docs_not_messages(memory_publisher, tmp_path, monkeypatch):
+    # the cleaner packs docs, 4 to a message here
+    for i in range(6):
+        body, properties = encode_batch([
+            Message({'url': 'http://site/{}/{}'.format(i, j)}, 'text/plain', 'some words')
+            for j in range(4)])
+        memory_publisher.publish('CORPUS_QUEUE', body, properties=properties)
+
+    # messages unacked each time the sink acks
+    unacked = []
+    consumers = []
+    batch_consumer = corpus.batch_consumer
+
+    def spying_consumer(*args, **kwargs):
+        consumer = batch_consumer(*args, **kwargs)
+        ack = consumer.ack
+
+        def spy(batch):
+            unacked.append(len(consumer._unacked))
+            return ack(batch)
+        consumer.ack = spy
+        consumers.append(consumer)
+        return consumer
+    monkeypatch.setattr(corpus, 'batch_consumer', spying_consumer)
+
+    store_docs(MEMORY_HOST, 'CORPUS_QUEUE', str(tmp_path), batch_size=2, batch_wait=0.05,
+               flush_docs=8, flush_interval=60, idle_timeout=0.2, docs_per_message=4)
+
+    # 8 docs are two messages, acked as soon as they are flushed
+    assert consumers[0]._prefetch == 4
+    assert unacked and max(unacked) <= 2
+    assert not memory_publisher.queues['CORPUS_QUEUE']
+    store = CorpusStore(str(tmp_path))
+    assert len(store) == 24
+    store.close()
@@ -0,0 +1,141 @@
+import queue
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from consumer import BatchAcker
+from publisher import Publisher
+
+
+class FakeIoLoop(object):
+    def __init__(self):
+        # callbacks waiting to run, as (delay, callback)
+        self.scheduled = []
+
+    def call_later(self, delay, callback):
+        self.scheduled.append((delay, callback))
+
+    def add_callback_threadsafe(self, callback):
+        self.scheduled.append((0, callback))
+
+    def run(self):
+        '''runs what is scheduled now, not what that schedules'''
+        scheduled, self.scheduled = self.scheduled, []
+        for delay, callback in scheduled:
+            callback()
+
+
+class FakeChannel(object):
+    is_open = True
+
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(body)
+
+
+class OfflinePublisher(Publisher):
+    '''a Publisher with a fake channel in place of its connection thread'''
+    def _run(self):
+        pass
+
+    def connect(self):
+        self._connection = SimpleNamespace(ioloop=FakeIoLoop(), is_open=True)
+        self._channel = FakeChannel()
+        return self._connection.ioloop, self._channel
+
+
+def confirm(publisher, kind, delivery_tag, multiple=False):
+    publisher._on_delivery_confirmation(
+        SimpleNamespace(method=kind(delivery_tag=delivery_tag, multiple=multiple)))
+
+
+def test_acks_confirm_in_order_and_nacks_are_republished_first():
+    publisher = OfflinePublisher('broker')
+    ioloop, channel = publisher.connect()
+    confirmed = []
+    for body in (b'a', b'b', b'c', b'd'):
+        publisher.publish('Q', body, on_confirm=lambda body=body: confirmed.append(body))
+    publisher._drain()
+    assert channel.published == [b'a', b'b', b'c', b'd']
+    assert list(publisher._unconfirmed) == [1, 2, 3, 4]
+
+    confirm(publisher, pika.spec.Basic.Ack, 2, multiple=True)
+    assert confirmed == [b'a', b'b'] and publisher.outstanding == 2
+    confirm(publisher, pika.spec.Basic.Nack, 3)
+    confirm(publisher, pika.spec.Basic.Ack, 4)
+    assert confirmed == [b'a', b'b', b'd'] and publisher.outstanding == 1
+
+    publisher.publish('Q', b'e')
+    publisher._drain()
+    assert channel.published[4:] == [b'c', b'e']
+
+
+def test_lost_connection_requeues_unconfirmed_ahead_of_retries():
+    publisher = OfflinePublisher('broker')
+    ioloop, channel = publisher.connect()
+    for body in (b'a', b'b', b'c'):
+        publisher.publish('Q', body)
+    publisher._drain()
+    confirm(publisher, pika.spec.Basic.Nack, 1)
+
+    publisher._on_connection_closed(SimpleNamespace(ioloop=SimpleNamespace(stop=lambda: None)),
+                                    'gone')
+    ioloop, channel = publisher.connect()
+    publisher._drain()
+    # b and c were sent before a was nacked, they go first again
+    assert channel.published == [b'b', b'c', b'a']
+    assert publisher.outstanding == 3
+
+
+def test_publish_timeout_leaves_nothing_outstanding():
+    publisher = OfflinePublisher('broker', max_pending=1)
+    publisher.publish('Q', b'a')
+    with pytest.raises(queue.Full):
+        publisher.publish('Q', b'b', timeout=0.01)
+    assert publisher.outstanding == 1
+    assert not publisher.flush(timeout=0.01)
+
+
+def test_drain_idles_until_there_is_something_to_publish():
+    publisher = OfflinePublisher('broker')
+    ioloop, channel = publisher.connect()
+    publisher._drain()
+    # nothing queued, so nothing scheduled
+    assert ioloop.scheduled == []
+
+    publisher.publish('Q', b'a')
+    assert len(ioloop.scheduled) == 1
+    ioloop.run()
+    assert channel.published == [b'a']
+    # it keeps going while there may be more, then idles again
+    ioloop.run()
+    assert ioloop.scheduled == []
+
+    # a nack wakes it too
+    confirm(publisher, pika.spec.Basic.Nack, 1)
+    ioloop.run()
+    assert channel.published == [b'a', b'a']
+
+
+def test_batch_acker_acks_in_delivery_order():
+    acked = []
+    acker = BatchAcker(acked.append)
+    first = acker.add(5, 2)
+    second = acker.add(9, 1)
+    second()
+    # the earlier batch still waits for a confirm
+    assert acked == []
+    first()
+    assert acked == []
+    first()
+    assert acked == [9] and acker.pending() == 0
+
+    # a batch with nothing published is acked once it is at the front
+    third = acker.add(12, 1)
+    acker.add(14, 0)
+    assert acked == [9]
+    third()
+    assert acked == [9, 14]
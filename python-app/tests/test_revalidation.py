@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawler import PAGES
+
+# /0 links to /1 and so on, /2 links nowhere
+PATHS = ['/0', '/1', '/2']
+
+
+class EtagHandler(BaseHTTPRequestHandler):
+    '''serves PATHS with an ETag, and 304 to a matching If-None-Match'''
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path not in PATHS:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(self.path[1:])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        i = PATHS.index(self.path)
+        link = '<a href="{}">next</a>'.format(PATHS[i + 1]) if i + 1 < len(PATHS) else ''
+        body = '<html><body><p>page {} {}</p>{}</body></html>'.format(
+            i, 'words ' * 50, link).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EtagHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield '127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+def test_recrawl_follows_cached_links_of_unchanged_pages(server, memory_publisher,
+                                                         make_crawler, tmp_path, backend):
+    def crawl():
+        crawler = make_crawler(backend, 'http://{}/0'.format(server), num_threads=2,
+                               state_path=str(tmp_path))
+        crawler.crawl()
+        crawler.close()
+        return len(memory_publisher.queues.pop('HTML_QUEUE', ()))
+
+    assert crawl() == len(PATHS)
+    EtagHandler.requests.clear()
+    unchanged = PAGES.value(outcome='unchanged')
+
+    # every page answers 304, its links come from the validator cache
+    assert crawl() == 0
+    assert sorted(EtagHandler.requests) == PATHS
+    assert PAGES.value(outcome='unchanged') == unchanged + len(PATHS)
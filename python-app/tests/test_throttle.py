@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from bench import SyntheticSite
+from throttle import AimdLimiter
+
+PAGES = 60
+
+
+def test_queue_is_watched_off_the_caller():
+    depth = [0]
+    probe = threading.Event()
+    changes = []
+
+    def queue_depth():
+        # a slow broker
+        probe.wait()
+        return depth[0]
+
+    limiter = AimdLimiter(8, queue_depth=queue_depth, high_water=10, low_water=5,
+                          check_interval=0.01)
+    started = time.monotonic()
+    limiter.start(on_change=lambda: changes.append(limiter.paused))
+    # the caller only ever reads what the watcher last saw
+    assert limiter.limit == 1 and not limiter.paused
+    assert time.monotonic() - started < 0.1
+
+    depth[0] = 20
+    probe.set()
+    deadline = time.monotonic() + 5
+    while not changes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert changes == [True] and limiter.limit == 0
+
+    depth[0] = 3
+    while len(changes) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    limiter.stop()
+    assert changes == [True, False] and limiter.limit > 0
+
+
+@pytest.mark.parametrize('backend', ['thread', 'async'])
+def test_paused_crawl_resumes_as_the_queue_drains(memory_publisher, make_crawler, backend):
+    site = SyntheticSite(PAGES, fanout=3, page_size=512).start()
+    crawler = make_crawler(backend, site.url, seen_capacity=PAGES, queue_high_water=10,
+                           queue_low_water=2, queue_check_interval=0.02)
+
+    drained = []
+    paused = []
+    done = threading.Event()
+
+    def drain():
+        # a cleaner slower than the crawler
+        while not done.is_set():
+            paused.append(crawler._limiter is not None and crawler._limiter.paused)
+            queue = memory_publisher.queues['HTML_QUEUE']
+            if queue:
+                drained.append(queue.popleft())
+            time.sleep(0.03)
+
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+    try:
+        crawler.crawl()
+    finally:
+        done.set()
+        drainer.join()
+        site.stop()
+
+    assert any(paused)
+    assert len(drained) + len(memory_publisher.queues['HTML_QUEUE']) == PAGES
@@ -0,0 +1,34 @@
+from seenset import SeenSet
+from urls import normalize_url
+
+
+def test_normalize_url():
+    assert normalize_url('HTTP://Example.COM/a/b') == 'http://example.com/a/b'
+    # fragments and default ports go, other ports stay
+    assert normalize_url('http://example.com/a#top') == 'http://example.com/a'
+    assert normalize_url('http://example.com:80/a') == 'http://example.com/a'
+    assert normalize_url('https://example.com:443/a') == 'https://example.com/a'
+    assert normalize_url('https://example.com:80/a') == 'https://example.com:80/a'
+    # trailing slashes, but the root path is always there
+    assert normalize_url('http://example.com/a/') == 'http://example.com/a'
+    assert normalize_url('http://example.com') == 'http://example.com/'
+    # query parameters are sorted, blank values kept
+    assert (normalize_url('http://example.com/s?q=cat&a=1&b=') ==
+            normalize_url('http://example.com/s?b=&a=1&q=cat') ==
+            'http://example.com/s?a=1&b=&q=cat')
+    # paths are case sensitive
+    assert normalize_url('http://example.com/A') != normalize_url('http://example.com/a')
+
+
+def test_seen_set_dedupes_normalised_urls(tmp_path):
+    seen = SeenSet(str(tmp_path / 'seen.db'), capacity=100, commit_every=None)
+    assert seen.add('http://example.com/a?x=1&y=2')
+    assert not seen.add('HTTP://example.com:80/a/?y=2&x=1#frag')
+    assert 'http://example.com/a?y=2&x=1' in seen
+    assert 'http://example.com/b' not in seen
+    seen.close()
+
+    reopened = SeenSet(str(tmp_path / 'seen.db'), capacity=100)
+    assert len(reopened) == 1
+    assert not reopened.add('http://example.com/a?x=1&y=2')
+    reopened.close()
@@ -0,0 +1,146 @@
+import threading
+import colorlog
+
+import metrics
+
+logger = colorlog.getLogger('NLPCrawl')
+
+CONCURRENCY = metrics.gauge('nlpcrawl_crawl_concurrency', 'fetches the crawler may have in flight')
+QUEUE_DEPTH = metrics.gauge(
+    'nlpcrawl_downstream_queue_messages', 'messages waiting in the html queue, as last checked')
+PAUSED = metrics.gauge('nlpcrawl_crawl_paused', '1 while the html queue is over its high water mark')
+
+# how far the best round latency may drift up per round, so the limiter
+# follows a site that got slower for good instead of starving it
+BASELINE_DRIFT = 1.05
+
+
+class AimdLimiter(object):
+    '''decides how many fetches may be in flight, additive increase /
+    multiplicative decrease like tcp congestion control.
+
+    every fetch reports its latency and whether it failed. once a round of
+    about `limit` fetches has finished the limit is adjusted: halved when
+    more than `max_error_rate` of them failed or their mean latency passed
+    `latency_tolerance` times the best recent round (or `target_latency`
+    if given), otherwise raised by one. rounds quicker than
+    `latency_floor` seconds are never too slow. it doubles instead
+    until the first cut (slow start), and only grows while the crawler
+    actually uses it.
+
+    the depth of the downstream queue, checked every `check_interval`
+    seconds on a thread of its own between start() and stop(), holds the
+    limit where it is above `low_water` and pauses fetching altogether
+    above `high_water`, until the queue is back under `low_water`. a
+    `high_water` of None turns all that off. something has to drain the
+    queue while the crawl runs, or a paused crawl waits for good'''
+    def __init__(self, max_limit, min_limit=1, queue_depth=None,
+                 high_water=10000, low_water=None, check_interval=1.0,
+                 max_error_rate=0.1, latency_tolerance=2.0, target_latency=None,
+                 latency_floor=0.05):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.queue_depth = queue_depth
+        self.high_water = high_water
+        if low_water is None and high_water is not None:
+            low_water = high_water // 2
+        self.low_water = low_water
+        self.check_interval = check_interval
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.target_latency = target_latency
+        self.latency_floor = latency_floor
+
+        self._limit = float(self.min_limit)
+        self._slow_start = True
+        self._baseline = None
+        self._used = False
+        self._lock = threading.Lock()
+        self._round = [0, 0, 0.0]  # fetches, failures, total latency
+
+        self.depth = 0
+        self.paused = False
+        self._watcher = None
+        self._stopped = threading.Event()
+        CONCURRENCY.set(self.limit)
+
+    @property
+    def limit(self):
+        '''fetches allowed in flight right now, 0 while paused'''
+        return 0 if self.paused else int(self._limit)
+
+    def record(self, latency, failed=False):
+        '''reports one finished fetch, safe from any thread'''
+        with self._lock:
+            self._round[0] += 1
+            self._round[1] += failed
+            self._round[2] += latency
+            if self._round[0] < max(int(self._limit), 1):
+                return
+            fetches, failures, total = self._round
+            self._round = [0, 0, 0.0]
+            self._adjust(failures / fetches, total / fetches)
+
+    def saturated(self):
+        '''tells the limiter the crawler had as many fetches in flight as
+        it allows, so growing the limit would make a difference'''
+        self._used = True
+
+    def _adjust(self, error_rate, latency):
+        self._baseline = latency if self._baseline is None else min(
+            latency, self._baseline * BASELINE_DRIFT)
+        target = max(self.latency_floor,
+                     self.target_latency or self._baseline * self.latency_tolerance)
+        if error_rate > self.max_error_rate or latency > target:
+            self._slow_start = False
+            self._limit = max(self.min_limit, self._limit / 2)
+        elif self._used and (self.low_water is None or self.depth <= self.low_water):
+            step = self._limit if self._slow_start else 1
+            self._limit = min(self.max_limit, self._limit + step)
+        self._used = False
+        CONCURRENCY.set(int(self._limit))
+
+    def start(self, on_change=None):
+        '''starts watching the downstream queue, off the crawler's threads
+        so a slow broker never holds them up. `on_change` is called from
+        the watcher whenever fetching pauses or resumes'''
+        if self.queue_depth is None or self.high_water is None:
+            return
+        self._stopped.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(on_change,),
+                                         name='queue-watcher', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        '''stops watching, without waiting more than a check_interval for a
+        slow look at the queue to return'''
+        self._stopped.set()
+        if self._watcher is not None:
+            self._watcher.join(self.check_interval)
+            self._watcher = None
+
+    def _watch(self, on_change):
+        while not self._stopped.is_set():
+            if self.check() and on_change is not None:
+                on_change()
+            self._stopped.wait(self.check_interval)
+
+    def check(self):
+        '''looks at the downstream queue, returns True if that paused or
+        resumed fetching'''
+        try:
+            self.depth = self.queue_depth()
+        except Exception as e:
+            logger.warning('│ │ ├ checking the html queue failed: {!r}'.format(e))
+            return False
+        QUEUE_DEPTH.set(self.depth)
+
+        was_paused = self.paused
+        if not self.paused and self.depth >= self.high_water:
+            logger.info('│ │ ├ {} pages waiting downstream, pausing...'.format(self.depth))
+            self.paused = True
+        elif self.paused and self.depth <= self.low_water:
+            logger.info('│ │ ├ {} pages waiting downstream, resuming...'.format(self.depth))
+            self.paused = False
+        PAUSED.set(int(self.paused))
+        return self.paused != was_paused
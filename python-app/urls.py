@@ -0,0 +1,29 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    '''returns the canonical form of a url, used as its dedupe key. the
+    scheme and host are lower cased, default ports, fragments and trailing
+    slashes are dropped and query parameters are sorted'''
+    parts = urlsplit(url.strip())
+    scheme = (parts.scheme or 'http').lower()
+
+    netloc = parts.netloc.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and DEFAULT_PORTS.get(scheme) == port:
+        netloc = netloc.rsplit(':', 1)[0]
+
+    path = parts.path or '/'
+    if len(path) > 1 and path.endswith('/'):
+        path = path.rstrip('/') or '/'
+
+    query = parts.query
+    if query:
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, netloc, path, query, ''))
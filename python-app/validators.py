@@ -0,0 +1,71 @@
+import collections
+import hashlib
+import sqlite3
+import threading
+import zlib
+
+from urls import normalize_url
+
+Entry = collections.namedtuple('Entry', ['etag', 'last_modified', 'content_hash', 'links'])
+
+
+def content_hash(text):
+    '''signed 64 bit hash of a page body, fits a sqlite integer'''
+    digest = hashlib.blake2b(text.encode('utf-8', 'replace'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def conditional_headers(entry):
+    '''request headers that let the server answer 304 if nothing changed'''
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+class ValidatorCache(object):
+    '''persistent per url cache of the http validators (ETag and
+    Last-Modified) and content hash from the last fetch. the page's
+    outgoing links are kept too, so an unchanged page still feeds the
+    frontier without being downloaded again'''
+    def __init__(self, path=':memory:', commit_every=100):
+        self.commit_every = commit_every
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS validators ('
+                         'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                         'content_hash INTEGER, links BLOB)')
+        self._uncommitted = 0
+
+    def get(self, url):
+        '''returns the Entry for the url, or None if it was never fetched'''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT etag, last_modified, content_hash, links FROM validators WHERE url = ?',
+                (normalize_url(url),)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, chash, links = row
+        links = zlib.decompress(links).decode('utf-8').split('\n') if links else []
+        return Entry(etag, last_modified, chash, links)
+
+    def put(self, url, etag, last_modified, chash, links):
+        links = zlib.compress('\n'.join(links).encode('utf-8')) if links else None
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO validators '
+                '(url, etag, last_modified, content_hash, links) VALUES (?, ?, ?, ?, ?)',
+                (normalize_url(url), etag, last_modified, chash, links))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0